@@ -0,0 +1,47 @@
+"""CPU của fan-out: encode một lần cho mọi người nhận so với encode lại cho từng socket.
+
+Chạy: python -m bench.bench_encode [số người nhận]
+"""
+import datetime
+import json
+import sys
+import timeit
+import message.connection_manager as connection_manager
+from message.connection_manager import encode_frame
+
+EVENT = {
+  "action": "send",
+  "id": "5f0c6b1e-3c1d-4a7e-9a53-0f8f3c2a1b7d",
+  "conversation_id": "0d6f4c55-8e4b-4c5e-a7a4-2b1e9f3d8c10",
+  "sender_id": "a3b9e2f1-7c4d-4e8a-9b6c-1d2e3f4a5b6c",
+  "content": "Tin nhắn mẫu có dấu tiếng Việt " * 4,
+  "type": "text",
+  "file_url": None,
+  "seq": 12345,
+  "created_at": datetime.datetime(2026, 10, 18, 7, 0, 0, 123456)
+}
+
+
+def per_recipient(recipients: int):
+  # Cách cũ: mỗi socket tự send_json, tức encode lại cho từng người nhận
+  for _ in range(recipients):
+    json.dumps(EVENT, default=str)
+
+
+def once(recipients: int):
+  frame = encode_frame(EVENT)
+  for _ in range(recipients):
+    frame.encode()
+
+
+def main():
+  recipients = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+  rounds = 200
+  print(f"{recipients} người nhận, {rounds} lần broadcast, orjson={'có' if connection_manager.orjson else 'không'}")
+  for name, func in [("encode cho từng người nhận", per_recipient), ("encode một lần", once)]:
+    seconds = min(timeit.repeat(lambda: func(recipients), number=rounds, repeat=3))
+    print(f"  {name:<28} {seconds / rounds * 1e6:10.1f} µs / broadcast")
+
+
+if __name__ == "__main__":
+  main()
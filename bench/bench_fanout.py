@@ -0,0 +1,81 @@
+"""Fan-out tới 500 socket trong một tiến trình, có một phần client chậm (mặc định 5%, tức 25/500).
+
+Đo thời gian broadcast() giữ event loop và độ trễ tới khi mỗi socket nhanh thực sự gửi frame;
+mọi client chậm phải bị ngắt (1013) thay vì làm chậm các client khác, còn client nhanh thì không.
+Chạy: python -m bench.bench_fanout [số socket] [số broadcast] [tỉ lệ client chậm]
+"""
+import asyncio
+import random
+import statistics
+import sys
+import time
+from message.connection_manager import ConnectionManager, OUTBOUND_QUEUE_SIZE
+from message.pubsub import InProcessPubSub
+
+
+class FakeWebSocket:
+  def __init__(self, delay: float = 0.0):
+    self.delay = delay
+    self.latencies = []
+    self.close_code = None
+
+  async def accept(self):
+    pass
+
+  async def send_text(self, frame: str):
+    if self.delay:
+      await asyncio.sleep(self.delay)
+    sent_at = float(frame[frame.index('"t":') + 4:frame.index("}")])
+    self.latencies.append(time.perf_counter() - sent_at)
+
+  async def send_json(self, data):
+    pass
+
+  async def close(self, code: int = 1000, reason: str = ""):
+    self.close_code = code
+
+
+def percentile(values, fraction):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def main(sockets: int, broadcasts: int, slow_fraction: float = 0.05):
+  manager = ConnectionManager(InProcessPubSub())
+  await manager.start()
+  slow_count = max(1, round(sockets * slow_fraction)) if slow_fraction > 0 else 0
+  fast = [FakeWebSocket() for _ in range(sockets - slow_count)]
+  slow = [FakeWebSocket(delay=1.0) for _ in range(slow_count)]
+  # Xen kẽ client chậm giữa các client nhanh như khi kết nối thật
+  websockets = fast + slow
+  random.Random(1).shuffle(websockets)
+  for websocket in websockets:
+    await manager.connect(websocket, "bench")
+
+  broadcast_times = []
+  for _ in range(broadcasts):
+    started = time.perf_counter()
+    await manager.broadcast({"action": "send", "t": started}, "bench")
+    broadcast_times.append(time.perf_counter() - started)
+    # Nhường event loop cho các task ghi như khi có nhiều request thật
+    await asyncio.sleep(0.001)
+  await asyncio.sleep(0.5)
+
+  latencies = [latency for websocket in fast for latency in websocket.latencies]
+  delivered = len(latencies) / (len(fast) * broadcasts)
+  slow_evicted = sum(1 for websocket in slow if websocket.close_code == 1013)
+  fast_evicted = sum(1 for websocket in fast if websocket.close_code == 1013)
+  print(f"{sockets} socket ({slow_count} chậm), {broadcasts} broadcast, hàng đợi mỗi socket {OUTBOUND_QUEUE_SIZE}")
+  print(f"  broadcast(): trung bình {statistics.mean(broadcast_times) * 1e3:.2f} ms, p99 {percentile(broadcast_times, 0.99) * 1e3:.2f} ms")
+  print(f"  độ trễ tới socket nhanh: p50 {percentile(latencies, 0.5) * 1e3:.2f} ms, p99 {percentile(latencies, 0.99) * 1e3:.2f} ms")
+  print(f"  socket nhanh nhận đủ: {delivered:.0%}")
+  print(f"  client chậm bị ngắt: {slow_evicted}/{slow_count}; client nhanh bị ngắt: {fast_evicted}/{len(fast)} (evictions={manager.evictions})")
+  await manager.stop()
+
+
+if __name__ == "__main__":
+  asyncio.run(main(
+    int(sys.argv[1]) if len(sys.argv) > 1 else 500,
+    int(sys.argv[2]) if len(sys.argv) > 2 else 400,
+    float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+  ))
@@ -0,0 +1,72 @@
+"""Đồ thị bạn bè trong bộ nhớ với 1M cạnh ngẫu nhiên: bộ nhớ thực và độ trễ truy vấn.
+
+Không cần DB: đồ thị được đánh dấu đã nạp rồi dựng bằng add_edge như khi accept lời mời.
+Bộ nhớ đo bằng tracemalloc (cấp phát của riêng đồ thị, không tính chuỗi uuid đã có sẵn)
+và bằng RSS tăng thêm của tiến trình; tracemalloc làm chậm lúc dựng nên thời gian dựng
+chỉ mang tính tham khảo.
+Chạy: python -m bench.bench_friend_graph [số user] [số cạnh]
+"""
+import asyncio
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+import uuid
+from friend.friend_graph import FriendGraph
+
+
+def rss_bytes():
+  with open("/proc/self/status") as status:
+    for line in status:
+      if line.startswith("VmRSS:"):
+        return int(line.split()[1]) * 1024
+  return 0
+
+
+def percentile(samples, fraction):
+  samples = sorted(samples)
+  return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def main():
+  users = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  edges = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+  random.seed(1)
+  user_ids = [str(uuid.uuid4()) for _ in range(users)]
+
+  rss_before = rss_bytes()
+  tracemalloc.start()
+  graph = FriendGraph()
+  graph.loaded_at = time.monotonic()
+  started = time.perf_counter()
+  while graph.edges < edges:
+    a, b = random.sample(user_ids, 2)
+    graph.add_edge(a, b)
+  build_seconds = time.perf_counter() - started
+  traced, traced_peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  rss_delta = rss_bytes() - rss_before
+  stats = graph.stats()
+  mb = 1024 * 1024
+  print(f"{stats['nodes']} user, {stats['edges']} cạnh, dựng {build_seconds:.1f} s")
+  print(f"  tracemalloc {traced / mb:.1f} MB (đỉnh {traced_peak / mb:.1f} MB), "
+        f"RSS tăng {rss_delta / mb:.1f} MB, danh sách kề {stats['adjacency_bytes'] / mb:.1f} MB")
+
+  samples = random.sample(user_ids, 1000)
+  for name, query in [
+    ("friends", lambda user_id, other: graph.friends(user_id)),
+    ("mutual_friends", lambda user_id, other: graph.mutual_friends(user_id, other)),
+    ("suggestions", lambda user_id, other: graph.suggestions(user_id, 20))
+  ]:
+    latencies = []
+    for user_id in samples:
+      started = time.perf_counter()
+      await query(user_id, random.choice(user_ids))
+      latencies.append(time.perf_counter() - started)
+    print(f"  {name:<16} trung bình {statistics.mean(latencies) * 1e6:8.1f} µs, "
+          f"p99 {percentile(latencies, 0.99) * 1e6:8.1f} µs")
+
+
+if __name__ == "__main__":
+  asyncio.run(main())
@@ -0,0 +1,117 @@
+"""Đăng nhập đều 200 lần/giây trong khi các WebSocket nhận ping qua ConnectionManager.
+
+So sánh bcrypt chạy thẳng trên event loop với password_hasher: mỗi PING_INTERVAL một ping
+được "nhận" từ client và phát lại qua manager.broadcast() tới các socket giả; độ trễ
+khứ hồi tính từ thời điểm ping lẽ ra tới (theo lịch cố định, không phải lúc event loop
+rảnh) đến khi socket giả gửi frame đi. Lần chạy không đăng nhập làm mốc.
+Chạy: BCRYPT_ROUNDS=10 python -m bench.bench_password [đăng nhập/giây] [số giây] [số socket]
+"""
+import asyncio
+import json
+import sys
+import time
+from fastapi import HTTPException
+from message.connection_manager import ConnectionManager
+from message.pubsub import InProcessPubSub
+from models.models import pwd_context
+from user.password_hasher import password_hasher, PASSWORD_HASH_WORKERS
+
+PING_INTERVAL = 0.01
+
+
+class FakeWebSocket:
+  def __init__(self):
+    self.latencies = []
+
+  async def accept(self):
+    pass
+
+  async def send_text(self, frame: str):
+    self.latencies.append(time.perf_counter() - json.loads(frame)["t"])
+
+  async def send_json(self, data):
+    pass
+
+  async def close(self, code: int = 1000, reason: str = ""):
+    pass
+
+
+def percentile(values, fraction):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def at(moment: float):
+  delay = moment - time.perf_counter()
+  if delay > 0:
+    await asyncio.sleep(delay)
+
+
+async def measure(login, rate: int, seconds: float, sockets: int):
+  manager = ConnectionManager(InProcessPubSub())
+  await manager.start()
+  websockets = [FakeWebSocket() for _ in range(sockets)]
+  for websocket in websockets:
+    await manager.connect(websocket, "bench")
+  outcomes = {"ok": 0, "shed": 0}
+
+  async def handle_ping(sent_at: float):
+    # Như handler WebSocket: nhận frame từ client rồi phát lại cho cả cuộc hội thoại
+    await asyncio.sleep(0)
+    await manager.broadcast({"action": "pong", "t": sent_at}, "bench")
+
+  async def run_login():
+    try:
+      await login()
+      outcomes["ok"] += 1
+    except HTTPException:
+      outcomes["shed"] += 1
+
+  started = time.perf_counter()
+  pings, logins = [], []
+  # Lịch cố định: ping hay đăng nhập bị trễ vẫn được tính từ lúc lẽ ra phải tới
+  for index in range(int(seconds / PING_INTERVAL)):
+    sent_at = started + index * PING_INTERVAL
+    await at(sent_at)
+    pings.append(asyncio.create_task(handle_ping(sent_at)))
+    if login is not None:
+      while len(logins) < rate * (time.perf_counter() - started) and len(logins) < rate * seconds:
+        logins.append(asyncio.create_task(run_login()))
+  await asyncio.gather(*pings, *logins)
+  elapsed = time.perf_counter() - started
+  await asyncio.sleep(0.1)
+  for websocket in websockets:
+    manager.disconnect(websocket)
+  await asyncio.sleep(0.1)
+  await manager.stop()
+  latencies = [latency for websocket in websockets for latency in websocket.latencies]
+  return latencies, outcomes, elapsed
+
+
+async def main():
+  rate = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+  seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+  sockets = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+  hashed = pwd_context.hash("secret123")
+
+  async def inline():
+    # Cách cũ: verify đồng bộ ngay trong handler
+    valid, _ = pwd_context.verify_and_update("secret123", hashed)
+    assert valid
+
+  async def pooled():
+    valid, _ = await password_hasher.verify_and_update("secret123", hashed)
+    assert valid
+
+  print(f"{rate} đăng nhập/giây trong {seconds:g} s, {sockets} socket nhận ping mỗi "
+        f"{PING_INTERVAL * 1000:g} ms, {PASSWORD_HASH_WORKERS} thread hash")
+  for name, login in [("không đăng nhập", None), ("bcrypt trên event loop", inline), ("password_hasher", pooled)]:
+    latencies, outcomes, elapsed = await measure(login, rate, seconds, sockets)
+    print(f"  {name:<24} ping khứ hồi p50 {percentile(latencies, 0.5) * 1000:8.1f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:8.1f} ms; đăng nhập xong {outcomes['ok']}, "
+          f"bị từ chối 503 {outcomes['shed']}, hết đợt sau {elapsed:.1f} s")
+  password_hasher.shutdown()
+
+
+if __name__ == "__main__":
+  asyncio.run(main())
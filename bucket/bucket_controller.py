@@ -1,41 +1,119 @@
-from fastapi import APIRouter, Depends, HTTPException
+import asyncio
+import os
+import uuid
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from sqlalchemy import and_
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from fastapi import File, UploadFile
+from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartParser, MultiPartException
+from boto3.s3.transfer import TransferConfig
 from utils.utils import get_vn_time
-import boto3
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
+from bucket.s3 import s3_client, S3_BUCKET_NAME, AWS_REGION, public_url, upload_prefix, upload_owner
+from bucket.s3_cleanup import s3_cleanup_queue
+from database import get_db
+from models.models import ConversationParticipant, Message
+from botocore.exceptions import ClientError
+from user.user_controller import get_current_user_id
+from conversation.membership import membership_index
+from message.message_service import append_message, message_event
+from message.connection_manager import manager
+from interface.interface import (
+  IPresignUploadData,
+  ICompleteMultipartUploadData,
+  IAbortMultipartUploadData,
+  IUploadCompleteData
+)
 
-AWS_ACCESS_KEY = os.getenv('AWS_ACCESS_KEY')
-AWS_SECRET_KEY = os.getenv('AWS_SECRET_KEY')
-AWS_REGION = os.getenv('AWS_REGION')
-S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME')
+# File lớn hơn mức này bị từ chối với 413
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_MB", "250")) * 1024 * 1024
+# Phần boundary / header của form multipart được cộng thêm vào giới hạn body
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+# Số upload lên S3 chạy cùng lúc trên một worker, các upload khác chờ
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "4"))
+# File lớn hơn một part được gửi bằng multipart upload, mỗi part đọc thẳng từ file tạm
+UPLOAD_PART_SIZE = int(os.getenv("UPLOAD_PART_MB", "8")) * 1024 * 1024
 
-s3_client = boto3.client(
-  "s3",
-  aws_access_key_id=AWS_ACCESS_KEY,
-  aws_secret_access_key=AWS_SECRET_KEY,
-  region_name=AWS_REGION
+upload_semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+# Bộ nhớ đệm tối đa mỗi upload khoảng max_in_memory_upload_chunks * UPLOAD_PART_SIZE
+# (mặc định của boto3 là 10 part đọc sẵn vào RAM)
+upload_config = TransferConfig(
+  multipart_threshold=UPLOAD_PART_SIZE,
+  multipart_chunksize=UPLOAD_PART_SIZE,
+  max_concurrency=2,
+  use_threads=True
 )
+# boto3 không nhận tham số này trong constructor nhưng TransferManager của s3transfer có dùng
+upload_config.max_in_memory_upload_chunks = 2
+# Thời hạn (giây) của URL ký sẵn để client upload / tải thẳng với S3
+PRESIGNED_UPLOAD_EXPIRES = int(os.getenv("PRESIGNED_UPLOAD_EXPIRES", "900"))
+PRESIGNED_DOWNLOAD_EXPIRES = int(os.getenv("PRESIGNED_DOWNLOAD_EXPIRES", "300"))
 
 s3_router = APIRouter()
 
+
+class UploadTooLarge(MultiPartException):
+  pass
+
+
+async def capped_stream(request: Request, limit: int):
+  # Đếm byte ngay khi nhận: vượt giới hạn thì dừng, file tạm không bao giờ lớn hơn limit.
+  # Lỗi là MultiPartException để MultiPartParser đóng (xoá) file tạm đang ghi dở
+  received = 0
+  async for chunk in request.stream():
+    received += len(chunk)
+    if received > limit:
+      raise UploadTooLarge("Upload exceeds size limit")
+    yield chunk
+
+
+async def receive_upload(request: Request) -> UploadFile:
+  """Đọc field "file" của form multipart, từ chối với 413 theo Content-Length trước khi nhận
+  body và trong lúc nhận nếu client khai sai / không khai kích thước."""
+  too_large = HTTPException(status_code=413, detail=f"File exceeds {UPLOAD_MAX_BYTES // (1024 * 1024)} MB")
+  limit = UPLOAD_MAX_BYTES + UPLOAD_FORM_OVERHEAD
+  content_length = request.headers.get("content-length", "")
+  if content_length.isdigit() and int(content_length) > limit:
+    raise too_large
+  if not request.headers.get("content-type", "").startswith("multipart/form-data"):
+    raise HTTPException(status_code=400, detail="Expected multipart/form-data")
+  try:
+    form = await MultiPartParser(request.headers, capped_stream(request, limit), max_files=1, max_fields=10).parse()
+  except UploadTooLarge:
+    raise too_large
+  except MultiPartException as e:
+    raise HTTPException(status_code=400, detail=e.message)
+  file = form.get("file")
+  if not isinstance(file, UploadFile):
+    raise HTTPException(status_code=400, detail="Missing file")
+  if file.size > UPLOAD_MAX_BYTES:
+    await file.close()
+    raise too_large
+  return file
+
+
 @s3_router.post("/upload/")
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(request: Request):
+  # File được ghi ra file tạm (SpooledTemporaryFile) trong lúc nhận, không đọc toàn bộ vào RAM
+  file = await receive_upload(request)
   try:
-    file_content = await file.read()
-    s3_client.put_object(
-      Bucket=S3_BUCKET_NAME, 
-      Key=file.filename, 
-      Body=file_content,
-    )
+    async with upload_semaphore:
+      # boto3 là đồng bộ, chạy trong thread để không chặn event loop
+      await asyncio.to_thread(
+        s3_client.upload_fileobj,
+        file.file,
+        S3_BUCKET_NAME,
+        file.filename,
+        ExtraArgs={"ContentType": file.content_type} if file.content_type else None,
+        Config=upload_config
+      )
 
-    file_url = f"https://{S3_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{file.filename}"
+    file_url = public_url(file.filename)
     return {"filename": file.filename, "url": file_url}
   except Exception as e:
     return {"error": str(e)}
+  finally:
+    await file.close()
 
 
 @s3_router.get("/download/{filename}")
@@ -55,3 +133,170 @@ async def delete_file(filename: str):
   except Exception as e:
     return {"error": str(e)}
 
+
+
+def owned_key(key: str, user_id: str) -> str:
+  # Client chỉ được thao tác trên object do chính mình upload qua URL ký sẵn
+  if not key.startswith(upload_prefix(user_id)) or ".." in key:
+    raise HTTPException(status_code=403, detail="Object does not belong to current user")
+  return key
+
+
+@s3_router.post("/presign/upload")
+async def presign_upload(data: IPresignUploadData, current_user_id: str = Depends(get_current_user_id)):
+  """Cấp URL PUT ký sẵn để client upload thẳng lên S3.
+  File nhỏ hơn một part: một URL (mode = single). Lớn hơn: multipart, mỗi part một URL,
+  client gửi ETag của từng part về /presign/multipart/complete."""
+  if data.size <= 0:
+    raise HTTPException(status_code=400, detail="Invalid file size")
+  if data.size > UPLOAD_MAX_BYTES:
+    raise HTTPException(status_code=413, detail=f"File exceeds {UPLOAD_MAX_BYTES // (1024 * 1024)} MB")
+
+  key = f"{upload_prefix(current_user_id)}{uuid.uuid4()}/{os.path.basename(data.filename)}"
+  params = {"Bucket": S3_BUCKET_NAME, "Key": key}
+  if data.content_type:
+    params["ContentType"] = data.content_type
+
+  # generate_presigned_url chỉ ký cục bộ, không gọi mạng.
+  # ContentLength được ký vào URL nên S3 từ chối body khác kích thước đã khai báo
+  if data.size <= UPLOAD_PART_SIZE:
+    return {
+      "mode": "single",
+      "key": key,
+      "url": s3_client.generate_presigned_url(
+        "put_object",
+        Params={**params, "ContentLength": data.size},
+        ExpiresIn=PRESIGNED_UPLOAD_EXPIRES
+      ),
+      "file_url": public_url(key),
+      "expires_in": PRESIGNED_UPLOAD_EXPIRES
+    }
+
+  response = await asyncio.to_thread(s3_client.create_multipart_upload, **params)
+  upload_id = response["UploadId"]
+  part_count = -(-data.size // UPLOAD_PART_SIZE)
+  parts = [
+    {
+      "part_number": part_number,
+      "url": s3_client.generate_presigned_url(
+        "upload_part",
+        Params={
+          "Bucket": S3_BUCKET_NAME,
+          "Key": key,
+          "UploadId": upload_id,
+          "PartNumber": part_number,
+          # Part cuối nhận phần còn lại
+          "ContentLength": min(UPLOAD_PART_SIZE, data.size - (part_number - 1) * UPLOAD_PART_SIZE)
+        },
+        ExpiresIn=PRESIGNED_UPLOAD_EXPIRES
+      )
+    }
+    for part_number in range(1, part_count + 1)
+  ]
+  return {
+    "mode": "multipart",
+    "key": key,
+    "upload_id": upload_id,
+    "part_size": UPLOAD_PART_SIZE,
+    "parts": parts,
+    "file_url": public_url(key),
+    "expires_in": PRESIGNED_UPLOAD_EXPIRES
+  }
+
+
+@s3_router.post("/presign/multipart/complete")
+async def complete_multipart_upload(data: ICompleteMultipartUploadData, current_user_id: str = Depends(get_current_user_id)):
+  key = owned_key(data.key, current_user_id)
+  try:
+    await asyncio.to_thread(
+      s3_client.complete_multipart_upload,
+      Bucket=S3_BUCKET_NAME,
+      Key=key,
+      UploadId=data.upload_id,
+      MultipartUpload={
+        "Parts": [
+          {"PartNumber": part.part_number, "ETag": part.etag}
+          for part in sorted(data.parts, key=lambda part: part.part_number)
+        ]
+      }
+    )
+  except ClientError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  return {"key": key, "file_url": public_url(key)}
+
+
+@s3_router.post("/presign/multipart/abort")
+async def abort_multipart_upload(data: IAbortMultipartUploadData, current_user_id: str = Depends(get_current_user_id)):
+  key = owned_key(data.key, current_user_id)
+  try:
+    await asyncio.to_thread(s3_client.abort_multipart_upload, Bucket=S3_BUCKET_NAME, Key=key, UploadId=data.upload_id)
+  except ClientError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  return {"message": "Upload aborted"}
+
+
+@s3_router.post("/upload/complete")
+async def complete_upload(data: IUploadCompleteData, current_user_id: str = Depends(get_current_user_id)):
+  """Gọi sau khi client upload xong: tạo Message trỏ tới object và phát cho conversation."""
+  key = owned_key(data.key, current_user_id)
+  if not await membership_index.is_member(data.conversation_id, current_user_id):
+    raise HTTPException(status_code=403, detail="Sender is not in conversation")
+  try:
+    head = await asyncio.to_thread(s3_client.head_object, Bucket=S3_BUCKET_NAME, Key=key)
+  except ClientError:
+    raise HTTPException(status_code=404, detail="Uploaded object not found")
+  if head["ContentLength"] > UPLOAD_MAX_BYTES:
+    s3_cleanup_queue.enqueue(key)
+    raise HTTPException(status_code=413, detail=f"File exceeds {UPLOAD_MAX_BYTES // (1024 * 1024)} MB")
+
+  new_message = await append_message({
+    "conversation_id": data.conversation_id,
+    "sender_id": current_user_id,
+    "content": data.content,
+    "type": data.type.value,
+    # Lưu key thay vì URL công khai: client lấy URL tải qua /presign/download
+    "file_url": key
+  })
+  await manager.broadcast(message_event(new_message), new_message["conversation_id"])
+  return new_message
+
+
+@s3_router.get("/presign/download")
+async def presign_download(
+  key: str,
+  expires_in: int = Query(PRESIGNED_DOWNLOAD_EXPIRES, ge=60, le=3600),
+  db: AsyncSession = Depends(get_db),
+  current_user_id: str = Depends(get_current_user_id)
+):
+  """URL GET ký sẵn, ngắn hạn, để client tải thẳng từ S3.
+  Chỉ cấp cho object của chính người gọi hoặc được chính người upload đính kèm vào một
+  tin nhắn trong conversation mà người gọi đang tham gia."""
+  if ".." in key:
+    raise HTTPException(status_code=404, detail="File not found")
+  if not key.startswith(upload_prefix(current_user_id)):
+    conditions = [Message.file_url.in_([key, public_url(key)])]
+    owner = upload_owner(key)
+    if owner is not None:
+      # Tin nhắn của người khác trỏ tới key này không cấp quyền tải
+      conditions.append(Message.sender_id == owner)
+    result = await db.execute(
+      select(Message.id)
+      .join(
+        ConversationParticipant,
+        and_(
+          ConversationParticipant.conversation_id == Message.conversation_id,
+          ConversationParticipant.user_id == current_user_id
+        )
+      )
+      # Tin nhắn cũ lưu URL công khai thay vì key
+      .where(*conditions)
+      .limit(1)
+    )
+    if result.first() is None:
+      raise HTTPException(status_code=404, detail="File not found")
+  url = s3_client.generate_presigned_url(
+    "get_object",
+    Params={"Bucket": S3_BUCKET_NAME, "Key": key},
+    ExpiresIn=expires_in
+  )
+  return {"key": key, "url": url, "expires_in": expires_in}
@@ -0,0 +1,64 @@
+import boto3
+import os
+from botocore.config import Config
+from urllib.parse import urlparse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+AWS_ACCESS_KEY = os.getenv('AWS_ACCESS_KEY')
+AWS_SECRET_KEY = os.getenv('AWS_SECRET_KEY')
+AWS_REGION = os.getenv('AWS_REGION')
+S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME')
+# Chỉ đặt khi dùng S3 giả lập (moto, MinIO) ở môi trường test / dev
+AWS_S3_ENDPOINT_URL = os.getenv('AWS_S3_ENDPOINT_URL') or None
+
+s3_client = boto3.client(
+  "s3",
+  aws_access_key_id=AWS_ACCESS_KEY,
+  aws_secret_access_key=AWS_SECRET_KEY,
+  region_name=AWS_REGION,
+  endpoint_url=AWS_S3_ENDPOINT_URL,
+  # SigV4: URL ký sẵn ràng buộc cả Content-Length (SigV2 bỏ qua header này)
+  config=Config(signature_version="s3v4")
+)
+
+
+def public_url(key: str) -> str:
+  return f"https://{S3_BUCKET_NAME}.s3.{AWS_REGION}.amazonaws.com/{key}"
+
+
+def object_key_from_url(file_url: str):
+  """file_url là key (upload qua URL ký sẵn) hoặc URL công khai của bucket (cách cũ).
+  URL trỏ ra ngoài bucket không ứng với object nào: trả về None."""
+  if not file_url.startswith(("http://", "https://")):
+    return file_url
+  if not file_url.startswith(public_url("")):
+    return None
+  return urlparse(file_url).path.lstrip("/")
+
+
+def upload_prefix(user_id: str) -> str:
+  return f"uploads/{user_id}/"
+
+
+def upload_owner(key: str):
+  """user_id của người upload với key dạng uploads/<user_id>/..., None với key khác."""
+  parts = key.split("/", 2)
+  if len(parts) == 3 and parts[0] == "uploads":
+    return parts[1]
+  return None
+
+
+def attachment_allowed(file_url, user_id: str) -> bool:
+  """Tin nhắn chỉ được trỏ tới object do chính người gửi upload: file_url do client tự điền,
+  nếu không chặn thì ai biết key cũng lấy được URL tải hoặc khiến object bị xoá theo tin nhắn."""
+  if not file_url:
+    return True
+  key = object_key_from_url(file_url)
+  if key is None:
+    return True
+  if ".." in key:
+    return False
+  owner = upload_owner(key)
+  return owner is None or owner == user_id
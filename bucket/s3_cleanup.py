@@ -0,0 +1,99 @@
+import asyncio
+from sqlalchemy.future import select
+from database import AsyncSessionLocal
+from models.models import Message
+from bucket.s3 import s3_client, S3_BUCKET_NAME, object_key_from_url, public_url
+
+# delete_objects của S3 nhận tối đa 1000 key mỗi lần
+S3_DELETE_BATCH_SIZE = 1000
+
+
+class S3CleanupQueue:
+  """Xoá object S3 ở nền để API không phải chờ S3.
+
+  Object vẫn còn tin nhắn khác trỏ tới (cùng file gửi nhiều lần) được giữ lại.
+  Hàng đợi nằm trong bộ nhớ: object chưa kịp xoá khi tiến trình dừng đột ngột sẽ bị bỏ lại.
+  """
+
+  def __init__(self):
+    self.queue: asyncio.Queue = asyncio.Queue()
+    self.task = None
+    self.deleted = 0
+    self.failed = 0
+    self.kept = 0
+
+  async def start(self):
+    if self.task is None:
+      self.task = asyncio.create_task(self._run())
+
+  async def stop(self):
+    if self.task is None:
+      return
+    self.task.cancel()
+    try:
+      await self.task
+    except asyncio.CancelledError:
+      pass
+    self.task = None
+    keys = []
+    while not self.queue.empty():
+      keys.append(self.queue.get_nowait())
+    for start in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+      await self._delete(keys[start:start + S3_DELETE_BATCH_SIZE])
+
+  def enqueue(self, file_url: str):
+    key = object_key_from_url(file_url) if file_url else None
+    if key:
+      self.queue.put_nowait(key)
+
+  async def _run(self):
+    while True:
+      keys = [await self.queue.get()]
+      while len(keys) < S3_DELETE_BATCH_SIZE and not self.queue.empty():
+        keys.append(self.queue.get_nowait())
+      await self._delete(keys)
+
+  async def _referenced(self, keys):
+    # Tin nhắn lưu key (upload qua URL ký sẵn) hoặc URL công khai (cách cũ); ix_messages_file_url
+    urls = {public_url(key): key for key in keys}
+    async with AsyncSessionLocal() as db:
+      result = await db.execute(
+        select(Message.file_url).where(Message.file_url.in_([*keys, *urls])).distinct()
+      )
+      return {urls.get(file_url, file_url) for file_url in result.scalars().all()}
+
+  async def _delete(self, keys):
+    try:
+      referenced = await self._referenced(keys)
+    except Exception as e:
+      # Không kiểm tra được thì không xoá
+      self.failed += len(keys)
+      print("Lỗi kiểm tra file S3 còn được dùng:", str(e))
+      return
+    self.kept += len(referenced)
+    keys = [key for key in dict.fromkeys(keys) if key not in referenced]
+    if not keys:
+      return
+    try:
+      # boto3 là đồng bộ, chạy trong thread để không chặn event loop
+      response = await asyncio.to_thread(
+        s3_client.delete_objects,
+        Bucket=S3_BUCKET_NAME,
+        Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True}
+      )
+      errors = response.get("Errors", [])
+      self.failed += len(errors)
+      self.deleted += len(keys) - len(errors)
+    except Exception as e:
+      self.failed += len(keys)
+      print("Lỗi xoá file S3:", str(e))
+
+  def stats(self) -> dict:
+    return {
+      "pending": self.queue.qsize(),
+      "deleted": self.deleted,
+      "failed": self.failed,
+      "kept": self.kept
+    }
+
+s3_cleanup_queue = S3CleanupQueue()
@@ -7,43 +7,95 @@ from interface.interface import (
     IUpdateConversationNameData, 
     IUpdateConversationParticipantData,
     IRemoveParticipantData,
-    IUpdateConversationData
+    IUpdateConversationData,
+    IReadConversationData
 )
 from sqlalchemy.future import select
-from sqlalchemy import delete
+from sqlalchemy import update, func
 from utils.utils import get_vn_time
+from utils.cache import TTLCache
 from database import get_db
+from user.user_controller import get_current_user_id
+from conversation.conversation_service import get_or_create_private_conversation, find_private_conversation_id
+from conversation.purge import purge_queue, detach_participants
+from message.connection_manager import manager
+from conversation.membership import (
+    add_participants_by_email,
+    remove_participants_not_in
+)
 
 conversation_router = APIRouter()
 
+# Cache chi tiết conversation (header chat). Được xoá khi đổi tên / avatar / participants
+# hoặc xoá conversation; last_message_id / updated_at có thể trễ tối đa ttl giây.
+conversation_cache = TTLCache(maxsize=2048, ttl=30)
+CONVERSATION_CACHE_CHANNEL = "#conversation-cache"
+
+
+def apply_conversation_invalidation(payload: dict):
+    conversation_cache.invalidate(payload["conversation_id"])
+
+
+# Mỗi worker có cache riêng: worker sửa conversation báo cho mọi worker khác xoá theo.
+# Thông báo lỡ trong lúc pub/sub mất kết nối chỉ làm cache cũ tối đa ttl giây.
+manager.add_control_handler(CONVERSATION_CACHE_CHANNEL, apply_conversation_invalidation)
+
+
+async def invalidate_conversation(conversation_id: str):
+    """Gọi sau khi commit thay đổi conversation hoặc participants."""
+    await manager.publish_control(CONVERSATION_CACHE_CHANNEL, {"conversation_id": conversation_id})
+
+async def get_conversation_detail(conversation_id: str, db: AsyncSession):
+    """Conversation kèm thông tin rút gọn của participants trong một câu truy vấn, có cache."""
+    detail = conversation_cache.get(conversation_id)
+    if detail is not None:
+        return detail
+
+    result = await db.execute(
+        select(Conversation, User.id, User.username, User.email, User.avatar_url, User.created_at)
+        .outerjoin(ConversationParticipant, ConversationParticipant.conversation_id == Conversation.id)
+        .outerjoin(User, User.id == ConversationParticipant.user_id)
+        .where(Conversation.id == conversation_id)
+    )
+    rows = result.all()
+    if not rows:
+        return None
+
+    conversation = rows[0].Conversation
+    detail = {
+        "conversation": {column.name: getattr(conversation, column.key) for column in Conversation.__table__.columns},
+        "users": [
+            {
+                "id": row.id,
+                "username": row.username,
+                "email": row.email,
+                "avatar_url": row.avatar_url,
+                "created_at": row.created_at
+            }
+            for row in rows if row.id is not None
+        ]
+    }
+    conversation_cache.set(conversation_id, detail)
+    return detail
+
+
 @conversation_router.get("/{conversation_id}")
 async def get_conversation_by_id(conversation_id: str, db: AsyncSession = Depends(get_db)):
     """params: conversation_id"""
-    result = await db.execute(select(Conversation).where(Conversation.id == conversation_id))
-    conversation = result.scalars().first()
-    
-    result = await db.execute(select(ConversationParticipant.user_id).where(ConversationParticipant.conversation_id == conversation_id))
-    user_ids = result.scalars().all()
-    
-    result = await db.execute(select(User).where(User.id.in_(user_ids)))
-    users = result.scalars().all()
-    
-    return {
-        "conversation": conversation,
-        "users": users
-    }
+    detail = await get_conversation_detail(conversation_id, db)
+    if detail is None:
+        return {
+            "conversation": None,
+            "users": []
+        }
+    return detail
 
 
 @conversation_router.get("/users/{conversation_id}")
 async def get_conversation_users(conversation_id: str, db: AsyncSession = Depends(get_db)):
     """params: conversation_id"""    
-    result = await db.execute(select(ConversationParticipant.user_id).where(ConversationParticipant.conversation_id == conversation_id))
-    user_ids = result.scalars().all()
-    
-    result = await db.execute(select(User).where(User.id.in_(user_ids)))
-    users = result.scalars().all()
-    
-    return users
+    detail = await get_conversation_detail(conversation_id, db)
+    return detail["users"] if detail else []
 
 
 @conversation_router.post("/")
@@ -60,29 +112,29 @@ async def create_new_conversation(data: INewConversationData, db: AsyncSession =
     if not creator:
         raise HTTPException(status_code=400, detail="Creator does not exist")
 
-    result = await db.execute(select(User.id, User.email).where(User.email.in_(data.participants)))
-    user_ids = result.scalars().all()
-
-    new_conversation = Conversation(
-        name=data.name,
-        type=data.type,
-        avatar_url=data.avatar_url,
-        created_by=creator
-    )
-    
-    db.add(new_conversation)
-    await db.commit()
-    await db.refresh(new_conversation)
-    
-    participants_records = [
-        ConversationParticipant(
-            conversation_id=new_conversation.id,
-            user_id=user_id
+    if data.type == "private":
+        # Conversation private giữa hai user là duy nhất theo pair_key
+        result = await db.execute(select(User.id).where(User.email.in_(data.participants)))
+        user_ids = result.scalars().all()
+        if len(user_ids) != 2:
+            raise HTTPException(status_code=400, detail="Private conversation requires exactly 2 registered participants")
+        conversation_id, _ = await get_or_create_private_conversation(db, user_ids[0], user_ids[1], data.name)
+        await db.commit()
+        result = await db.execute(select(Conversation).where(Conversation.id == conversation_id))
+        new_conversation = result.scalars().first()
+    else:
+        new_conversation = Conversation(
+            name=data.name,
+            type=data.type,
+            avatar_url=data.avatar_url,
+            created_by=creator
         )
-        for user_id in user_ids
-    ]
-    db.add_all(participants_records)
-    await db.commit()
+        
+        db.add(new_conversation)
+        await db.flush()
+        user_ids = await add_participants_by_email(db, new_conversation.id, data.participants)
+        await db.commit()
+    await manager.publish_membership(new_conversation.id, added=user_ids)
 
     return {
         "message": "Conversation created successfully",
@@ -91,6 +143,27 @@ async def create_new_conversation(data: INewConversationData, db: AsyncSession =
     }
 
 
+@conversation_router.post("/private/{user_id}")
+async def open_private_conversation(user_id: str, db: AsyncSession = Depends(get_db), current_user_id: str = Depends(get_current_user_id)):
+    """Mở (hoặc tạo nếu chưa có) conversation private giữa user hiện tại và user_id"""
+    if user_id == current_user_id:
+        raise HTTPException(status_code=400, detail="Cannot open a private conversation with yourself")
+    conversation_id = await find_private_conversation_id(db, current_user_id, user_id)
+    created = False
+    if conversation_id is None:
+        result = await db.execute(select(User.username).where(User.id == user_id))
+        username = result.scalars().first()
+        if username is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        conversation_id, created = await get_or_create_private_conversation(db, current_user_id, user_id, username)
+        await db.commit()
+        await manager.publish_membership(conversation_id, added=[current_user_id, user_id])
+    return {
+        "conversation_id": conversation_id,
+        "created": created
+    }
+
+
 @conversation_router.put("/update-avatar/{conversation_id}")
 async def update_conversation_name(conversation_id: str, data: IUpdateConversationAvatarData, db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(Conversation).where(Conversation.id == conversation_id))
@@ -102,6 +175,7 @@ async def update_conversation_name(conversation_id: str, data: IUpdateConversati
     conversation.updated_at = await get_vn_time()
     
     await db.commit()
+    await invalidate_conversation(conversation_id)
     await db.refresh(conversation)
 
     return {"message": "Conversation avatar updated"}
@@ -118,6 +192,7 @@ async def update_conversation_name(conversation_id: str, data: IUpdateConversati
     conversation.updated_at = await get_vn_time()
     
     await db.commit()
+    await invalidate_conversation(conversation_id)
     await db.refresh(conversation)
 
     return {"message": "Conversation name updated"}
@@ -134,34 +209,12 @@ async def update_conversation_name(conversation_id: str, data: IUpdateConversati
     conversation.avatar_url = data.avatar_url
     conversation.updated_at = await get_vn_time()
     
-    result = await db.execute(select(User.id).where(User.email.in_(data.participants)))
-    user_ids = result.scalars().all()
-    
-    result = await db.execute(
-        select(ConversationParticipant.user_id)
-        .where(ConversationParticipant.conversation_id == conversation_id)
-    )
-    existing_participants = set(result.scalars().all())
-    new_user_ids = set(user_ids)
-    participants_to_remove = existing_participants - new_user_ids
-    participants_to_add = new_user_ids - existing_participants
-
-    if participants_to_remove:
-        await db.execute(
-            delete(ConversationParticipant)
-            .where(
-                ConversationParticipant.conversation_id == conversation_id,
-                ConversationParticipant.user_id.in_(participants_to_remove)
-            )
-        )
-    if participants_to_add:
-        new_participants = [
-            ConversationParticipant(conversation_id=conversation_id, user_id=user_id)
-            for user_id in participants_to_add
-        ]
-        db.add_all(new_participants)
+    participants_to_remove = await remove_participants_not_in(db, conversation_id, data.participants)
+    participants_to_add = await add_participants_by_email(db, conversation_id, data.participants)
 
     await db.commit()
+    await invalidate_conversation(conversation_id)
+    await manager.publish_membership(conversation_id, added=participants_to_add, removed=participants_to_remove)
     await db.refresh(conversation)
     
     result = await db.execute(select(User.id).where(User.email == data.email))
@@ -193,25 +246,10 @@ async def update_conversation_add_participants(conversation_id: str, data: IUpda
     if conversation is None:
         raise HTTPException(status_code=404, detail="Conversation not found")
 
-    result = await db.execute(select(User.id).where(User.email.in_(data.participants)))
-    user_ids = result.scalars().all()
-
-    result = await db.execute(
-        select(ConversationParticipant.user_id)
-        .where(ConversationParticipant.conversation_id == conversation_id, 
-            ConversationParticipant.user_id.in_(user_ids))
-    )
-    
-    existing_participants = {row[0] for row in result.all()} 
-    new_user_ids = [user_id for user_id in user_ids if user_id not in existing_participants]
-
-    new_participants = [
-        ConversationParticipant(conversation_id=conversation_id, user_id=user_id)
-        for user_id in new_user_ids
-    ]
-    
-    db.add_all(new_participants)
+    new_user_ids = await add_participants_by_email(db, conversation_id, data.participants)
     await db.commit()
+    await invalidate_conversation(conversation_id)
+    await manager.publish_membership(conversation_id, added=new_user_ids)
 
     return {
         "message": "Users added successfully",
@@ -242,6 +280,8 @@ async def update_conversation_remove_participant(conversation_id: str, data: IRe
     
     await db.delete(user)
     await db.commit()
+    await invalidate_conversation(conversation_id)
+    await manager.publish_membership(conversation_id, removed=[userid])
 
     return {
         "message": "User removed successfully",
@@ -250,12 +290,33 @@ async def update_conversation_remove_participant(conversation_id: str, data: IRe
     }
 
 
+@conversation_router.put("/read/{conversation_id}")
+async def mark_conversation_read(conversation_id: str, data: IReadConversationData, db: AsyncSession = Depends(get_db)):
+    """params: seq là seq của sự kiện mới nhất user đã xem, con trỏ đã đọc không bao giờ lùi"""
+    result = await db.execute(
+        update(ConversationParticipant)
+        .where(
+            ConversationParticipant.conversation_id == conversation_id,
+            ConversationParticipant.user_id == select(User.id).where(User.email == data.email).scalar_subquery()
+        )
+        .values(last_read_seq=func.greatest(ConversationParticipant.last_read_seq, data.seq))
+    )
+    if result.rowcount == 0:
+        raise HTTPException(status_code=404, detail="User not in conversation")
+    await db.commit()
+    return {"message": "Conversation marked as read"}
+
+
 @conversation_router.delete("/{conversation_id}")
 async def delete_conversation(conversation_id: str, db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(Conversation).where(Conversation.id == conversation_id))
     conversation = result.scalars().first()
     if conversation is None:
         raise HTTPException(status_code=404, detail="Conversation not found")
-    await db.delete(conversation)
+    # Gỡ participants ngay, tin nhắn và conversation được xoá dần ở nền
+    removed_user_ids = await detach_participants(db, conversation_id)
     await db.commit()
+    await invalidate_conversation(conversation_id)
+    await manager.publish_membership(conversation_id, removed=removed_user_ids)
+    purge_queue.purge_conversation(conversation_id)
     return {"message": "Conversation deleted successfully"}
\ No newline at end of file
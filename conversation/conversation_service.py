@@ -0,0 +1,52 @@
+import uuid
+from typing import Optional, Tuple
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from models.models import Conversation, get_vietnam_now
+from conversation.membership import add_participants, membership_index
+from utils.utils import private_pair_key
+
+
+async def find_private_conversation_id(db: AsyncSession, user_id: str, other_user_id: str) -> Optional[str]:
+    """Tra conversation riêng của hai user qua unique index pair_key."""
+    result = await db.execute(
+        select(Conversation.id).where(Conversation.pair_key == private_pair_key(user_id, other_user_id))
+    )
+    return result.scalar_one_or_none()
+
+
+async def get_or_create_private_conversation(
+    db: AsyncSession,
+    user_id: str,
+    other_user_id: str,
+    name: str
+) -> Tuple[str, bool]:
+    """Trả về (conversation_id, created). Chỉ tồn tại tối đa một conversation riêng cho
+    mỗi cặp user nhờ unique index pair_key, kể cả khi hai request chạy đồng thời.
+    Không commit, người gọi commit."""
+    pair_key = private_pair_key(user_id, other_user_id)
+    now = get_vietnam_now()
+    result = await db.execute(
+        insert(Conversation)
+        .values(
+            id=str(uuid.uuid4()),
+            name=name,
+            type="private",
+            avatar_url="",
+            created_by=user_id,
+            pair_key=pair_key,
+            last_seq=0,
+            created_at=now,
+            updated_at=now
+        )
+        .on_conflict_do_nothing(index_elements=["pair_key"])
+        .returning(Conversation.id)
+    )
+    conversation_id = result.scalar_one_or_none()
+    created = conversation_id is not None
+    if not created:
+        conversation_id = await find_private_conversation_id(db, user_id, other_user_id)
+    await add_participants(db, conversation_id, [user_id, other_user_id])
+    membership_index.invalidate(conversation_id)
+    return conversation_id, created
@@ -0,0 +1,122 @@
+import uuid
+from typing import FrozenSet, Iterable, List
+from sqlalchemy import String, cast, delete, func, literal
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from database import AsyncSessionLocal
+from models.models import Conversation, ConversationParticipant, User
+from utils.cache import TTLCache
+
+
+class MembershipIndex:
+    """conversation_id -> tập user_id, nạp lười từ ConversationParticipant, loại bỏ theo LRU.
+
+    Các endpoint thay đổi participants phải gọi invalidate(); ttl giới hạn độ trễ
+    khi thay đổi đến từ worker khác.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def members(self, conversation_id: str) -> FrozenSet[str]:
+        members = self.cache.get(conversation_id)
+        if members is None:
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(
+                    select(ConversationParticipant.user_id)
+                    .where(ConversationParticipant.conversation_id == conversation_id)
+                )
+                members = frozenset(result.scalars().all())
+            self.cache.set(conversation_id, members)
+        return members
+
+    async def is_member(self, conversation_id: str, user_id: str) -> bool:
+        return user_id in await self.members(conversation_id)
+
+    def invalidate(self, conversation_id: str):
+        self.cache.invalidate(conversation_id)
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+membership_index = MembershipIndex()
+
+
+async def get_user_conversation_ids(user_id: str) -> List[str]:
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(ConversationParticipant.conversation_id)
+            .where(ConversationParticipant.user_id == user_id)
+        )
+        return list(result.scalars().all())
+
+
+async def is_participant(user_id: str, conversation_id: str) -> bool:
+    return await membership_index.is_member(conversation_id, user_id)
+
+
+def current_last_seq(conversation_id: str):
+    # Người mới vào chỉ tính chưa đọc từ thời điểm được thêm, không nhận cả lịch sử cũ
+    return (
+        select(Conversation.last_seq)
+        .where(Conversation.id == conversation_id)
+        .scalar_subquery()
+    )
+
+
+async def add_participants(db: AsyncSession, conversation_id: str, user_ids: Iterable[str]) -> List[str]:
+    """Thêm participants theo id bằng một câu INSERT, bỏ qua người đã có.
+    Trả về các user_id thực sự được thêm."""
+    last_seq = current_last_seq(conversation_id)
+    rows = [
+        {"id": str(uuid.uuid4()), "conversation_id": conversation_id, "user_id": user_id, "last_read_seq": last_seq}
+        for user_id in set(user_ids)
+    ]
+    if not rows:
+        return []
+    result = await db.execute(
+        insert(ConversationParticipant)
+        .values(rows)
+        .on_conflict_do_nothing(index_elements=["conversation_id", "user_id"])
+        .returning(ConversationParticipant.user_id)
+    )
+    return list(result.scalars().all())
+
+
+async def add_participants_by_email(db: AsyncSession, conversation_id: str, emails: Iterable[str]) -> List[str]:
+    """Đổi email -> id và thêm participants trong cùng một câu lệnh, bỏ qua người đã có.
+    Trả về các user_id thực sự được thêm."""
+    emails = list(emails)
+    if not emails:
+        return []
+    result = await db.execute(
+        insert(ConversationParticipant)
+        .from_select(
+            ["id", "conversation_id", "user_id", "last_read_seq"],
+            select(
+                cast(func.gen_random_uuid(), String),
+                literal(conversation_id, String),
+                User.id,
+                current_last_seq(conversation_id)
+            )
+            .where(User.email.in_(emails))
+        )
+        .on_conflict_do_nothing(index_elements=["conversation_id", "user_id"])
+        .returning(ConversationParticipant.user_id)
+    )
+    return list(result.scalars().all())
+
+
+async def remove_participants_not_in(db: AsyncSession, conversation_id: str, emails: Iterable[str]) -> List[str]:
+    """Xoá mọi participant không nằm trong danh sách email bằng một câu DELETE.
+    Trả về các user_id đã bị xoá."""
+    result = await db.execute(
+        delete(ConversationParticipant)
+        .where(
+            ConversationParticipant.conversation_id == conversation_id,
+            ConversationParticipant.user_id.not_in(select(User.id).where(User.email.in_(list(emails))))
+        )
+        .returning(ConversationParticipant.user_id)
+    )
+    return list(result.scalars().all())
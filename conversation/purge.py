@@ -0,0 +1,132 @@
+import asyncio
+from collections import deque
+from typing import List
+from sqlalchemy import delete, select, update
+from models.models import Conversation, ConversationParticipant, Message, User
+from message.message_service import autocommit_engine, delete_sender_messages, delete_event
+from message.connection_manager import manager
+from bucket.s3_cleanup import s3_cleanup_queue
+
+# Số tin nhắn xoá trong mỗi transaction ngắn
+PURGE_CHUNK_SIZE = 1000
+# Số lần thử một job trước khi bỏ cuộc; job chạy lại được vì mỗi khối đã xoá là đã commit
+PURGE_MAX_ATTEMPTS = 3
+PURGE_RETRY_DELAY = 5
+
+
+class PurgeQueue:
+    """Xoá conversation / user lớn ở nền, mỗi lần một khối tin nhắn.
+
+    Tin nhắn bị xoá theo từng khối PURGE_CHUNK_SIZE dòng, file đính kèm được chuyển cho
+    s3_cleanup_queue, cuối cùng mới xoá dòng cha (các dòng con còn lại do ON DELETE CASCADE).
+    Tin nhắn của user bị xoá còn để lại dấu xoá trong các conversation vẫn tồn tại.
+    Job lỗi được thử lại, job vẫn lỗi sau PURGE_MAX_ATTEMPTS lần được ghi vào stats().
+    Hàng đợi nằm trong bộ nhớ: job chưa chạy xong khi tiến trình dừng cần được gọi lại.
+    """
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task = None
+        self.purged_messages = 0
+        self.failed = 0
+        self.recent_failures = deque(maxlen=20)
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def purge_conversation(self, conversation_id: str):
+        self.queue.put_nowait(("conversation", conversation_id))
+
+    def purge_user(self, user_id: str):
+        self.queue.put_nowait(("user", user_id))
+
+    async def _run(self):
+        while True:
+            kind, target_id = await self.queue.get()
+            for attempt in range(1, PURGE_MAX_ATTEMPTS + 1):
+                try:
+                    await self._purge(kind, target_id)
+                    break
+                except Exception as e:
+                    print(f"Lỗi xoá {kind} {target_id} (lần {attempt}):", str(e))
+                    if attempt == PURGE_MAX_ATTEMPTS:
+                        self.failed += 1
+                        self.recent_failures.append({"kind": kind, "id": target_id, "error": str(e)})
+                    else:
+                        await asyncio.sleep(PURGE_RETRY_DELAY * attempt)
+
+    async def _purge(self, kind: str, target_id: str):
+        if kind == "conversation":
+            await self._purge_messages(Message.conversation_id == target_id)
+            await self._delete_row(delete(Conversation).where(Conversation.id == target_id))
+        else:
+            await self._purge_sender_messages(target_id)
+            # conversations.created_by về NULL nhờ ON DELETE SET NULL
+            await self._delete_row(delete(User).where(User.id == target_id))
+
+    async def _purge_messages(self, condition):
+        while True:
+            chunk = select(Message.id).where(condition).limit(PURGE_CHUNK_SIZE).scalar_subquery()
+            async with autocommit_engine.connect() as conn:
+                result = await conn.execute(
+                    delete(Message).where(Message.id.in_(chunk)).returning(Message.file_url)
+                )
+                file_urls = result.scalars().all()
+            for file_url in file_urls:
+                s3_cleanup_queue.enqueue(file_url)
+            self.purged_messages += len(file_urls)
+            if len(file_urls) < PURGE_CHUNK_SIZE:
+                return
+            # Nhường event loop giữa các khối
+            await asyncio.sleep(0)
+
+    async def _purge_sender_messages(self, user_id: str):
+        while True:
+            deleted = await delete_sender_messages(user_id, PURGE_CHUNK_SIZE)
+            for row in deleted:
+                await manager.broadcast(delete_event(row), row["conversation_id"])
+            self.purged_messages += len(deleted)
+            if len(deleted) < PURGE_CHUNK_SIZE:
+                return
+            await asyncio.sleep(0)
+
+    async def _delete_row(self, stmt):
+        async with autocommit_engine.connect() as conn:
+            await conn.execute(stmt)
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.queue.qsize(),
+            "purged_messages": self.purged_messages,
+            "failed": self.failed,
+            "recent_failures": list(self.recent_failures)
+        }
+
+purge_queue = PurgeQueue()
+
+
+async def detach_participants(db, conversation_id: str) -> List[str]:
+    """Gỡ mọi participant để conversation biến mất khỏi inbox ngay, trước khi purge,
+    và nhả pair_key để cặp user mở được conversation private mới trong lúc chờ purge.
+    Trả về user_id của các participant đã gỡ."""
+    await db.execute(
+        update(Conversation)
+        .where(Conversation.id == conversation_id)
+        .values(pair_key=None)
+    )
+    result = await db.execute(
+        delete(ConversationParticipant)
+        .where(ConversationParticipant.conversation_id == conversation_id)
+        .returning(ConversationParticipant.user_id)
+    )
+    return list(result.scalars().all())
@@ -1,95 +1,251 @@
-from fastapi import APIRouter, Depends, HTTPException
-from models.models import Friendship, User, Conversation, ConversationParticipant
+from fastapi import APIRouter, Depends, HTTPException, Query
+from models.models import Friendship, User, get_vietnam_now
 from database import get_db
 from pydantic import BaseModel
 from datetime import datetime
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import aliased
 from sqlalchemy.future import select
-from sqlalchemy import delete, or_, and_, func
+from sqlalchemy import or_, and_, case, tuple_, func, cast, literal, String, DateTime
+from sqlalchemy.dialects.postgresql import insert
+from typing import Optional
+from utils.utils import encode_cursor, decode_cursor
 from schemas.schemas import FriendRequestSchema, FriendshipActionSchema
-from user.user_controller import get_current_user
+from user.user_controller import get_current_user_id
+from message.connection_manager import manager
+from conversation.conversation_controller import invalidate_conversation
+from conversation.conversation_service import get_or_create_private_conversation, find_private_conversation_id
+from conversation.purge import purge_queue, detach_participants
+from friend.friend_graph import friend_graph
+from user.profile_loader import profile_loader, ordered_profiles
 
 friend_router = APIRouter()
 
+# Các cột của User được phép trả về cho người khác
+PUBLIC_USER_FIELDS = ("id", "username", "email", "avatar_url", "created_at")
+
 @friend_router.get("/friend-list")
 async def get_friend_list(
   db: AsyncSession = Depends(get_db), 
-  current_user: User = Depends(get_current_user)
+  current_user_id: str = Depends(get_current_user_id)
 ):
+  """Giữ nguyên dạng cũ (friendship kèm requester / receiver) nhưng chỉ với thông tin công khai
+  của hai user, không bao giờ trả về hash mật khẩu."""
+  requester, receiver = aliased(User), aliased(User)
   result = await db.execute(
-    select(Friendship)
+    select(
+      Friendship.id,
+      Friendship.requester_id,
+      Friendship.receiver_id,
+      Friendship.status,
+      Friendship.created_at,
+      Friendship.updated_at,
+      *[getattr(requester, field).label(f"requester_{field}") for field in PUBLIC_USER_FIELDS],
+      *[getattr(receiver, field).label(f"receiver_{field}") for field in PUBLIC_USER_FIELDS]
+    )
+    .join(requester, requester.id == Friendship.requester_id)
+    .join(receiver, receiver.id == Friendship.receiver_id)
     .where(
       or_(
-        Friendship.requester_id == current_user.id,
-        Friendship.receiver_id == current_user.id
+        Friendship.requester_id == current_user_id,
+        Friendship.receiver_id == current_user_id
       )
     )
-    .options(
-      selectinload(Friendship.requester),
-      selectinload(Friendship.receiver)
+  )
+  return [
+    {
+      "id": row["id"],
+      "requester_id": row["requester_id"],
+      "receiver_id": row["receiver_id"],
+      "status": row["status"],
+      "created_at": row["created_at"],
+      "updated_at": row["updated_at"],
+      "requester": {field: row[f"requester_{field}"] for field in PUBLIC_USER_FIELDS},
+      "receiver": {field: row[f"receiver_{field}"] for field in PUBLIC_USER_FIELDS}
+    }
+    for row in result.mappings().all()
+  ]
+
+
+@friend_router.get("/friends")
+async def get_friends(
+  status: str = Query("accepted", pattern="^(accepted|incoming|outgoing)$"),
+  cursor: Optional[str] = None,
+  limit: int = Query(50, ge=1, le=200),
+  db: AsyncSession = Depends(get_db),
+  current_user_id: str = Depends(get_current_user_id)
+):
+  """status: accepted (bạn bè), incoming (lời mời nhận được), outgoing (lời mời đã gửi).
+  Chỉ trả về thông tin công khai của người còn lại, mới cập nhật trước.
+  params: cursor là next_cursor của trang trước"""
+  try:
+    position = decode_cursor(cursor) if cursor else None
+  except ValueError:
+    raise HTTPException(status_code=400, detail="Invalid cursor")
+
+  # Mỗi nhánh dùng đúng một index (requester_id, status, ...) hoặc (receiver_id, status, ...)
+  if status == "incoming":
+    condition = and_(Friendship.receiver_id == current_user_id, Friendship.status == "PENDING")
+  elif status == "outgoing":
+    condition = and_(Friendship.requester_id == current_user_id, Friendship.status == "PENDING")
+  else:
+    condition = or_(
+      and_(Friendship.requester_id == current_user_id, Friendship.status == "ACCEPTED"),
+      and_(Friendship.receiver_id == current_user_id, Friendship.status == "ACCEPTED")
+    )
+
+  other_id = case((Friendship.requester_id == current_user_id, Friendship.receiver_id), else_=Friendship.requester_id)
+  stmt = (
+    select(
+      Friendship.id,
+      Friendship.status,
+      Friendship.created_at,
+      Friendship.updated_at,
+      User.id.label("user_id"),
+      User.username,
+      User.email,
+      User.avatar_url
     )
+    .join(User, User.id == other_id)
+    .where(condition)
+    .order_by(Friendship.updated_at.desc(), Friendship.id.desc())
+    .limit(limit + 1)
   )
-  friend_list = result.scalars().all()
-  return friend_list
+  if position:
+    stmt = stmt.where(tuple_(Friendship.updated_at, Friendship.id) < tuple_(*position))
+
+  result = await db.execute(stmt)
+  rows = result.all()
+  has_more = len(rows) > limit
+  rows = rows[:limit]
+
+  friends = [
+    {
+      "friendship_id": row.id,
+      "status": row.status,
+      "created_at": row.created_at,
+      "updated_at": row.updated_at,
+      "user": {
+        "id": row.user_id,
+        "username": row.username,
+        "email": row.email,
+        "avatar_url": row.avatar_url
+      }
+    }
+    for row in rows
+  ]
+
+  return {
+    "friends": friends,
+    "next_cursor": encode_cursor(rows[-1].updated_at, rows[-1].id) if has_more else None,
+    "has_more": has_more
+  }
+
+
+@friend_router.get("/mutual/{user_id}")
+async def get_mutual_friends(
+  user_id: str,
+  limit: int = Query(20, ge=0, le=200),
+  current_user_id: str = Depends(get_current_user_id)
+):
+  """Số bạn chung với user_id và thông tin công khai của tối đa limit người trong số đó"""
+  mutual_ids = await friend_graph.mutual_friends(current_user_id, user_id)
+  shown_ids = mutual_ids[:limit]
+  profiles = await profile_loader.load_many(shown_ids)
+  return {
+    "count": len(mutual_ids),
+    "users": ordered_profiles(shown_ids, profiles)
+  }
+
+
+@friend_router.get("/suggestions")
+async def get_friend_suggestions(
+  limit: int = Query(20, ge=1, le=100),
+  db: AsyncSession = Depends(get_db),
+  current_user_id: str = Depends(get_current_user_id)
+):
+  """Bạn của bạn, xếp theo số bạn chung; bỏ qua những người đang có lời mời kết bạn với user hiện tại"""
+  result = await db.execute(
+    select(
+      case((Friendship.requester_id == current_user_id, Friendship.receiver_id), else_=Friendship.requester_id)
+    )
+    .where(
+      or_(
+        and_(Friendship.requester_id == current_user_id, Friendship.status == "PENDING"),
+        and_(Friendship.receiver_id == current_user_id, Friendship.status == "PENDING")
+      )
+    )
+  )
+  pending_ids = result.scalars().all()
+
+  suggestions = await friend_graph.suggestions(current_user_id, limit, exclude=pending_ids)
+  profiles = await profile_loader.load_many(user_id for user_id, _ in suggestions)
+  return [
+    {"user": profiles[user_id], "mutual_count": mutual_count}
+    for user_id, mutual_count in suggestions if user_id in profiles
+  ]
 
 
 @friend_router.post("/request")
 async def send_friend_request(
   payload: FriendRequestSchema, 
   db: AsyncSession = Depends(get_db), 
-  current_user: User = Depends(get_current_user)
+  current_user_id: str = Depends(get_current_user_id)
 ):
-  result = await db.execute(
-    select(Friendship).where(
-      or_(
-        and_(
-          Friendship.requester_id == current_user.id,
-          Friendship.receiver_id == payload.receiver_id
-        ),
-        and_(
-          Friendship.requester_id == payload.receiver_id,
-          Friendship.receiver_id == current_user.id
-        )
+  """Idempotent: gửi lại (kể cả bấm hai lần đồng thời) trả về Friendship đã có của cặp user.
+  Friendship, conversation và participants được ghi trong cùng một transaction."""
+  if payload.receiver_id == current_user_id:
+    raise HTTPException(status_code=400, detail="Cannot send a friend request to yourself")
+
+  now = get_vietnam_now()
+  # Chỉ chèn khi receiver tồn tại; unique index trên cặp (least, greatest) chặn bản trùng
+  inserted = (
+    insert(Friendship)
+    .from_select(
+      ["id", "requester_id", "receiver_id", "status", "created_at", "updated_at"],
+      select(
+        cast(func.gen_random_uuid(), String),
+        literal(current_user_id, String),
+        User.id,
+        cast(literal("PENDING"), Friendship.__table__.c.status.type),
+        literal(now, DateTime),
+        literal(now, DateTime)
       )
+      .where(User.id == payload.receiver_id)
     )
+    .on_conflict_do_nothing(
+      index_elements=[
+        func.least(Friendship.requester_id, Friendship.receiver_id),
+        func.greatest(Friendship.requester_id, Friendship.receiver_id)
+      ]
+    )
+    .returning(*Friendship.__table__.c)
+    .cte("inserted")
   )
-  
-  existing = result.scalars().first()
-  if existing:
-    return HTTPException(status_code=400, detail="Request existed!")
-
-  new_request = Friendship(
-    requester_id=current_user.id,
-    receiver_id=payload.receiver_id,
-    status="PENDING"
-  )
-  db.add(new_request)
-  await db.commit()
-  
-  result = await db.execute(select(User).where(User.id == payload.receiver_id))
-  receiver_user = result.scalars().first()
-  if not receiver_user:
-    raise HTTPException(status_code=404, detail="Receiver not found")
-  conversation_name = f"{receiver_user.username}"
-  
-  new_conversation = Conversation(
-    name=conversation_name,
-    type="private",
-    avatar_url="",
-    created_by=current_user.id
+  result = await db.execute(
+    select(inserted, User.username).join(User, User.id == inserted.c.receiver_id)
   )
-  db.add(new_conversation)
-  await db.commit()
-  await db.refresh(new_conversation)
-  
-  participants = [
-    ConversationParticipant(conversation_id=new_conversation.id, user_id=current_user.id),
-    ConversationParticipant(conversation_id=new_conversation.id, user_id=payload.receiver_id)
-  ]
-  db.add_all(participants)
+  row = result.first()
+
+  if row is None:
+    # Không chèn được: cặp user đã có Friendship, hoặc receiver không tồn tại
+    result = await db.execute(
+      select(Friendship).where(
+        func.least(Friendship.requester_id, Friendship.receiver_id) == min(current_user_id, payload.receiver_id),
+        func.greatest(Friendship.requester_id, Friendship.receiver_id) == max(current_user_id, payload.receiver_id)
+      )
+    )
+    existing = result.scalars().first()
+    if existing is None:
+      raise HTTPException(status_code=404, detail="Receiver not found")
+    return existing
+
+  conversation_id, _ = await get_or_create_private_conversation(db, current_user_id, payload.receiver_id, row.username)
   await db.commit()
-  
+  await manager.publish_membership(conversation_id, added=[current_user_id, payload.receiver_id])
+
+  new_request = dict(row._mapping)
+  new_request.pop("username")
   return new_request
 
 
@@ -97,7 +253,7 @@ async def send_friend_request(
 async def accept_friend_request(
   friendship_id: str,
   db: AsyncSession = Depends(get_db),
-  current_user: User = Depends(get_current_user)
+  current_user_id: str = Depends(get_current_user_id)
 ):
   result = await db.execute(
     select(Friendship).where(Friendship.id == friendship_id)
@@ -111,6 +267,7 @@ async def accept_friend_request(
   friendship.updated_at = datetime.utcnow()
 
   await db.commit()
+  friend_graph.add_edge(friendship.requester_id, friendship.receiver_id)
   await db.refresh(friendship)
 
   return {"message": "Đã chấp nhận lời mời kết bạn"}
@@ -120,7 +277,7 @@ async def accept_friend_request(
 async def cancel_or_remove_friend(
   friendship_id: str,
   db: AsyncSession = Depends(get_db),
-  current_user: User = Depends(get_current_user)
+  current_user_id: str = Depends(get_current_user_id)
 ):
   # Tìm Friendship
   result = await db.execute(
@@ -135,37 +292,20 @@ async def cancel_or_remove_friend(
   user1_id = friendship.requester_id
   user2_id = friendship.receiver_id
 
-  # Tìm Conversation liên quan
-  conversation_result = await db.execute(
-    select(Conversation)
-    .join(ConversationParticipant, Conversation.id == ConversationParticipant.conversation_id)
-    .where(
-      Conversation.type == "private",
-      ConversationParticipant.user_id.in_([user1_id, user2_id])
-    )
-    .group_by(Conversation.id)
-    .having(
-      func.count(ConversationParticipant.user_id) == 2
-    )
-  )
-  conversation = conversation_result.scalars().first()
+  # Tìm Conversation liên quan qua khoá cặp user
+  conversation_id = await find_private_conversation_id(db, user1_id, user2_id)
 
-  # Xóa Conversation và ConversationParticipant nếu tìm thấy
-  if conversation:
-    await db.execute(
-      delete(ConversationParticipant).where(
-        ConversationParticipant.conversation_id == conversation.id
-      )
-    )
-    await db.execute(
-      delete(Conversation).where(
-        Conversation.id == conversation.id
-      )
-    )
+  # Gỡ participants ngay, tin nhắn và Conversation được xoá dần ở nền
+  removed_user_ids = await detach_participants(db, conversation_id) if conversation_id else []
 
   # Xóa Friendship
   await db.delete(friendship)
   await db.commit()
+  friend_graph.remove_edge(user1_id, user2_id)
+  if conversation_id:
+    await invalidate_conversation(conversation_id)
+    await manager.publish_membership(conversation_id, removed=removed_user_ids)
+    purge_queue.purge_conversation(conversation_id)
 
   message = "Đã từ chối lời mời kết bạn" if friendship.status == "PENDING" else "Đã hủy kết bạn"
   return {"message": message}
\ No newline at end of file
@@ -0,0 +1,194 @@
+import asyncio
+import heapq
+import os
+import time
+from array import array
+from collections import Counter
+from typing import Dict, List, Tuple
+from sqlalchemy.future import select
+from database import AsyncSessionLocal
+from models.models import Friendship
+
+# Đồ thị được nạp lại sau ngần ấy giây để bắt kịp thay đổi từ worker khác
+FRIEND_GRAPH_TTL = float(os.getenv("FRIEND_GRAPH_TTL", "300"))
+# Số dòng friendships đọc mỗi lần khi nạp đồ thị
+FRIEND_GRAPH_LOAD_BATCH = 10000
+
+
+class FriendGraph:
+  """Đồ thị bạn bè (chỉ các cạnh ACCEPTED) trong bộ nhớ.
+
+  user_id (uuid) được ánh xạ sang số nguyên liên tiếp, danh sách kề của mỗi đỉnh là
+  một array('i') nên 1M cạnh chỉ tốn khoảng 8 MB cho danh sách kề.
+  Nạp lười ở truy vấn đầu tiên; accept / remove / xoá user cập nhật trực tiếp,
+  thay đổi xảy ra trong lúc đang nạp được ghi lại và áp dụng sau khi nạp xong.
+  Khi quá FRIEND_GRAPH_TTL, đồ thị được nạp lại ở nền: truy vấn vẫn dùng đồ thị hiện tại
+  cho tới khi đồ thị mới được thay vào (trong lúc nạp, bộ nhớ tạm thời gấp đôi).
+  """
+
+  def __init__(self):
+    self.index: Dict[str, int] = {}
+    self.user_ids: List[str] = []
+    self.adjacency: List[array] = []
+    self.loaded_at = None
+    self.lock = asyncio.Lock()
+    self.pending_ops: List[Tuple[str, str, str]] = None
+    self.edges = 0
+    self.build_seconds = 0.0
+    self.refresh_task = None
+    self.refresh_failures = 0
+
+  def _node(self, user_id: str) -> int:
+    node = self.index.get(user_id)
+    if node is None:
+      node = self.index[user_id] = len(self.user_ids)
+      self.user_ids.append(user_id)
+      self.adjacency.append(array("i"))
+    return node
+
+  async def ensure_loaded(self):
+    if self.loaded_at is None:
+      # Chưa có đồ thị nào để trả lời: lần nạp đầu tiên phải chờ
+      async with self.lock:
+        if self.loaded_at is None:
+          await self._build()
+      return
+    if time.monotonic() - self.loaded_at >= FRIEND_GRAPH_TTL and self.refresh_task is None:
+      self.refresh_task = asyncio.create_task(self._refresh())
+
+  async def _refresh(self):
+    try:
+      async with self.lock:
+        await self._build()
+    except Exception as e:
+      self.refresh_failures += 1
+      print("Lỗi nạp lại đồ thị bạn bè:", str(e))
+    finally:
+      self.refresh_task = None
+
+  async def _build(self):
+    started = time.perf_counter()
+    self.pending_ops = []
+    index, user_ids, adjacency = {}, [], []
+    edges = 0
+
+    def node(user_id):
+      value = index.get(user_id)
+      if value is None:
+        value = index[user_id] = len(user_ids)
+        user_ids.append(user_id)
+        adjacency.append(array("i"))
+      return value
+
+    try:
+      async with AsyncSessionLocal() as db:
+        result = await db.stream(
+          select(Friendship.requester_id, Friendship.receiver_id)
+          .where(Friendship.status == "ACCEPTED")
+          .execution_options(yield_per=FRIEND_GRAPH_LOAD_BATCH)
+        )
+        async for partition in result.partitions():
+          for requester_id, receiver_id in partition:
+            a, b = node(requester_id), node(receiver_id)
+            adjacency[a].append(b)
+            adjacency[b].append(a)
+            edges += 1
+    except Exception:
+      self.pending_ops = None
+      raise
+
+    self.index, self.user_ids, self.adjacency = index, user_ids, adjacency
+    self.edges = edges
+    ops, self.pending_ops = self.pending_ops, None
+    for op, user_id, other_user_id in ops:
+      if op == "add":
+        self.add_edge(user_id, other_user_id)
+      elif op == "remove":
+        self.remove_edge(user_id, other_user_id)
+      else:
+        self.remove_user(user_id)
+    self.loaded_at = time.monotonic()
+    self.build_seconds = time.perf_counter() - started
+
+  def add_edge(self, user_id: str, other_user_id: str):
+    if self.pending_ops is not None:
+      self.pending_ops.append(("add", user_id, other_user_id))
+    if self.loaded_at is None:
+      return
+    a, b = self._node(user_id), self._node(other_user_id)
+    if b not in self.adjacency[a]:
+      self.adjacency[a].append(b)
+      self.adjacency[b].append(a)
+      self.edges += 1
+
+  def remove_edge(self, user_id: str, other_user_id: str):
+    if self.pending_ops is not None:
+      self.pending_ops.append(("remove", user_id, other_user_id))
+    a, b = self.index.get(user_id), self.index.get(other_user_id)
+    if self.loaded_at is None or a is None or b is None or b not in self.adjacency[a]:
+      return
+    self.adjacency[a].remove(b)
+    self.adjacency[b].remove(a)
+    self.edges -= 1
+
+  def remove_user(self, user_id: str):
+    if self.pending_ops is not None:
+      self.pending_ops.append(("remove_user", user_id, None))
+    a = self.index.get(user_id)
+    if self.loaded_at is None or a is None:
+      return
+    for b in self.adjacency[a]:
+      self.adjacency[b].remove(a)
+    self.edges -= len(self.adjacency[a])
+    self.adjacency[a] = array("i")
+
+  async def friends(self, user_id: str) -> List[str]:
+    await self.ensure_loaded()
+    node = self.index.get(user_id)
+    if node is None:
+      return []
+    return [self.user_ids[other] for other in self.adjacency[node]]
+
+  async def mutual_friends(self, user_id: str, other_user_id: str) -> List[str]:
+    await self.ensure_loaded()
+    a, b = self.index.get(user_id), self.index.get(other_user_id)
+    if a is None or b is None:
+      return []
+    # Duyệt danh sách kề nhỏ hơn, tra trong tập của danh sách lớn hơn
+    small, large = sorted((self.adjacency[a], self.adjacency[b]), key=len)
+    large = set(large)
+    return [self.user_ids[node] for node in small if node in large]
+
+  async def suggestions(self, user_id: str, limit: int = 20, exclude=()) -> List[Tuple[str, int]]:
+    """Bạn của bạn chưa kết bạn với user_id, xếp theo số bạn chung giảm dần.
+    Trả về [(user_id, số bạn chung)]."""
+    await self.ensure_loaded()
+    node = self.index.get(user_id)
+    if node is None:
+      return []
+    friends = self.adjacency[node]
+    skip = set(friends)
+    skip.add(node)
+    skip.update(self.index[other] for other in exclude if other in self.index)
+
+    overlap = Counter()
+    for friend in friends:
+      overlap.update(self.adjacency[friend])
+    for other in skip:
+      overlap.pop(other, None)
+    top = heapq.nlargest(limit, overlap.items(), key=lambda item: (item[1], -item[0]))
+    return [(self.user_ids[other], count) for other, count in top]
+
+  def stats(self) -> dict:
+    return {
+      "loaded": self.loaded_at is not None,
+      "nodes": len(self.user_ids),
+      "edges": self.edges,
+      "build_ms": self.build_seconds * 1000,
+      "refreshing": self.refresh_task is not None,
+      "refresh_failures": self.refresh_failures,
+      "adjacency_bytes": sum(adjacency.buffer_info()[1] * adjacency.itemsize for adjacency in self.adjacency)
+    }
+
+
+friend_graph = FriendGraph()
@@ -1,10 +1,121 @@
 import asyncio
+from sqlalchemy import text
 from database import engine
 from models.models import Base
 
+# create_all chỉ tạo bảng/index còn thiếu cho bảng mới,
+# các thay đổi trên bảng đã tồn tại được áp dụng ở đây (phải idempotent)
+MIGRATIONS = [
+    "CREATE INDEX IF NOT EXISTS ix_messages_conversation_created_id ON messages (conversation_id, created_at, id)",
+    # Số thứ tự sự kiện theo conversation: đánh số lại lịch sử cũ theo thời gian gửi
+    "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS last_seq BIGINT NOT NULL DEFAULT 0",
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS seq BIGINT",
+    """
+    UPDATE messages m SET seq = n.seq
+    FROM (
+        SELECT id, row_number() OVER (PARTITION BY conversation_id ORDER BY created_at, id) AS seq
+        FROM messages
+    ) n
+    WHERE m.id = n.id AND m.seq IS NULL
+    """,
+    """
+    UPDATE conversations c SET last_seq = s.max_seq
+    FROM (SELECT conversation_id, max(seq) AS max_seq FROM messages GROUP BY conversation_id) s
+    WHERE c.id = s.conversation_id AND c.last_seq < s.max_seq
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_messages_conversation_seq ON messages (conversation_id, seq)",
+    # Con trỏ đã đọc: lịch sử có trước khi thêm cột được coi là đã đọc
+    "ALTER TABLE conversation_participants ADD COLUMN IF NOT EXISTS last_read_seq BIGINT",
+    """
+    UPDATE conversation_participants p SET last_read_seq = c.last_seq
+    FROM conversations c
+    WHERE c.id = p.conversation_id AND p.last_read_seq IS NULL
+    """,
+    "ALTER TABLE conversation_participants ALTER COLUMN last_read_seq SET DEFAULT 0",
+    "ALTER TABLE conversation_participants ALTER COLUMN last_read_seq SET NOT NULL",
+    "CREATE INDEX IF NOT EXISTS ix_conversation_participants_user_id ON conversation_participants (user_id)",
+    # Mỗi user chỉ xuất hiện một lần trong một conversation: xoá bản ghi trùng rồi thêm ràng buộc
+    """
+    DELETE FROM conversation_participants a
+    USING conversation_participants b
+    WHERE a.conversation_id = b.conversation_id AND a.user_id = b.user_id AND a.id > b.id
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_conversation_participants_conversation_user ON conversation_participants (conversation_id, user_id)",
+    # Khoá cặp user của conversation private; nếu có nhiều conversation cho cùng cặp thì chỉ
+    # conversation có id nhỏ nhất nhận khoá
+    "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS pair_key VARCHAR(73)",
+    """
+    UPDATE conversations c SET pair_key = p.pair_key
+    FROM (
+        SELECT DISTINCT ON (pair_key) conversation_id, pair_key
+        FROM (
+            SELECT cp.conversation_id, min(cp.user_id) || ':' || max(cp.user_id) AS pair_key
+            FROM conversation_participants cp
+            JOIN conversations pc ON pc.id = cp.conversation_id AND pc.type = 'private'
+            GROUP BY cp.conversation_id
+            HAVING count(*) = 2
+        ) pairs
+        ORDER BY pair_key, conversation_id
+    ) p
+    WHERE c.id = p.conversation_id
+      AND c.pair_key IS NULL
+      AND NOT EXISTS (SELECT 1 FROM conversations d WHERE d.pair_key = p.pair_key)
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS conversations_pair_key_key ON conversations (pair_key)",
+    # Để Postgres tự xoá dòng con thay vì ORM nạp hết vào bộ nhớ
+    *[
+        f"""
+        ALTER TABLE {table}
+            DROP CONSTRAINT IF EXISTS {table}_{column}_fkey,
+            ADD CONSTRAINT {table}_{column}_fkey FOREIGN KEY ({column}) REFERENCES {parent}(id) ON DELETE CASCADE
+        """
+        for table, column, parent in [
+            ("friendships", "requester_id", "users"),
+            ("friendships", "receiver_id", "users"),
+            ("messages", "conversation_id", "conversations"),
+            ("messages", "sender_id", "users"),
+            ("conversation_participants", "conversation_id", "conversations"),
+            ("conversation_participants", "user_id", "users"),
+            ("deleted_messages", "conversation_id", "conversations"),
+        ]
+    ],
+    # Tìm user theo username / email không phân biệt hoa thường (LIKE 'q%' và '%q%')
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm ON users USING gin (lower(username) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_email_trgm ON users USING gin (lower(email) gin_trgm_ops)",
+    # Sắp xếp / phân trang kết quả tìm kiếm theo lower(username), id
+    "CREATE INDEX IF NOT EXISTS ix_users_username_lower_id ON users (lower(username), id)",
+    "CREATE INDEX IF NOT EXISTS ix_friendships_requester_status ON friendships (requester_id, status, updated_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_friendships_receiver_status ON friendships (receiver_id, status, updated_at, id)",
+    # Một Friendship cho mỗi cặp user không phân biệt chiều: giữ bản ACCEPTED, nếu không thì bản có id nhỏ nhất
+    """
+    DELETE FROM friendships a
+    USING friendships b
+    WHERE least(a.requester_id, a.receiver_id) = least(b.requester_id, b.receiver_id)
+      AND greatest(a.requester_id, a.receiver_id) = greatest(b.requester_id, b.receiver_id)
+      AND a.id <> b.id
+      AND (
+        (b.status = 'ACCEPTED' AND a.status <> 'ACCEPTED')
+        OR (b.status = a.status AND b.id < a.id)
+      )
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_friendships_pair ON friendships (least(requester_id, receiver_id), greatest(requester_id, receiver_id))",
+    # Xoá user không bị chặn bởi các conversation họ đã tạo
+    "ALTER TABLE conversations ALTER COLUMN created_by DROP NOT NULL",
+    """
+    ALTER TABLE conversations
+        DROP CONSTRAINT IF EXISTS conversations_created_by_fkey,
+        ADD CONSTRAINT conversations_created_by_fkey FOREIGN KEY (created_by) REFERENCES users(id) ON DELETE SET NULL
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_messages_sender_id ON messages (sender_id)",
+    "CREATE INDEX IF NOT EXISTS ix_messages_file_url ON messages (file_url)",
+]
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        for statement in MIGRATIONS:
+            await conn.execute(text(statement))
 
 if __name__ == "__main__":
     asyncio.run(init_db())
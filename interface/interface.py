@@ -3,7 +3,7 @@ from sqlalchemy.future import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 from typing import Optional, List
-from enum_data.enum_data import ConversationType
+from enum_data.enum_data import ConversationType, MessageType
 
 
 ## USER INTERFACE
@@ -27,6 +27,41 @@ class ILoginUserData(BaseModel):
   password: Optional[str] = None
 
 
+## MESSAGE INTERFACE
+class INewMessageData(BaseModel):
+  conversation_id: str
+  sender_id: str
+  content: Optional[str] = None
+  type: MessageType = MessageType.TEXT
+  file_url: Optional[str] = None
+
+
+## BUCKET INTERFACE
+class IPresignUploadData(BaseModel):
+  filename: str
+  size: int
+  content_type: Optional[str] = None
+
+class IUploadedPartData(BaseModel):
+  part_number: int
+  etag: str
+
+class ICompleteMultipartUploadData(BaseModel):
+  key: str
+  upload_id: str
+  parts: List[IUploadedPartData]
+
+class IAbortMultipartUploadData(BaseModel):
+  key: str
+  upload_id: str
+
+class IUploadCompleteData(BaseModel):
+  key: str
+  conversation_id: str
+  content: Optional[str] = None
+  type: MessageType = MessageType.FILE
+
+
 ## CONVERSATION INTERFACE
 class INewConversationData(BaseModel):
   name: Optional[str] = None
@@ -52,6 +87,10 @@ class IUpdateConversationParticipantData(BaseModel):
   
 class IRemoveParticipantData(BaseModel):
   participant: str
+
+class IReadConversationData(BaseModel):
+  email: str
+  seq: int
   
 class FriendRequestCreate(BaseModel):
   receiver_id: str
\ No newline at end of file
@@ -7,6 +7,16 @@ from bucket.bucket_controller import s3_router
 from sns.sns_controller import sns_router
 from friend.friend_controller import friend_router
 from call.call_controller import call_router
+from message.connection_manager import manager
+from message.write_pipeline import write_pipeline, WRITE_BEHIND_ENABLED
+from bucket.s3_cleanup import s3_cleanup_queue
+from conversation.conversation_controller import conversation_cache
+from conversation.membership import membership_index
+from conversation.purge import purge_queue
+from user.user_controller import principal_stats, restore_deleted_users
+from user.password_hasher import password_hasher
+from user.profile_loader import profile_loader
+from friend.friend_graph import friend_graph
 
 app = FastAPI(
     title="OTT BACKEND",
@@ -25,10 +35,41 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def startup():
+    await manager.start()
+    await s3_cleanup_queue.start()
+    await purge_queue.start()
+    await restore_deleted_users()
+    if WRITE_BEHIND_ENABLED:
+        await write_pipeline.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await write_pipeline.stop()
+    await manager.stop()
+    await purge_queue.stop()
+    await s3_cleanup_queue.stop()
+    password_hasher.shutdown()
+
 @app.get("/health")
 async def read_root():
     return {"message": "BACKEND RUNNING"}
 
+@app.get("/metrics")
+async def read_metrics():
+    return {
+        "websocket": manager.stats(),
+        "s3_cleanup": s3_cleanup_queue.stats(),
+        "conversation_cache": conversation_cache.stats(),
+        "membership_index": membership_index.stats(),
+        "purge": purge_queue.stats(),
+        "principal_cache": principal_stats(),
+        "password_hasher": password_hasher.stats(),
+        "profile_loader": profile_loader.stats(),
+        "friend_graph": friend_graph.stats()
+    }
+
 app.include_router(
     router=user_router,
     prefix="/user",
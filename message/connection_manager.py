@@ -0,0 +1,264 @@
+import asyncio
+import datetime
+import json
+import os
+from fastapi import WebSocket
+from typing import Callable, Dict, Set
+from message.pubsub import create_pubsub
+from conversation.membership import membership_index
+
+try:
+    import orjson
+except ImportError:  # orjson là tuỳ chọn, chỉ để encode nhanh hơn
+    orjson = None
+
+# Số frame tối đa chờ gửi cho mỗi client trước khi bị coi là chậm và bị ngắt
+OUTBOUND_QUEUE_SIZE = int(os.getenv("WS_OUTBOUND_QUEUE_SIZE", "256"))
+# Mã đóng 1013 (Try Again Later): client cần kết nối lại và đồng bộ lại lịch sử
+RESYNC_CLOSE_CODE = 1013
+# "conversation_id" dành riêng cho thông báo thay đổi participants giữa các worker
+MEMBERSHIP_CHANNEL = "#membership"
+
+
+def _encode_default(value):
+    # datetime luôn ra ISO 8601 ("2026-10-18T07:00:00.123456") như response REST của FastAPI,
+    # dù có orjson hay không
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_frame(message: dict) -> str:
+    """Encode một sự kiện thành text frame, dùng chung cho mọi người nhận."""
+    if orjson is not None:
+        return orjson.dumps(message, default=_encode_default, option=orjson.OPT_PASSTHROUGH_DATETIME).decode()
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":"), default=_encode_default)
+
+
+class ClientConnection:
+    """Một WebSocket kèm hàng đợi gửi có giới hạn, được xả bởi task ghi riêng."""
+
+    def __init__(self, websocket: WebSocket, user_id: str = None):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.conversations: Set[str] = set()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        self.closed = False
+        self.writer_task = asyncio.create_task(self._writer())
+
+    async def _writer(self):
+        try:
+            while True:
+                frame = await self.queue.get()
+                await self.websocket.send_text(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Lỗi của một client không ảnh hưởng tới các client khác
+            print("Lỗi gửi WebSocket:", str(e))
+            self.closed = True
+
+    def enqueue(self, frame: str) -> bool:
+        """Không bao giờ chờ; trả về False nếu client đã đóng hoặc hàng đợi đầy."""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def close(self, code: int = None, reason: str = ""):
+        self.closed = True
+        self.writer_task.cancel()
+        if code is None:
+            return
+        try:
+            await asyncio.wait_for(self.websocket.send_json({"action": "resync", "reason": reason}), timeout=1)
+            await asyncio.wait_for(self.websocket.close(code=code, reason=reason), timeout=1)
+        except Exception:
+            pass
+
+
+class ConnectionManager:
+    def __init__(self, pubsub):
+        # Kết nối theo conversation_id (chỉ của tiến trình này)
+        self.active_connections: Dict[str, Set[ClientConnection]] = {}
+        self.connections: Dict[WebSocket, ClientConnection] = {}
+        # Chỉ mục theo user cho các socket gộp (/ws/user)
+        self.user_connections: Dict[str, Set[ClientConnection]] = {}
+        self.pubsub = pubsub
+        self.evictions = 0
+        self.publish_failures = 0
+        # Kênh điều khiển khác (bắt đầu bằng "#") -> hàm xử lý payload ở mọi worker
+        self.control_handlers: Dict[str, Callable[[dict], None]] = {}
+        self._tasks = set()
+
+    async def start(self):
+        await self.pubsub.start(self.deliver, self.resync_all)
+
+    async def stop(self):
+        await self.pubsub.stop()
+
+    async def connect(self, websocket: WebSocket, conversation_id: str) -> ClientConnection:
+        await websocket.accept()
+        connection = ClientConnection(websocket)
+        self.connections[websocket] = connection
+        self.subscribe(connection, conversation_id)
+        return connection
+
+    async def connect_user(self, websocket: WebSocket, user_id: str, conversation_ids) -> ClientConnection:
+        """Một socket cho cả hộp thư của user, đăng ký sẵn mọi conversation của user."""
+        await websocket.accept()
+        connection = ClientConnection(websocket, user_id)
+        self.connections[websocket] = connection
+        self.user_connections.setdefault(user_id, set()).add(connection)
+        for conversation_id in conversation_ids:
+            self.subscribe(connection, conversation_id)
+        return connection
+
+    async def publish_membership(self, conversation_id: str, added=(), removed=()):
+        """Gọi sau khi commit thay đổi participants. Áp dụng ngay ở worker này rồi publish để
+        mọi worker khác cũng đăng ký / huỷ đăng ký các socket /ws/user của user liên quan
+        và làm mới membership_index."""
+        change = {"conversation_id": conversation_id, "added": list(added), "removed": list(removed)}
+        if not change["added"] and not change["removed"]:
+            return
+        self._apply_membership(change)
+        try:
+            await self.pubsub.publish(MEMBERSHIP_CHANNEL, encode_frame(change))
+        except Exception as e:
+            self.publish_failures += 1
+            print("Lỗi publish thay đổi participants:", str(e))
+
+    def add_control_handler(self, channel: str, handler: Callable[[dict], None]):
+        self.control_handlers[channel] = handler
+
+    async def publish_control(self, channel: str, payload: dict):
+        """Chạy handler của channel ở worker này rồi publish để mọi worker khác cũng chạy."""
+        self.control_handlers[channel](payload)
+        try:
+            await self.pubsub.publish(channel, encode_frame(payload))
+        except Exception as e:
+            self.publish_failures += 1
+            print(f"Lỗi publish {channel}:", str(e))
+
+    def _apply_membership(self, change: dict):
+        # Lặp lại được: worker gửi cũng nhận lại chính thông báo của nó
+        conversation_id = change["conversation_id"]
+        membership_index.invalidate(conversation_id)
+        for user_id in change["added"]:
+            self.subscribe_user(user_id, conversation_id)
+        for user_id in change["removed"]:
+            self.unsubscribe_user(user_id, conversation_id)
+
+    def subscribe_user(self, user_id: str, conversation_id: str):
+        # Các socket đang mở của user nhận luôn sự kiện của conversation
+        frame = encode_frame({"action": "subscribed", "conversation_id": conversation_id})
+        for connection in self.user_connections.get(user_id, ()):
+            if conversation_id not in connection.conversations:
+                self.subscribe(connection, conversation_id)
+                connection.enqueue(frame)
+
+    def unsubscribe_user(self, user_id: str, conversation_id: str):
+        frame = encode_frame({"action": "unsubscribed", "conversation_id": conversation_id})
+        for connection in list(self.user_connections.get(user_id, ())):
+            if conversation_id in connection.conversations:
+                self.unsubscribe(connection, conversation_id)
+                connection.enqueue(frame)
+
+    def subscribe(self, connection: ClientConnection, conversation_id: str):
+        # Khởi tạo tập kết nối cho conversation_id nếu chưa tồn tại
+        self.active_connections.setdefault(conversation_id, set()).add(connection)
+        connection.conversations.add(conversation_id)
+
+    def unsubscribe(self, connection: ClientConnection, conversation_id: str):
+        connections = self.active_connections.get(conversation_id)
+        if connections is not None:
+            connections.discard(connection)
+            # Dọn dẹp cuộc trò chuyện không còn kết nối
+            if not connections:
+                del self.active_connections[conversation_id]
+        connection.conversations.discard(conversation_id)
+
+    def _remove(self, connection: ClientConnection):
+        for conversation_id in list(connection.conversations):
+            self.unsubscribe(connection, conversation_id)
+        self.connections.pop(connection.websocket, None)
+        if connection.user_id is not None:
+            connections = self.user_connections.get(connection.user_id)
+            if connections is not None:
+                connections.discard(connection)
+                if not connections:
+                    del self.user_connections[connection.user_id]
+
+    def disconnect(self, websocket: WebSocket):
+        connection = self.connections.get(websocket)
+        if connection is None:
+            return
+        self._remove(connection)
+        task = asyncio.create_task(connection.close())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def evict(self, connection: ClientConnection):
+        """Ngắt client không theo kịp, client phải kết nối lại và đồng bộ lại."""
+        self.evictions += 1
+        self._close_for_resync(connection, "slow consumer")
+
+    async def resync_all(self):
+        # pubsub vừa kết nối lại: sự kiện trong lúc mất kết nối đã bị lỡ,
+        # buộc mọi client kết nối lại và đồng bộ theo seq
+        for connection in list(self.connections.values()):
+            self._close_for_resync(connection, "resync")
+
+    def _close_for_resync(self, connection: ClientConnection, reason: str):
+        self._remove(connection)
+        task = asyncio.create_task(connection.close(RESYNC_CLOSE_CODE, reason))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def broadcast(self, message: dict, conversation_id: str):
+        # Encode đúng một lần rồi publish qua pubsub để mọi worker (kể cả worker này)
+        # cùng phát chính frame đó tới client của mình.
+        # Sự kiện đã được lưu trước khi broadcast: lỗi publish không làm hỏng request,
+        # client nhận lại qua đồng bộ theo seq.
+        try:
+            await self.pubsub.publish(conversation_id, encode_frame(message))
+        except Exception as e:
+            self.publish_failures += 1
+            print("Lỗi publish sự kiện:", str(e))
+
+    async def deliver(self, conversation_id: str, frame: str):
+        if conversation_id == MEMBERSHIP_CHANNEL:
+            self._apply_membership(json.loads(frame))
+            return
+        handler = self.control_handlers.get(conversation_id)
+        if handler is not None:
+            handler(json.loads(frame))
+            return
+        # Chỉ đưa vào hàng đợi của các client trong cuộc trò chuyện, không chờ socket nào
+        for connection in list(self.active_connections.get(conversation_id, ())):
+            if connection.enqueue(frame):
+                continue
+            if connection.closed:
+                # Socket đã lỗi khi gửi, chỉ dọn dẹp
+                self.disconnect(connection.websocket)
+            else:
+                self.evict(connection)
+
+    def stats(self) -> dict:
+        depths = [connection.queue.qsize() for connection in self.connections.values()]
+        return {
+            "connections": len(depths),
+            "conversations": len(self.active_connections),
+            "users": len(self.user_connections),
+            "queued_frames": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "queue_limit": OUTBOUND_QUEUE_SIZE,
+            "evictions": self.evictions,
+            "publish_failures": self.publish_failures,
+            "pubsub": self.pubsub.stats()
+        }
+
+manager = ConnectionManager(create_pubsub())
@@ -1,48 +1,79 @@
-from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect, HTTPException
-from models.models import Message, Conversation
+from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect, HTTPException, Query
+from models.models import Message
 from database import get_db
 from sqlalchemy.future import select
+from sqlalchemy import tuple_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from types import SimpleNamespace
-from typing import List, Dict
-from utils.utils import get_vn_time
-from urllib.parse import urlparse
-from bucket.bucket_controller import s3_client, S3_BUCKET_NAME
+from typing import Optional
+from utils.utils import encode_cursor, decode_cursor
+from message.connection_manager import manager, encode_frame, ClientConnection
+from message.write_pipeline import write_pipeline, WRITE_BEHIND_ENABLED
+from message.message_service import append_message, message_event, delete_message, delete_event, get_events_after
+from conversation.membership import get_user_conversation_ids, is_participant, membership_index
+from user.user_controller import decode_access_token
+from interface.interface import INewMessageData
+from bucket.s3 import attachment_allowed
 
 message_router = APIRouter()
 
-class ConnectionManager:
-    def __init__(self):
-        # Từ điển để lưu trữ kết nối theo conversation_id
-        self.active_connections: Dict[str, List[WebSocket]] = {}
-
-    async def connect(self, websocket: WebSocket, conversation_id: str):
-        await websocket.accept()
-        # Khởi tạo danh sách cho conversation_id nếu chưa tồn tại
-        if conversation_id not in self.active_connections:
-            self.active_connections[conversation_id] = []
-        self.active_connections[conversation_id].append(websocket)
-
-    def disconnect(self, websocket: WebSocket, conversation_id: str):
-        if conversation_id in self.active_connections:
-            self.active_connections[conversation_id].remove(websocket)
-            # Dọn dẹp danh sách cuộc trò chuyện trống
-            if not self.active_connections[conversation_id]:
-                del self.active_connections[conversation_id]
-
-    async def broadcast(self, message: dict, conversation_id: str):
-        # Chỉ phát tin nhắn đến các client trong cuộc trò chuyện được chỉ định
-        if conversation_id in self.active_connections:
-            for connection in self.active_connections[conversation_id]:
-                await connection.send_json(message)
-
-manager = ConnectionManager()
+# Số sự kiện tối đa trong một lần đồng bộ
+SYNC_PAGE_SIZE = 200
+
+async def handle_send(data: SimpleNamespace, sender_id: str):
+    values = {
+        "conversation_id": str(data.conversation_id),
+        "sender_id": sender_id,
+        "content": data.content,
+        "type": data.type,
+        "file_url": data.file_url
+    }
+    try:
+        # Kiểm tra thành viên trong bộ nhớ, không tốn thêm truy vấn cho mỗi frame
+        if not await membership_index.is_member(values["conversation_id"], sender_id):
+            print(f"Bỏ qua tin nhắn: {sender_id} không thuộc {values['conversation_id']}")
+            return
+        if not attachment_allowed(values["file_url"], sender_id):
+            print(f"Bỏ qua tin nhắn: {sender_id} đính kèm file không phải của mình")
+            return
+        if WRITE_BEHIND_ENABLED:
+            # Ghi theo lô, chỉ trả về khi lô đã commit
+            new_message = await write_pipeline.submit(values)
+        else:
+            new_message = await append_message(values)
+        # Chỉ phát tin nhắn đến các client trong cuộc trò chuyện này
+        await manager.broadcast(message_event(new_message), values["conversation_id"])
+    except Exception as e:
+        print("Lỗi cơ sở dữ liệu:", str(e))
+
+
+async def handle_delete(message_id: str, conversation_id: str):
+    try:
+        deleted = await delete_message(message_id, conversation_id)
+        if deleted:
+            # Chỉ phát thông báo xóa đến các client trong cuộc trò chuyện này
+            await manager.broadcast(delete_event(deleted), conversation_id)
+    except Exception as e:
+        print("Lỗi xóa:", str(e))
+
+
+async def handle_sync(connection: ClientConnection, conversation_id: str, after_seq: int):
+    # Chỉ trả các sự kiện client bị lỡ về đúng socket yêu cầu
+    try:
+        result = await get_events_after(conversation_id, int(after_seq), SYNC_PAGE_SIZE)
+        connection.enqueue(encode_frame({"action": "sync", **result}))
+    except Exception as e:
+        print("Lỗi đồng bộ:", str(e))
+
 
 @message_router.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket, conversation_id: str, db: AsyncSession = Depends(get_db)):
+async def websocket_endpoint(websocket: WebSocket, conversation_id: str):
+    # Không giữ session DB suốt vòng đời socket: mỗi action mở một session ngắn
+    # và trả kết nối về pool ngay sau khi commit, socket rảnh không chiếm pool.
     print(f"Nhận yêu cầu WebSocket cho conversation_id: {conversation_id}")
     # Kết nối WebSocket với conversation_id được chỉ định
-    await manager.connect(websocket, conversation_id)
+    connection = await manager.connect(websocket, conversation_id)
     try:
         while True:
             receive_message = await websocket.receive_json()
@@ -54,84 +85,83 @@ async def websocket_endpoint(websocket: WebSocket, conversation_id: str, db: Asy
                 # Xác minh rằng tin nhắn thuộc về cuộc trò chuyện đúng
                 if str(data.conversation_id) != conversation_id:
                     continue  # Bỏ qua tin nhắn của các cuộc trò chuyện khác
-
-                new_message = Message(
-                    conversation_id=data.conversation_id,
-                    sender_id=data.sender_id,
-                    content=data.content,
-                    type=data.type,
-                    file_url=data.file_url
-                )
-                
-                try:
-                    db.add(new_message)
-                    
-                    # Cập nhật conversation
-                    stmt = select(Conversation).where(Conversation.id == data.conversation_id)
-                    result = await db.execute(stmt)
-                    conversation = result.scalar_one_or_none()
-                    if conversation:
-                        conversation.updated_at = await get_vn_time()
-                        conversation.last_message_id = new_message.id  # Cập nhật last_message_id
-                        db.add(conversation)
-                    
-                    await db.commit()
-                    await db.refresh(new_message)
-                    
-                    message_dict = {
-                        "action": "send",
-                        "id": new_message.id,
-                        "conversation_id": new_message.conversation_id,
-                        "sender_id": new_message.sender_id,
-                        "content": new_message.content,
-                        "type": new_message.type,
-                        "file_url": new_message.file_url
-                    }
-                    # Chỉ phát tin nhắn đến các client trong cuộc trò chuyện này
-                    await manager.broadcast(message_dict, conversation_id)
-                except Exception as e:
-                    print("Lỗi cơ sở dữ liệu:", str(e))
+                await handle_send(data, data.sender_id)
 
             # Xử lý xóa tin nhắn
             elif data.action == "delete":
-                message_id = data.message_id
-                try:
-                    stmt = select(Message).where(Message.id == message_id)
-                    result = await db.execute(stmt)
-                    message = result.scalar_one_or_none()
-                    if message and str(message.conversation_id) == conversation_id:
-                        await db.delete(message)
-                        
-                        # Cập nhật last_message_id
-                        stmt = select(Message).where(Message.conversation_id == conversation_id).order_by(Message.created_at.desc()).limit(1)
-                        result = await db.execute(stmt)
-                        last_message = result.scalar_one_or_none()
-                        
-                        stmt = select(Conversation).where(Conversation.id == conversation_id)
-                        result = await db.execute(stmt)
-                        conversation = result.scalar_one_or_none()
-                        if conversation:
-                            conversation.updated_at = await get_vn_time()
-                            conversation.last_message_id = last_message.id if last_message else None
-                            db.add(conversation)
-                        
-                        await db.commit()
-                        
-                        delete_dict = {
-                            "action": "delete",
-                            "message_id": message_id
-                        }
-                        # Chỉ phát thông báo xóa đến các client trong cuộc trò chuyện này
-                        await manager.broadcast(delete_dict, conversation_id)
-                except Exception as e:
-                    print("Lỗi xóa:", str(e))
+                await handle_delete(data.message_id, conversation_id)
+
+            # Lấy các sự kiện bị lỡ sau khi kết nối lại
+            elif data.action == "sync":
+                await handle_sync(connection, conversation_id, data.after_seq)
 
     except WebSocketDisconnect:
         print("WebSocket đã ngắt kết nối")
     except Exception as e:
         print("Lỗi WebSocket:", str(e))
     finally:
-        manager.disconnect(websocket, conversation_id)
+        manager.disconnect(websocket)
+
+
+@message_router.websocket("/ws/user")
+async def user_websocket_endpoint(websocket: WebSocket, token: str):
+    """Một socket cho toàn bộ hộp thư của user.
+    Frame: subscribe / unsubscribe / send / delete / sync, đều kèm conversation_id."""
+    try:
+        user_id = decode_access_token(token)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+
+    conversation_ids = await get_user_conversation_ids(user_id)
+    connection = await manager.connect_user(websocket, user_id, conversation_ids)
+    try:
+        while True:
+            data = SimpleNamespace(**await websocket.receive_json())
+            conversation_id = str(getattr(data, "conversation_id", ""))
+
+            if data.action == "subscribe":
+                if await is_participant(user_id, conversation_id):
+                    manager.subscribe(connection, conversation_id)
+                    connection.enqueue(encode_frame({"action": "subscribed", "conversation_id": conversation_id}))
+
+            elif data.action == "unsubscribe":
+                manager.unsubscribe(connection, conversation_id)
+                connection.enqueue(encode_frame({"action": "unsubscribed", "conversation_id": conversation_id}))
+
+            # Chỉ cho gửi / xoá trong các conversation socket đã đăng ký
+            elif conversation_id not in connection.conversations:
+                continue
+
+            elif data.action == "send":
+                # sender_id lấy từ token, không tin giá trị client gửi lên
+                await handle_send(data, user_id)
+
+            elif data.action == "delete":
+                await handle_delete(data.message_id, conversation_id)
+
+            elif data.action == "sync":
+                await handle_sync(connection, conversation_id, data.after_seq)
+
+    except WebSocketDisconnect:
+        print("WebSocket đã ngắt kết nối")
+    except Exception as e:
+        print("Lỗi WebSocket:", str(e))
+    finally:
+        manager.disconnect(websocket)
+
+@message_router.post('/send')
+async def send_message(data: INewMessageData):
+    if not await membership_index.is_member(data.conversation_id, data.sender_id):
+        raise HTTPException(status_code=403, detail="Sender is not in conversation")
+    if not attachment_allowed(data.file_url, data.sender_id):
+        raise HTTPException(status_code=403, detail="Attachment does not belong to sender")
+    try:
+        new_message = await append_message(data.model_dump(mode="json"))
+    except IntegrityError:
+        raise HTTPException(status_code=404, detail="Conversation or sender not found")
+    await manager.broadcast(message_event(new_message), new_message["conversation_id"])
+    return new_message
 
 @message_router.get('/get-mess/{message_id}')
 async def get_message_by_id(message_id: str, db: AsyncSession = Depends(get_db)):
@@ -139,38 +169,67 @@ async def get_message_by_id(message_id: str, db: AsyncSession = Depends(get_db))
     message = result.scalars().first()
     return message
 
+@message_router.get('/{conversation_id}/sync')
+async def sync_conversation_events(
+    conversation_id: str,
+    after_seq: int = Query(0, ge=0),
+    limit: int = Query(SYNC_PAGE_SIZE, ge=1, le=1000)
+):
+    """params: after_seq là seq lớn nhất client đã có, trả về các sự kiện gửi / xoá sau đó."""
+    return await get_events_after(conversation_id, after_seq, limit)
+
 @message_router.get('/{conversation_id}')
-async def get_conversation_messages(conversation_id: str, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(Message).where(Message.conversation_id == conversation_id))
+async def get_conversation_messages(
+    conversation_id: str,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    db: AsyncSession = Depends(get_db)
+):
+    """params: before / after là cursor lấy từ next_cursor, không truyền cursor sẽ lấy trang mới nhất.
+    Tin nhắn trong một trang luôn sắp xếp cũ -> mới."""
+    if before and after:
+        raise HTTPException(status_code=400, detail="Only one of before/after can be used")
+    try:
+        cursor = decode_cursor(before or after) if (before or after) else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    position = tuple_(Message.created_at, Message.id)
+    stmt = select(Message).where(Message.conversation_id == conversation_id)
+    if after:
+        # Cuộn xuôi: lấy các tin nhắn mới hơn cursor
+        stmt = stmt.where(position > tuple_(*cursor)).order_by(Message.created_at.asc(), Message.id.asc())
+    else:
+        # Cuộn ngược (mặc định): lấy các tin nhắn cũ hơn cursor
+        if cursor:
+            stmt = stmt.where(position < tuple_(*cursor))
+        stmt = stmt.order_by(Message.created_at.desc(), Message.id.desc())
+
+    # Lấy thêm 1 dòng để biết còn trang tiếp theo hay không
+    result = await db.execute(stmt.limit(limit + 1))
     messages = result.scalars().all()
-    return messages
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+
+    next_cursor = None
+    if has_more:
+        edge = messages[-1]
+        next_cursor = encode_cursor(edge.created_at, edge.id)
+    if not after:
+        messages.reverse()
+
+    return {
+        "messages": messages,
+        "next_cursor": next_cursor,
+        "has_more": has_more
+    }
 
 @message_router.delete("/{message_id}")
-async def delete_conversation(message_id: str, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(Message).where(Message.id == message_id))
-    message = result.scalars().first()
-    
-    if message is None:
+async def delete_conversation(message_id: str):
+    deleted = await delete_message(message_id)
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Message not found")
     
-    if message.file_url:
-        parsed_url = urlparse(message.file_url)
-        filename = parsed_url.path.lstrip("/")
-        s3_client.delete_object(Bucket=S3_BUCKET_NAME, Key=filename)
-    
-    # Cập nhật last_message_id
-    stmt = select(Message).where(Message.conversation_id == message.conversation_id).order_by(Message.created_at.desc()).limit(1)
-    result = await db.execute(stmt)
-    last_message = result.scalar_one_or_none()
-    
-    stmt = select(Conversation).where(Conversation.id == message.conversation_id)
-    result = await db.execute(stmt)
-    conversation = result.scalar_one_or_none()
-    if conversation:
-        conversation.updated_at = await get_vn_time()
-        conversation.last_message_id = last_message.id if last_message else None  # Cập nhật last_message_id
-        db.add(conversation)
-    
-    await db.delete(message)
-    await db.commit()
-    return {"message": "Message deleted successfully"}
\ No newline at end of file
+    await manager.broadcast(delete_event(deleted), deleted["conversation_id"])
+    return {"message": "Message deleted successfully"}
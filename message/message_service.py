@@ -0,0 +1,281 @@
+import uuid
+from typing import List, Optional
+from sqlalchemy import insert, update, delete, select, case, cast, func, literal, String, DateTime
+from sqlalchemy.orm import aliased
+from database import engine, AsyncSessionLocal
+from bucket.s3_cleanup import s3_cleanup_queue
+from models.models import Message, Conversation, ConversationParticipant, DeletedMessage, get_vietnam_now
+
+# Mỗi câu lệnh tự commit: một câu CTE là nguyên tử nên không cần BEGIN/COMMIT riêng
+autocommit_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
+
+MESSAGE_COLUMNS = (
+    Message.id,
+    Message.conversation_id,
+    Message.sender_id,
+    Message.content,
+    Message.type,
+    Message.file_url,
+    Message.seq,
+    Message.created_at
+)
+
+
+async def append_message(values: dict) -> dict:
+    """Thêm tin nhắn, cập nhật last_seq / last_message_id / updated_at của conversation và
+    con trỏ đã đọc của người gửi trong một câu lệnh (một round trip).
+    values gồm conversation_id, sender_id, content, type, file_url. Trả về dòng vừa thêm (RETURNING)."""
+    message_id = str(uuid.uuid4())
+    now = get_vietnam_now()
+    # Khoá dòng conversation khi tăng last_seq nên seq luôn tăng dần, không trùng
+    bumped_conversation = (
+        update(Conversation)
+        .where(Conversation.id == values["conversation_id"])
+        .values(last_seq=Conversation.last_seq + 1, last_message_id=message_id, updated_at=now)
+        .returning(Conversation.last_seq)
+        .cte("bumped_conversation")
+    )
+    # Người gửi đã "đọc" tới tin nhắn của chính mình
+    sender_read = (
+        update(ConversationParticipant)
+        .where(
+            ConversationParticipant.conversation_id == values["conversation_id"],
+            ConversationParticipant.user_id == values["sender_id"]
+        )
+        .values(last_read_seq=select(bumped_conversation.c.last_seq).scalar_subquery())
+        .cte("sender_read")
+    )
+    stmt = (
+        insert(Message)
+        .values(
+            id=message_id,
+            seq=select(bumped_conversation.c.last_seq).scalar_subquery(),
+            created_at=now,
+            updated_at=now,
+            **values
+        )
+        .add_cte(bumped_conversation, sender_read)
+        .returning(*MESSAGE_COLUMNS)
+    )
+    async with autocommit_engine.connect() as conn:
+        result = await conn.execute(stmt)
+        return dict(result.mappings().one())
+
+
+async def delete_message(message_id: str, conversation_id: str = None) -> Optional[dict]:
+    """Xoá tin nhắn (nếu truyền conversation_id thì tin nhắn phải thuộc conversation đó),
+    tăng last_seq, ghi dấu xoá và sửa last_message_id trong một câu lệnh.
+    File đính kèm được xoá khỏi S3 ở nền. Trả về None nếu không tìm thấy."""
+    now = get_vietnam_now()
+    conditions = [Message.id == message_id]
+    if conversation_id is not None:
+        conditions.append(Message.conversation_id == conversation_id)
+    deleted_message = (
+        delete(Message)
+        .where(*conditions)
+        .returning(Message.id, Message.conversation_id, Message.file_url)
+        .cte("deleted_message")
+    )
+    # Chỉ tìm lại tin nhắn cuối khi chính nó bị xoá; câu con đi theo index
+    # (conversation_id, seq) từ cuối nên không phụ thuộc độ dài lịch sử.
+    # Câu con vẫn thấy dòng vừa xoá (cùng snapshot) nên phải loại nó ra.
+    remaining = aliased(Message)
+    previous_message_id = (
+        select(remaining.id)
+        .where(
+            remaining.conversation_id == deleted_message.c.conversation_id,
+            remaining.id != deleted_message.c.id
+        )
+        .order_by(remaining.seq.desc())
+        .limit(1)
+        .correlate_except(remaining)
+        .scalar_subquery()
+    )
+    bumped_conversation = (
+        update(Conversation)
+        .where(Conversation.id == deleted_message.c.conversation_id)
+        .values(
+            last_seq=Conversation.last_seq + 1,
+            updated_at=now,
+            last_message_id=case(
+                (Conversation.last_message_id == deleted_message.c.id, previous_message_id),
+                else_=Conversation.last_message_id
+            )
+        )
+        .returning(Conversation.id, Conversation.last_seq)
+        .cte("bumped_conversation")
+    )
+    tombstone = (
+        insert(DeletedMessage)
+        .from_select(
+            ["id", "conversation_id", "message_id", "seq", "deleted_at"],
+            select(
+                literal(str(uuid.uuid4()), String),
+                bumped_conversation.c.id,
+                literal(message_id, String),
+                bumped_conversation.c.last_seq,
+                literal(now, DateTime)
+            )
+        )
+        .cte("tombstone")
+    )
+    stmt = (
+        select(
+            deleted_message.c.id.label("message_id"),
+            deleted_message.c.conversation_id,
+            deleted_message.c.file_url,
+            bumped_conversation.c.last_seq.label("seq")
+        )
+        .select_from(deleted_message.join(bumped_conversation, bumped_conversation.c.id == deleted_message.c.conversation_id))
+        .add_cte(tombstone)
+    )
+    async with autocommit_engine.connect() as conn:
+        result = await conn.execute(stmt)
+        row = result.mappings().one_or_none()
+    if row is None:
+        return None
+    s3_cleanup_queue.enqueue(row["file_url"])
+    return dict(row)
+
+
+async def delete_sender_messages(sender_id: str, limit: int) -> List[dict]:
+    """Xoá tối đa limit tin nhắn của sender_id ở mọi conversation trong một câu lệnh, giống
+    delete_message cho từng tin: mỗi tin nhận một seq mới và một dấu xoá, last_seq / last_message_id
+    của từng conversation được cập nhật. File đính kèm được xoá khỏi S3 ở nền.
+    Trả về các sự kiện xoá {message_id, conversation_id, seq} theo thứ tự seq."""
+    now = get_vietnam_now()
+    chunk = select(Message.id).where(Message.sender_id == sender_id).limit(limit).scalar_subquery()
+    purged = (
+        delete(Message)
+        .where(Message.id.in_(chunk))
+        .returning(Message.id, Message.conversation_id, Message.file_url, Message.seq)
+        .cte("purged")
+    )
+    deleted_counts = (
+        select(purged.c.conversation_id, func.count().label("deleted"))
+        .group_by(purged.c.conversation_id)
+        .cte("deleted_counts")
+    )
+    # Như delete_message: câu con vẫn thấy các dòng vừa xoá nên phải loại chúng ra
+    remaining = aliased(Message)
+    previous_message_id = (
+        select(remaining.id)
+        .where(
+            remaining.conversation_id == Conversation.id,
+            remaining.id.not_in(select(purged.c.id))
+        )
+        .order_by(remaining.seq.desc())
+        .limit(1)
+        .correlate(Conversation)
+        .scalar_subquery()
+    )
+    bumped_conversations = (
+        update(Conversation)
+        .where(Conversation.id == deleted_counts.c.conversation_id)
+        .values(
+            last_seq=Conversation.last_seq + deleted_counts.c.deleted,
+            updated_at=now,
+            last_message_id=case(
+                (Conversation.last_message_id.in_(select(purged.c.id)), previous_message_id),
+                else_=Conversation.last_message_id
+            )
+        )
+        .returning(Conversation.id, Conversation.last_seq, deleted_counts.c.deleted)
+        .cte("bumped_conversations")
+    )
+    # Dải seq mới của mỗi conversation được chia cho các tin bị xoá theo thứ tự seq cũ
+    position = func.row_number().over(
+        partition_by=purged.c.conversation_id,
+        order_by=purged.c.seq
+    )
+    numbered = (
+        select(purged.c.id, purged.c.conversation_id, purged.c.file_url, position.label("position"))
+        .cte("numbered")
+    )
+    events = (
+        select(
+            numbered.c.id.label("message_id"),
+            numbered.c.conversation_id,
+            numbered.c.file_url,
+            (bumped_conversations.c.last_seq - bumped_conversations.c.deleted + numbered.c.position).label("seq")
+        )
+        .join_from(numbered, bumped_conversations, bumped_conversations.c.id == numbered.c.conversation_id)
+        .cte("events")
+    )
+    tombstones = (
+        insert(DeletedMessage)
+        .from_select(
+            ["id", "conversation_id", "message_id", "seq", "deleted_at"],
+            select(
+                cast(func.gen_random_uuid(), String),
+                events.c.conversation_id,
+                events.c.message_id,
+                events.c.seq,
+                literal(now, DateTime)
+            )
+        )
+        .cte("tombstones")
+    )
+    stmt = select(events).order_by(events.c.seq).add_cte(tombstones)
+    async with autocommit_engine.connect() as conn:
+        result = await conn.execute(stmt)
+        rows = [dict(row) for row in result.mappings().all()]
+    for row in rows:
+        s3_cleanup_queue.enqueue(row["file_url"])
+    return rows
+
+
+async def get_events_after(conversation_id: str, after_seq: int, limit: int) -> dict:
+    """Các sự kiện gửi / xoá có seq > after_seq theo thứ tự seq, tối đa limit sự kiện."""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(*MESSAGE_COLUMNS)
+            .where(Message.conversation_id == conversation_id, Message.seq > after_seq)
+            .order_by(Message.seq)
+            .limit(limit + 1)
+        )
+        events = [message_event(row) for row in result.mappings().all()]
+
+        result = await db.execute(
+            select(DeletedMessage.message_id, DeletedMessage.conversation_id, DeletedMessage.seq)
+            .where(DeletedMessage.conversation_id == conversation_id, DeletedMessage.seq > after_seq)
+            .order_by(DeletedMessage.seq)
+            .limit(limit + 1)
+        )
+        events += [delete_event(row) for row in result.mappings().all()]
+
+    # Mỗi danh sách là tiền tố đã sắp xếp, nên limit sự kiện đầu của bản gộp là chính xác
+    events.sort(key=lambda event: event["seq"])
+    has_more = len(events) > limit
+    events = events[:limit]
+    return {
+        "conversation_id": conversation_id,
+        "events": events,
+        "last_seq": events[-1]["seq"] if events else after_seq,
+        "has_more": has_more
+    }
+
+
+def message_event(row) -> dict:
+    """Frame "send" phát tới client cho một tin nhắn vừa được lưu."""
+    return {
+        "action": "send",
+        "id": row["id"],
+        "conversation_id": row["conversation_id"],
+        "sender_id": row["sender_id"],
+        "content": row["content"],
+        "type": row["type"],
+        "file_url": row["file_url"],
+        "seq": row["seq"],
+        "created_at": row["created_at"]
+    }
+
+
+def delete_event(row) -> dict:
+    """Frame "delete" phát tới client khi một tin nhắn bị xoá."""
+    return {
+        "action": "delete",
+        "message_id": row["message_id"],
+        "conversation_id": row["conversation_id"],
+        "seq": row["seq"]
+    }
@@ -0,0 +1,220 @@
+import asyncio
+import os
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import NullPool
+from database import engine
+
+# handler(conversation_id, frame) nhận mọi frame đã encode được publish, kể cả từ worker khác
+Handler = Callable[[str, str], Awaitable[None]]
+# Gọi sau khi kết nối LISTEN được nối lại (các sự kiện trong lúc mất kết nối đã bị lỡ)
+ReconnectHandler = Callable[[], Awaitable[None]]
+
+# Payload NOTIFY phải < 8000 byte
+NOTIFY_PAYLOAD_LIMIT = 7900
+# Số ký tự mỗi phần khi cắt frame lớn: UTF-8 tối đa 4 byte / ký tự, chừa chỗ cho header
+NOTIFY_CHUNK_CHARS = 1900
+# Chu kỳ (giây) kiểm tra kết nối LISTEN còn sống
+PUBSUB_HEARTBEAT_INTERVAL = float(os.getenv("PUBSUB_HEARTBEAT_INTERVAL", "15"))
+
+
+class InProcessPubSub:
+    """Phát sự kiện ngay trong tiến trình hiện tại, chỉ đúng khi chạy một worker."""
+
+    def __init__(self):
+        self.handler: Optional[Handler] = None
+
+    async def start(self, handler: Handler, on_reconnect: Optional[ReconnectHandler] = None):
+        self.handler = handler
+
+    async def stop(self):
+        self.handler = None
+
+    async def publish(self, conversation_id: str, frame: str):
+        if self.handler:
+            await self.handler(conversation_id, frame)
+
+    def stats(self) -> dict:
+        return {"backend": "memory"}
+
+
+class PostgresPubSub:
+    """Phát sự kiện giữa nhiều worker / máy qua LISTEN/NOTIFY của Postgres.
+
+    Mỗi tiến trình giữ một kết nối LISTEN riêng, publish là một pg_notify ngắn. Tiến trình gửi
+    cũng nhận lại chính sự kiện của nó nên việc phát cục bộ chỉ diễn ra trong _on_notify.
+
+    - Payload NOTIFY bị Postgres giới hạn < 8000 byte: frame lớn hơn được cắt thành nhiều phần,
+      gửi trong cùng một transaction (Postgres giao chúng cùng nhau, đúng thứ tự) rồi ghép lại.
+    - LISTEN cần kết nối session trực tiếp: không dùng được qua pooler (vd. host "-pooler" của
+      Neon), nên listen_engine nên trỏ tới PUBSUB_DATABASE_URL là endpoint trực tiếp.
+    - Kết nối LISTEN được kiểm tra mỗi heartbeat giây và tự kết nối lại khi bị ngắt; sự kiện
+      trong khoảng mất kết nối bị lỡ nên on_reconnect được gọi để client đồng bộ lại theo seq.
+    """
+
+    CHANNEL = "ott_message_events"
+
+    def __init__(self, engine: AsyncEngine, listen_engine: AsyncEngine = None, heartbeat: float = PUBSUB_HEARTBEAT_INTERVAL):
+        self.engine = engine
+        self.listen_engine = listen_engine or engine
+        self.heartbeat = heartbeat
+        self.handler: Optional[Handler] = None
+        self.on_reconnect: Optional[ReconnectHandler] = None
+        self._listen_conn = None
+        self._driver_conn = None
+        self._lost = asyncio.Event()
+        self._supervisor = None
+        # key -> các phần đã nhận của một frame bị cắt
+        self._partial: Dict[str, List[Optional[str]]] = {}
+        self._tasks = set()
+        self.reconnects = 0
+        self.chunked_frames = 0
+
+    async def start(self, handler: Handler, on_reconnect: Optional[ReconnectHandler] = None):
+        self.handler = handler
+        self.on_reconnect = on_reconnect
+        await self._listen()
+        self._supervisor = asyncio.create_task(self._supervise())
+
+    async def stop(self):
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            try:
+                await self._supervisor
+            except asyncio.CancelledError:
+                pass
+            self._supervisor = None
+        await self._close_listener()
+
+    async def _listen(self):
+        self._lost = asyncio.Event()
+        self._partial.clear()
+        conn = await self.listen_engine.connect()
+        try:
+            raw_conn = await conn.get_raw_connection()
+            driver_conn = raw_conn.driver_connection
+            await driver_conn.add_listener(self.CHANNEL, self._on_notify)
+            driver_conn.add_termination_listener(self._on_terminated)
+        except Exception:
+            await conn.invalidate()
+            raise
+        self._listen_conn, self._driver_conn = conn, driver_conn
+
+    async def _close_listener(self):
+        conn, driver_conn = self._listen_conn, self._driver_conn
+        self._listen_conn = self._driver_conn = None
+        if conn is None:
+            return
+        try:
+            driver_conn.remove_termination_listener(self._on_terminated)
+            if not driver_conn.is_closed():
+                await driver_conn.remove_listener(self.CHANNEL, self._on_notify)
+                await conn.close()
+                return
+        except Exception as e:
+            print("Lỗi đóng kết nối LISTEN:", str(e))
+        # Kết nối đã hỏng: bỏ hẳn thay vì trả về pool
+        try:
+            await conn.invalidate()
+        except Exception:
+            pass
+
+    def _on_terminated(self, connection):
+        self._lost.set()
+
+    async def _supervise(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._lost.wait(), timeout=self.heartbeat)
+                print("Kết nối LISTEN bị ngắt")
+            except asyncio.TimeoutError:
+                try:
+                    await asyncio.wait_for(self._driver_conn.execute("SELECT 1"), timeout=self.heartbeat)
+                    continue
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print("Kết nối LISTEN không phản hồi:", str(e))
+            await self._reconnect()
+
+    async def _reconnect(self):
+        await self._close_listener()
+        delay = 1
+        while True:
+            try:
+                await self._listen()
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Kết nối lại LISTEN thất bại, thử lại sau {delay}s:", str(e))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+        self.reconnects += 1
+        if self.on_reconnect is not None:
+            await self.on_reconnect()
+
+    def _on_notify(self, connection, pid, channel, payload):
+        # payload = "<conversation_id>\n<frame>"
+        # hoặc "<conversation_id> <key> <index> <total>\n<phần frame>" với frame bị cắt
+        header, separator, body = payload.partition("\n")
+        if not separator:
+            print("Bỏ qua payload NOTIFY không hợp lệ:", payload[:100])
+            return
+        fields = header.split(" ")
+        if len(fields) == 1:
+            self._dispatch(header, body)
+            return
+        conversation_id, key, index, total = fields
+        parts = self._partial.setdefault(key, [None] * int(total))
+        parts[int(index)] = body
+        if None not in parts:
+            del self._partial[key]
+            self._dispatch(conversation_id, "".join(parts))
+
+    def _dispatch(self, conversation_id: str, frame: str):
+        task = asyncio.create_task(self.handler(conversation_id, frame))
+        # Giữ tham chiếu tới task để không bị GC khi đang chạy
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _payloads(self, conversation_id: str, frame: str) -> List[str]:
+        payload = f"{conversation_id}\n{frame}"
+        if len(payload.encode()) < NOTIFY_PAYLOAD_LIMIT:
+            return [payload]
+        self.chunked_frames += 1
+        key = uuid.uuid4().hex
+        parts = [frame[start:start + NOTIFY_CHUNK_CHARS] for start in range(0, len(frame), NOTIFY_CHUNK_CHARS)]
+        return [f"{conversation_id} {key} {index} {len(parts)}\n{part}" for index, part in enumerate(parts)]
+
+    async def publish(self, conversation_id: str, frame: str):
+        payloads = self._payloads(conversation_id, frame)
+        # Mọi phần nằm trong một transaction nên được giao cùng nhau
+        async with self.engine.connect() as conn:
+            await conn.execute(select(*[func.pg_notify(self.CHANNEL, payload) for payload in payloads]))
+            await conn.commit()
+
+    def stats(self) -> dict:
+        return {
+            "backend": "postgres",
+            "listening": self._driver_conn is not None and not self._driver_conn.is_closed(),
+            "reconnects": self.reconnects,
+            "chunked_frames": self.chunked_frames,
+            "partial_frames": len(self._partial)
+        }
+
+
+def create_pubsub():
+    """PUBSUB_BACKEND=postgres để bật fan-out giữa nhiều worker, mặc định là memory."""
+    backend = os.getenv("PUBSUB_BACKEND", "memory").lower()
+    if backend == "postgres":
+        listen_url = os.getenv("PUBSUB_DATABASE_URL")
+        if not listen_url:
+            print("PUBSUB_DATABASE_URL chưa được đặt, LISTEN dùng DATABASE_URL (không hoạt động qua pooler)")
+            return PostgresPubSub(engine)
+        return PostgresPubSub(engine, create_async_engine(listen_url, poolclass=NullPool))
+    if backend == "memory":
+        return InProcessPubSub()
+    raise ValueError(f"Unknown PUBSUB_BACKEND: {backend}")
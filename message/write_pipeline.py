@@ -0,0 +1,148 @@
+import asyncio
+import os
+import uuid
+from sqlalchemy import bindparam, func, insert, update
+from database import AsyncSessionLocal
+from models.models import Message, Conversation, ConversationParticipant, get_vietnam_now
+
+# Bật bằng MESSAGE_WRITE_BEHIND=1, mặc định mỗi tin nhắn được ghi ngay như cũ
+WRITE_BEHIND_ENABLED = os.getenv("MESSAGE_WRITE_BEHIND", "0") == "1"
+BATCH_MAX_SIZE = int(os.getenv("MESSAGE_WRITE_BEHIND_BATCH_SIZE", "200"))
+BATCH_WINDOW = float(os.getenv("MESSAGE_WRITE_BEHIND_WINDOW_MS", "10")) / 1000
+# Đặt vào hàng đợi để báo _run() ghi nốt lô đang gom rồi dừng
+_STOP = object()
+
+
+class MessageWritePipeline:
+    """Gom tin nhắn trong một cửa sổ thời gian ngắn rồi ghi theo lô.
+
+    Mỗi lô là một UPDATE (cấp dải seq) cho mỗi conversation bị chạm tới cộng một
+    INSERT nhiều dòng, trong cùng một transaction. submit() chỉ trả về khi lô chứa tin nhắn đã commit.
+    """
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task = None
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        # Không cancel(): huỷ giữa _write() sẽ bỏ dở transaction và các future của lô
+        # không bao giờ được trả lời. Chờ lô đang ghi xong rồi mới ghi nốt phần còn lại.
+        await self.queue.put(_STOP)
+        await self.task
+        self.task = None
+        # Tin nhắn submit() sau khi đã báo dừng nằm sau _STOP trong hàng đợi
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if batch:
+            await self._flush(batch)
+
+    async def submit(self, values: dict) -> dict:
+        """values gồm conversation_id, sender_id, content, type, file_url."""
+        row = {
+            **values,
+            "id": str(uuid.uuid4()),
+            "created_at": get_vietnam_now()
+        }
+        row["updated_at"] = row["created_at"]
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((row, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            stopping = False
+            deadline = loop.time() + BATCH_WINDOW
+            while len(batch) < BATCH_MAX_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+            if stopping:
+                return
+
+    async def _flush(self, batch):
+        try:
+            await self._write([row for row, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                # Một dòng lỗi (vd. conversation không tồn tại) không được làm hỏng cả lô
+                for item in batch:
+                    await self._flush([item])
+                return
+            print("Lỗi ghi tin nhắn:", str(e))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for row, future in batch:
+            if not future.done():
+                future.set_result(row)
+
+    async def _write(self, rows):
+        # Gom các dòng theo conversation (giữ thứ tự gửi)
+        rows_by_conversation = {}
+        for row in rows:
+            rows_by_conversation.setdefault(row["conversation_id"], []).append(row)
+
+        async with AsyncSessionLocal() as db:
+            # Khoá conversation theo thứ tự cố định để các worker không deadlock lẫn nhau
+            for conversation_id, conversation_rows in sorted(rows_by_conversation.items()):
+                # Cấp một dải seq liên tiếp cho cả lô của conversation này
+                last_row = conversation_rows[-1]
+                result = await db.execute(
+                    update(Conversation)
+                    .where(Conversation.id == conversation_id)
+                    .values(
+                        last_seq=Conversation.last_seq + len(conversation_rows),
+                        last_message_id=last_row["id"],
+                        updated_at=last_row["created_at"]
+                    )
+                    .returning(Conversation.last_seq)
+                )
+                last_seq = result.scalar_one_or_none()
+                if last_seq is None:
+                    raise LookupError(f"Conversation {conversation_id} not found")
+                first_seq = last_seq - len(conversation_rows) + 1
+                for offset, row in enumerate(conversation_rows):
+                    row["seq"] = first_seq + offset
+            await db.execute(insert(Message).values(rows))
+            # Người gửi đã "đọc" tới tin nhắn cuối của mình trong lô
+            sender_seqs = {}
+            for row in rows:
+                sender_seqs[(row["conversation_id"], row["sender_id"])] = row["seq"]
+            participants = ConversationParticipant.__table__
+            await db.execute(
+                participants.update()
+                .where(
+                    participants.c.conversation_id == bindparam("b_conversation_id"),
+                    participants.c.user_id == bindparam("b_user_id")
+                )
+                .values(last_read_seq=func.greatest(participants.c.last_read_seq, bindparam("b_seq"))),
+                [
+                    {"b_conversation_id": conversation_id, "b_user_id": user_id, "b_seq": seq}
+                    for (conversation_id, user_id), seq in sorted(sender_seqs.items())
+                ]
+            )
+            await db.commit()
+
+write_pipeline = MessageWritePipeline()
@@ -1,9 +1,12 @@
 from sqlalchemy import (
     Column,
     String,
+    BigInteger,
     ForeignKey,
     DateTime,
-    Enum
+    Enum,
+    Index,
+    func
 )
 from sqlalchemy.orm import relationship
 import datetime
@@ -11,9 +14,15 @@ import pytz
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.postgresql import ARRAY 
 import uuid
+import os
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hash cũ có cost khác BCRYPT_ROUNDS được coi là cần hash lại (xem user/password_hasher.py)
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=int(os.getenv("BCRYPT_ROUNDS", "12"))
+)
 
 Base = declarative_base()
 
@@ -40,11 +49,11 @@ class User(Base):
     created_at = Column(DateTime, default=get_vietnam_now)
     updated_at = Column(DateTime, default=get_vietnam_now, onupdate=get_vietnam_now)
 
-    conversations = relationship("ConversationParticipant", back_populates="user", cascade="all, delete-orphan")
-    messages = relationship("Message", back_populates="user", cascade="all, delete-orphan")
+    conversations = relationship("ConversationParticipant", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
+    messages = relationship("Message", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
     
-    sent_friend_requests = relationship("Friendship", foreign_keys='Friendship.requester_id', back_populates="requester", cascade="all, delete-orphan")
-    received_friend_requests = relationship("Friendship", foreign_keys='Friendship.receiver_id', back_populates="receiver", cascade="all, delete-orphan")
+    sent_friend_requests = relationship("Friendship", foreign_keys='Friendship.requester_id', back_populates="requester", cascade="all, delete-orphan", passive_deletes=True)
+    received_friend_requests = relationship("Friendship", foreign_keys='Friendship.receiver_id', back_populates="receiver", cascade="all, delete-orphan", passive_deletes=True)
 
     def set_password(self, raw_password):
         self.password = pwd_context.hash(raw_password)
@@ -52,6 +61,16 @@ class User(Base):
     def verify_password(self, raw_password):
         return pwd_context.verify(raw_password, self.password)
 
+class DeletedUser(Base):
+    """User đã bị xoá, ghi cùng transaction với request xoá. Không có khoá ngoại: dòng còn lại
+    sau khi purge xoá dòng users, để token cũ vẫn bị từ chối sau khi khởi động lại cho tới khi hết hạn
+    và purge chưa xong được xếp lại."""
+    __tablename__ = "deleted_users"
+
+    user_id = Column(String(36), primary_key=True)
+    deleted_at = Column(DateTime, nullable=False, default=get_vietnam_now)
+
+
 class Friendship(Base):
     __tablename__ = "friendships"
 
@@ -62,8 +81,8 @@ class Friendship(Base):
         unique=True,
         nullable=False,
     )
-    requester_id = Column(String(36), ForeignKey("users.id"), nullable=False)
-    receiver_id = Column(String(36), ForeignKey("users.id"), nullable=False)
+    requester_id = Column(String(36), ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    receiver_id = Column(String(36), ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     status = Column(Enum('PENDING', 'ACCEPTED', name="friendship_status"), nullable=False, default='PENDING')
     created_at = Column(DateTime, default=get_vietnam_now)
     updated_at = Column(DateTime, default=get_vietnam_now, onupdate=get_vietnam_now)
@@ -71,6 +90,14 @@ class Friendship(Base):
     requester = relationship("User", foreign_keys=[requester_id], back_populates="sent_friend_requests")
     receiver = relationship("User", foreign_keys=[receiver_id], back_populates="received_friend_requests")
 
+    __table_args__ = (
+        # Danh sách bạn / lời mời theo từng chiều, đã sắp theo (updated_at, id) cho phân trang keyset
+        Index("ix_friendships_requester_status", "requester_id", "status", "updated_at", "id"),
+        Index("ix_friendships_receiver_status", "receiver_id", "status", "updated_at", "id"),
+        # Mỗi cặp user (không phân biệt chiều) chỉ có một Friendship
+        Index("ux_friendships_pair", func.least(requester_id, receiver_id), func.greatest(requester_id, receiver_id), unique=True),
+    )
+
 
 class Conversation(Base):
     __tablename__ = "conversations"
@@ -86,12 +113,17 @@ class Conversation(Base):
     type = Column(Enum('private', 'group', name="conversation_type"), nullable=False)
     avatar_url = Column(String, nullable=True)
     last_message_id = Column(String(36), nullable=True)
-    created_by = Column(String(36), ForeignKey("users.id"), nullable=False)
+    # Số thứ tự của sự kiện (gửi / xoá tin nhắn) gần nhất trong conversation
+    last_seq = Column(BigInteger, nullable=False, default=0, server_default="0")
+    # "<user_id nhỏ>:<user_id lớn>" cho conversation private, NULL với group
+    pair_key = Column(String(73), nullable=True, unique=True)
+    # NULL khi người tạo đã bị xoá
+    created_by = Column(String(36), ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
     created_at = Column(DateTime, default=get_vietnam_now)
     updated_at = Column(DateTime, default=get_vietnam_now, onupdate=get_vietnam_now)
 
-    participants = relationship("ConversationParticipant", back_populates="conversation", cascade="all, delete-orphan")
-    messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
+    participants = relationship("ConversationParticipant", back_populates="conversation", cascade="all, delete-orphan", passive_deletes=True)
+    messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan", passive_deletes=True)
 
 
 class Message(Base):
@@ -104,17 +136,49 @@ class Message(Base):
         unique=True,
         nullable=False,
     )
-    conversation_id = Column(String(36), ForeignKey("conversations.id"), nullable=False)
-    sender_id = Column(String(36), ForeignKey("users.id"), nullable=False)
+    conversation_id = Column(String(36), ForeignKey("conversations.id", ondelete="CASCADE"), nullable=False)
+    sender_id = Column(String(36), ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     content = Column(String, nullable=True)
     type = Column(Enum('text', 'image', 'file', 'audio', 'video', name="message_type"), nullable=False, default='text')
     file_url = Column(String, nullable=True)
+    seq = Column(BigInteger, nullable=True)
     created_at = Column(DateTime, default=get_vietnam_now)
     updated_at = Column(DateTime, default=get_vietnam_now, onupdate=get_vietnam_now)
 
     conversation = relationship("Conversation", back_populates="messages")
     user = relationship("User", back_populates="messages")
 
+    __table_args__ = (
+        # Phục vụ phân trang keyset lịch sử tin nhắn theo (created_at, id)
+        Index("ix_messages_conversation_created_id", "conversation_id", "created_at", "id"),
+        Index("ux_messages_conversation_seq", "conversation_id", "seq", unique=True),
+        # Purge tin nhắn của user bị xoá theo từng khối
+        Index("ix_messages_sender_id", "sender_id"),
+        # Kiểm tra quyền tải file đính kèm qua /presign/download
+        Index("ix_messages_file_url", "file_url"),
+    )
+
+
+class DeletedMessage(Base):
+    """Dấu vết của tin nhắn đã xoá để client đồng bộ lại sự kiện xoá theo seq."""
+    __tablename__ = "deleted_messages"
+
+    id = Column(
+        String(36),
+        primary_key=True,
+        default=lambda: str(uuid.uuid4()),
+        unique=True,
+        nullable=False,
+    )
+    conversation_id = Column(String(36), ForeignKey("conversations.id", ondelete="CASCADE"), nullable=False)
+    message_id = Column(String(36), nullable=False)
+    seq = Column(BigInteger, nullable=False)
+    deleted_at = Column(DateTime, default=get_vietnam_now)
+
+    __table_args__ = (
+        Index("ix_deleted_messages_conversation_seq", "conversation_id", "seq"),
+    )
+
 
 class ConversationParticipant(Base):
     __tablename__ = "conversation_participants"
@@ -126,10 +190,16 @@ class ConversationParticipant(Base):
         unique=True,
         nullable=False,
     )
-    conversation_id = Column(String(36), ForeignKey("conversations.id"), nullable=False)
-    user_id = Column(String(36), ForeignKey("users.id"), nullable=False)
+    conversation_id = Column(String(36), ForeignKey("conversations.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(String(36), ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    # seq của sự kiện cuối cùng user đã đọc trong conversation
+    last_read_seq = Column(BigInteger, nullable=False, default=0, server_default="0")
 
     conversation = relationship("Conversation", back_populates="participants")
     user = relationship("User", back_populates="conversations")
 
+    __table_args__ = (
+        Index("uq_conversation_participants_conversation_user", "conversation_id", "user_id", unique=True),
+    )
+
 
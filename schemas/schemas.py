@@ -1,7 +1,16 @@
 from pydantic import BaseModel
+from typing import Optional
+from datetime import datetime
 
 class FriendRequestSchema(BaseModel):
   receiver_id: str
 
 class FriendshipActionSchema(BaseModel):
-  requester_id: str
\ No newline at end of file
+  requester_id: str
+
+class PublicProfile(BaseModel):
+  id: str
+  username: str
+  email: str
+  avatar_url: Optional[str] = None
+  created_at: Optional[datetime] = None
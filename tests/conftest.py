@@ -0,0 +1,119 @@
+"""Fixture dùng chung cho test.
+
+Test cần Postgres riêng: đặt TEST_DATABASE_URL (vd. postgresql+asyncpg://postgres@localhost/ott_test),
+thiếu biến này các test dùng DB bị skip. KHÔNG trỏ vào DB thật: schema bị xoá và tạo lại mỗi lần chạy.
+"""
+import asyncio
+import os
+import time
+import uuid
+import pytest
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+# database.py đọc DATABASE_URL lúc import nên phải đặt trước khi import app
+if TEST_DATABASE_URL:
+  os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+os.environ.setdefault("AWS_REGION", "ap-southeast-1")
+os.environ.setdefault("AWS_ACCESS_KEY", "test")
+os.environ.setdefault("AWS_SECRET_KEY", "test")
+os.environ.setdefault("S3_BUCKET_NAME", "ott-test")
+
+
+def run(coro):
+  return asyncio.run(coro)
+
+
+def make_engine():
+  from sqlalchemy.ext.asyncio import create_async_engine
+  from sqlalchemy.pool import NullPool
+  # NullPool: kết nối không bị giữ lại giữa các event loop của asyncio.run
+  return create_async_engine(TEST_DATABASE_URL, poolclass=NullPool)
+
+
+def make_worker(**kwargs):
+  """Một "worker": ConnectionManager với kết nối LISTEN riêng tới DB test."""
+  from message.connection_manager import ConnectionManager
+  from message.pubsub import PostgresPubSub
+  return ConnectionManager(PostgresPubSub(make_engine(), make_engine(), **kwargs))
+
+
+class FakeWebSocket:
+  def __init__(self):
+    self.frames: asyncio.Queue = asyncio.Queue()
+    self.close_code = None
+
+  async def accept(self):
+    pass
+
+  async def send_text(self, frame: str):
+    await self.frames.put(frame)
+
+  async def send_json(self, data):
+    pass
+
+  async def close(self, code: int = 1000, reason: str = ""):
+    self.close_code = code
+
+
+def auth(user_id):
+  """Header Authorization với access token hợp lệ 10 phút của user_id."""
+  from authlib.jose import jwt
+  from user.user_controller import SECRET_KEY
+  token = jwt.encode({"alg": "HS256"}, {"sub": user_id, "exp": int(time.time()) + 600}, SECRET_KEY)
+  return {"Authorization": f"Bearer {token.decode()}"}
+
+
+@pytest.fixture(scope="session")
+def database_url():
+  if not TEST_DATABASE_URL:
+    pytest.skip("TEST_DATABASE_URL is not set")
+  from models.models import Base
+
+  async def reset():
+    engine = make_engine()
+    async with engine.begin() as conn:
+      await conn.run_sync(Base.metadata.drop_all)
+      await conn.run_sync(Base.metadata.create_all)
+    await engine.dispose()
+
+  run(reset())
+  return TEST_DATABASE_URL
+
+
+@pytest.fixture(scope="session")
+def client(database_url):
+  # Một TestClient cho cả phiên: app và mọi WebSocket chạy chung một event loop
+  from fastapi.testclient import TestClient
+  from main import app
+  from database import engine
+  with TestClient(app) as client:
+    yield client
+    client.portal.call(engine.dispose)
+
+
+@pytest.fixture
+def make_conversation(database_url):
+  """Tạo n user và một conversation group chứa tất cả, trả về (user_ids, conversation_id)."""
+  from models.models import User, Conversation, ConversationParticipant
+
+  async def create(n):
+    engine = make_engine()
+    user_ids = [str(uuid.uuid4()) for _ in range(n)]
+    conversation_id = str(uuid.uuid4())
+    async with engine.begin() as conn:
+      await conn.execute(User.__table__.insert(), [
+        {"id": user_id, "username": f"user-{user_id[:8]}", "email": f"{user_id}@test.local", "password": "x"}
+        for user_id in user_ids
+      ])
+      await conn.execute(Conversation.__table__.insert().values(
+        id=conversation_id, name="test", type="group", created_by=user_ids[0], last_seq=0
+      ))
+      await conn.execute(ConversationParticipant.__table__.insert(), [
+        {"id": str(uuid.uuid4()), "conversation_id": conversation_id, "user_id": user_id, "last_read_seq": 0}
+        for user_id in user_ids
+      ])
+    await engine.dispose()
+    return user_ids, conversation_id
+
+  return lambda n=2: run(create(n))
@@ -0,0 +1,30 @@
+import json
+
+
+def test_conversation_cache_is_invalidated_across_workers(client, make_conversation, monkeypatch):
+  from conversation.conversation_controller import CONVERSATION_CACHE_CHANNEL, conversation_cache
+  from message.connection_manager import manager, encode_frame
+  _, conversation_id = make_conversation(2)
+  published = []
+  publish = manager.pubsub.publish
+
+  async def record(channel, frame):
+    published.append((channel, json.loads(frame)))
+    await publish(channel, frame)
+
+  monkeypatch.setattr(manager.pubsub, "publish", record)
+
+  # Worker sửa conversation xoá cache của mình và báo cho các worker khác
+  assert client.get(f"/conversation/{conversation_id}").status_code == 200
+  assert conversation_cache.get(conversation_id) is not None
+  response = client.put(f"/conversation/update-name/{conversation_id}", json={"name": "mới"})
+  assert response.status_code == 200
+  assert conversation_cache.get(conversation_id) is None
+  assert (CONVERSATION_CACHE_CHANNEL, {"conversation_id": conversation_id}) in published
+  assert client.get(f"/conversation/{conversation_id}").json()["conversation"]["name"] == "mới"
+
+  # Thông báo từ worker khác xoá bản đã cache ở worker này
+  assert conversation_cache.get(conversation_id) is not None
+  frame = encode_frame({"conversation_id": conversation_id})
+  client.portal.call(manager.deliver, CONVERSATION_CACHE_CHANNEL, frame)
+  assert conversation_cache.get(conversation_id) is None
@@ -0,0 +1,18 @@
+import datetime
+import json
+import message.connection_manager as connection_manager
+
+
+def test_frame_format_does_not_depend_on_orjson(monkeypatch):
+  event = {
+    "action": "send",
+    "content": "xin chào",
+    "created_at": datetime.datetime(2026, 10, 18, 7, 0, 0, 123456),
+    "seq": 7
+  }
+  with_orjson = connection_manager.encode_frame(event)
+  monkeypatch.setattr(connection_manager, "orjson", None)
+  without_orjson = connection_manager.encode_frame(event)
+
+  assert json.loads(with_orjson) == json.loads(without_orjson)
+  assert json.loads(without_orjson)["created_at"] == "2026-10-18T07:00:00.123456"
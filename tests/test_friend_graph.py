@@ -0,0 +1,35 @@
+import asyncio
+import time
+from tests.conftest import run
+
+
+def test_stale_graph_is_served_while_rebuilding_in_background():
+  from friend.friend_graph import FriendGraph, FRIEND_GRAPH_TTL
+  graph = FriendGraph()
+  graph.loaded_at = time.monotonic()
+  graph.add_edge("a", "b")
+  released = asyncio.Event()
+
+  async def slow_build():
+    # Giả lập nạp lại từ DB: dữ liệu mới không còn cạnh a - b
+    await released.wait()
+    graph.index, graph.user_ids, graph.adjacency, graph.edges = {}, [], [], 0
+    graph.loaded_at = time.monotonic()
+
+  graph._build = slow_build
+
+  async def scenario():
+    graph.loaded_at = time.monotonic() - FRIEND_GRAPH_TTL - 1
+    # Đồ thị đã quá hạn: trả lời ngay bằng đồ thị hiện tại, không chờ nạp lại
+    assert await asyncio.wait_for(graph.friends("a"), timeout=1) == ["b"]
+    assert graph.refresh_task is not None
+    task = graph.refresh_task
+    assert await asyncio.wait_for(graph.mutual_friends("a", "b"), timeout=1) == []
+    # Chỉ một lần nạp lại chạy cùng lúc
+    assert graph.refresh_task is task
+    released.set()
+    await task
+    assert graph.refresh_task is None
+    assert await graph.friends("a") == []
+
+  run(scenario())
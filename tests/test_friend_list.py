@@ -0,0 +1,24 @@
+import uuid
+
+
+def signup(client):
+  email = f"{uuid.uuid4()}@test.local"
+  response = client.post("/user/signup", json={"username": email[:8], "email": email, "password": "secret123"})
+  token = response.json()["access_token"]
+  me = client.get("/user/me", headers={"Authorization": f"Bearer {token}"}).json()
+  return me["id"], {"Authorization": f"Bearer {token}"}
+
+
+def test_friend_list_exposes_public_fields_only(client):
+  requester_id, headers = signup(client)
+  receiver_id, _ = signup(client)
+  response = client.post("/friend/request", json={"receiver_id": receiver_id}, headers=headers)
+  assert response.status_code == 200
+
+  [friendship] = client.get("/friend/friend-list", headers=headers).json()
+  assert friendship["requester_id"] == requester_id
+  assert friendship["receiver_id"] == receiver_id
+  assert friendship["status"] == "PENDING"
+  for side, user_id in (("requester", requester_id), ("receiver", receiver_id)):
+    assert friendship[side]["id"] == user_id
+    assert set(friendship[side]) == {"id", "username", "email", "avatar_url", "created_at"}
@@ -0,0 +1,36 @@
+import asyncio
+import json
+from tests.conftest import run, FakeWebSocket, make_worker
+
+
+def test_membership_change_reaches_user_sockets_on_other_worker(database_url):
+  async def scenario():
+    worker_a, worker_b = make_worker(), make_worker()
+    await worker_a.start()
+    await worker_b.start()
+    try:
+      websocket = FakeWebSocket()
+      connection = await worker_b.connect_user(websocket, "user-1", ["group-1"])
+
+      # Bị gỡ khỏi group qua worker A: socket ở worker B phải ngừng nhận ngay
+      await worker_a.publish_membership("group-1", removed=["user-1"])
+      frame = json.loads(await asyncio.wait_for(websocket.frames.get(), timeout=5))
+      assert frame == {"action": "unsubscribed", "conversation_id": "group-1"}
+      assert "group-1" not in connection.conversations
+
+      await worker_a.broadcast({"action": "send", "content": "bí mật"}, "group-1")
+      await asyncio.sleep(0.5)
+      assert websocket.frames.empty()
+
+      # Được thêm vào group khác qua worker A: socket ở worker B bắt đầu nhận
+      await worker_a.publish_membership("group-2", added=["user-1"])
+      frame = json.loads(await asyncio.wait_for(websocket.frames.get(), timeout=5))
+      assert frame == {"action": "subscribed", "conversation_id": "group-2"}
+      await worker_a.broadcast({"action": "send", "content": "chào mừng"}, "group-2")
+      frame = json.loads(await asyncio.wait_for(websocket.frames.get(), timeout=5))
+      assert frame["content"] == "chào mừng"
+    finally:
+      await worker_a.stop()
+      await worker_b.stop()
+
+  run(scenario())
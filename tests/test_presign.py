@@ -0,0 +1,74 @@
+from urllib.parse import parse_qs, urlparse
+from tests.conftest import auth
+
+
+def test_single_upload_url_signs_content_length(client, make_conversation):
+  [user_id], _ = make_conversation(1)
+  response = client.post(
+    "/bucket/presign/upload", json={"filename": "a.png", "size": 1234, "content_type": "image/png"}, headers=auth(user_id)
+  )
+  assert response.status_code == 200
+  query = parse_qs(urlparse(response.json()["url"]).query)
+  assert "content-length" in query["X-Amz-SignedHeaders"][0].split(";")
+
+
+def test_download_requires_ownership_or_membership(client, make_conversation):
+  from message.message_service import append_message
+  (sender, member), conversation_id = make_conversation(2)
+  [outsider], _ = make_conversation(1)
+  key = f"uploads/{sender}/file-id/a.png"
+
+  def download(user_id):
+    return client.get("/bucket/presign/download", params={"key": key}, headers=auth(user_id)).status_code
+
+  # Chưa gắn vào tin nhắn nào: chỉ người upload tải được
+  assert download(sender) == 200
+  assert download(member) == 404
+
+  async def attach():
+    return await append_message({
+      "conversation_id": conversation_id, "sender_id": sender, "content": None, "type": "image", "file_url": key
+    })
+
+  client.portal.call(attach)
+  assert download(member) == 200
+  assert download(outsider) == 404
+
+
+def test_foreign_upload_key_cannot_be_attached_or_downloaded(client, make_conversation):
+  from message.message_service import append_message
+  [victim], _ = make_conversation(1)
+  (attacker, accomplice), conversation_id = make_conversation(2)
+  key = f"uploads/{victim}/file-id/secret.pdf"
+
+  response = client.post("/message/send", json={
+    "conversation_id": conversation_id, "sender_id": attacker, "type": "file", "file_url": key
+  })
+  assert response.status_code == 403
+
+  # Kể cả khi một dòng như vậy đã có sẵn (dữ liệu cũ), nó không cấp quyền tải
+  async def attach():
+    return await append_message({
+      "conversation_id": conversation_id, "sender_id": attacker, "content": None, "type": "file", "file_url": key
+    })
+
+  client.portal.call(attach)
+  response = client.get("/bucket/presign/download", params={"key": key}, headers=auth(accomplice))
+  assert response.status_code == 404
+
+
+def test_cleanup_keeps_objects_still_referenced(client, make_conversation):
+  from bucket.s3 import public_url
+  from bucket.s3_cleanup import S3CleanupQueue
+  from message.message_service import append_message
+  (sender,), conversation_id = make_conversation(1)
+  shared, legacy, orphan = (f"uploads/{sender}/{name}/a.png" for name in ("shared", "legacy", "orphan"))
+
+  async def scenario():
+    for file_url in (shared, public_url(legacy)):
+      await append_message({
+        "conversation_id": conversation_id, "sender_id": sender, "content": None, "type": "image", "file_url": file_url
+      })
+    return await S3CleanupQueue()._referenced([shared, legacy, orphan])
+
+  assert client.portal.call(scenario) == {shared, legacy}
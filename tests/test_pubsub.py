@@ -0,0 +1,82 @@
+import asyncio
+from tests.conftest import run, make_engine, FakeWebSocket, make_worker
+
+
+def test_broadcast_reaches_other_worker(database_url):
+  async def scenario():
+    sender, receiver = make_worker(), make_worker()
+    await sender.start()
+    await receiver.start()
+    try:
+      websocket = FakeWebSocket()
+      await receiver.connect(websocket, "conversation-1")
+
+      await sender.broadcast({"action": "send", "content": "xin chào"}, "conversation-1")
+      frame = await asyncio.wait_for(websocket.frames.get(), timeout=5)
+      assert '"content":"xin chào"' in frame
+
+      # Lớn hơn giới hạn 8000 byte của NOTIFY, ký tự nhiều byte: phải được cắt rồi ghép lại nguyên vẹn
+      content = "tin nhắn dài " * 3000
+      await sender.broadcast({"action": "send", "content": content}, "conversation-1")
+      frame = await asyncio.wait_for(websocket.frames.get(), timeout=5)
+      assert content in frame
+      assert sender.pubsub.chunked_frames == 1
+      assert sender.publish_failures == 0
+    finally:
+      await sender.stop()
+      await receiver.stop()
+
+  run(scenario())
+
+
+def test_listener_reconnects_and_forces_resync(database_url):
+  async def scenario():
+    sender, receiver = make_worker(), make_worker(heartbeat=0.2)
+    await sender.start()
+    await receiver.start()
+    try:
+      stale = FakeWebSocket()
+      await receiver.connect(stale, "conversation-2")
+
+      # Giả lập mất kết nối (Neon autosuspend, rớt mạng): giết backend đang LISTEN
+      pid = receiver.pubsub._driver_conn.get_server_pid()
+      async with make_engine().connect() as conn:
+        await conn.exec_driver_sql(f"SELECT pg_terminate_backend({pid})")
+
+      for _ in range(50):
+        if receiver.pubsub.reconnects:
+          break
+        await asyncio.sleep(0.1)
+      assert receiver.pubsub.reconnects == 1
+      await asyncio.sleep(0.1)
+      # Socket cũ có thể đã lỡ sự kiện nên bị đóng với mã resync
+      assert stale.close_code == 1013
+
+      websocket = FakeWebSocket()
+      await receiver.connect(websocket, "conversation-2")
+      await sender.broadcast({"action": "send", "content": "sau khi nối lại"}, "conversation-2")
+      frame = await asyncio.wait_for(websocket.frames.get(), timeout=5)
+      assert "sau khi nối lại" in frame
+    finally:
+      await sender.stop()
+      await receiver.stop()
+
+  run(scenario())
+
+
+def test_control_message_reaches_other_worker(database_url):
+  async def scenario():
+    worker_a, worker_b = make_worker(), make_worker()
+    received = asyncio.Queue()
+    worker_a.add_control_handler("#test", lambda payload: None)
+    worker_b.add_control_handler("#test", received.put_nowait)
+    await worker_a.start()
+    await worker_b.start()
+    try:
+      await worker_a.publish_control("#test", {"user_id": "user-1"})
+      assert await asyncio.wait_for(received.get(), timeout=5) == {"user_id": "user-1"}
+    finally:
+      await worker_a.stop()
+      await worker_b.stop()
+
+  run(scenario())
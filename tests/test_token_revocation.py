@@ -0,0 +1,60 @@
+import time
+import uuid
+from tests.conftest import run, make_engine, auth
+
+
+def test_token_of_deleted_user_is_rejected(client):
+  email = f"{uuid.uuid4()}@test.local"
+  response = client.post("/user/signup", json={"username": "revoked", "email": email, "password": "secret123"})
+  assert response.status_code == 200
+  headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+  # Lần đầu token còn hợp lệ và được cache
+  assert client.get("/friend/friends", headers=headers).status_code == 200
+
+  assert client.delete(f"/user/{email}").status_code == 200
+  response = client.get("/friend/friends", headers=headers)
+  assert response.status_code == 401
+
+
+def test_deleted_user_is_gone_before_purge_finishes(client):
+  email = f"{uuid.uuid4()}@test.local"
+  client.post("/user/signup", json={"username": "gone", "email": email, "password": "secret123"})
+
+  assert client.delete(f"/user/{email}").status_code == 200
+  # Đánh dấu nằm trong DB ngay khi request trả về, không phụ thuộc purge ở nền
+  assert client.post("/user/signin", json={"email": email, "password": "secret123"}).status_code == 404
+  assert client.get(f"/user/info-email/{email}").status_code != 200
+  response = client.post("/user/signup", json={"username": "again", "email": email, "password": "secret123"})
+  assert response.status_code == 200
+
+
+def test_restart_restores_revocation_and_pending_purge(client, make_conversation):
+  from sqlalchemy import select
+  from models.models import DeletedUser, User
+  from user.user_controller import revoked_users, restore_deleted_users
+  [user_id], _ = make_conversation(1)
+
+  # Tiến trình dừng ngay sau khi commit đánh dấu xoá: bộ nhớ trống, purge chưa chạy
+  async def crash_after_mark():
+    engine = make_engine()
+    async with engine.begin() as conn:
+      await conn.execute(DeletedUser.__table__.insert().values(user_id=user_id))
+    await engine.dispose()
+
+  run(crash_after_mark())
+  revoked_users.clear()
+  client.portal.call(restore_deleted_users)
+  assert client.get("/friend/friends", headers=auth(user_id)).status_code == 401
+
+  async def user_exists():
+    engine = make_engine()
+    async with engine.connect() as conn:
+      row = (await conn.execute(select(User.id).where(User.id == user_id))).first()
+    await engine.dispose()
+    return row is not None
+
+  deadline = time.monotonic() + 10
+  while run(user_exists()) and time.monotonic() < deadline:
+    time.sleep(0.1)
+  assert not run(user_exists())
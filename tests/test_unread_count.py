@@ -0,0 +1,65 @@
+import asyncio
+
+
+def test_unread_count_ignores_own_messages_deletes_and_history(client, make_conversation):
+  from database import AsyncSessionLocal
+  from message.message_service import append_message, delete_message
+  from conversation.membership import add_participants
+  user_ids, conversation_id = make_conversation(3)
+  sender, reader, _ = user_ids
+
+  async def send(content):
+    return await append_message({
+      "conversation_id": conversation_id, "sender_id": sender, "content": content, "type": "text", "file_url": None
+    })
+
+  client.portal.call(send, "một")
+  second = client.portal.call(send, "hai")
+  client.portal.call(delete_message, second["id"], conversation_id)
+
+  # Người vào sau không tính lịch sử trước đó là chưa đọc
+  newcomer = make_conversation(1)[0][0]
+
+  async def join():
+    async with AsyncSessionLocal() as db:
+      added = await add_participants(db, conversation_id, [newcomer])
+      await db.commit()
+      return added
+
+  assert client.portal.call(join) == [newcomer]
+
+  def unread(user_id):
+    response = client.get(f"/user/{user_id}@test.local/inbox")
+    assert response.status_code == 200
+    [conversation] = [item for item in response.json()["conversations"] if item["id"] == conversation_id]
+    return conversation["unread_count"]
+
+  assert unread(sender) == 0
+  assert unread(reader) == 1
+  assert unread(newcomer) == 0
+
+
+def test_write_pipeline_advances_sender_read_pointer(client, make_conversation):
+  from message.write_pipeline import MessageWritePipeline
+  user_ids, conversation_id = make_conversation(2)
+  sender, reader = user_ids
+
+  async def send_batch():
+    pipeline = MessageWritePipeline()
+    await pipeline.start()
+    try:
+      # Gửi đồng thời để cả ba rơi vào cùng một lô
+      await asyncio.gather(*(
+        pipeline.submit({
+          "conversation_id": conversation_id, "sender_id": sender, "content": content, "type": "text", "file_url": None
+        })
+        for content in ("một", "hai", "ba")
+      ))
+    finally:
+      await pipeline.stop()
+
+  client.portal.call(send_batch)
+  response = client.get(f"/user/{sender}@test.local/inbox")
+  assert response.json()["conversations"][0]["unread_count"] == 0
+  response = client.get(f"/user/{reader}@test.local/inbox")
+  assert response.json()["conversations"][0]["unread_count"] == 3
@@ -0,0 +1,122 @@
+"""Upload qua /bucket/upload/ tới S3 giả lập (moto): RSS đỉnh của server không tăng theo kích thước file,
+file vượt giới hạn bị từ chối trước / trong khi nhận body.
+
+Server chạy bằng uvicorn trong tiến trình con để RSS chỉ gồm app; moto chạy trong tiến trình test.
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+import pytest
+
+moto_server = pytest.importorskip("moto.server")
+httpx = pytest.importorskip("httpx")
+
+UPLOAD_MAX_MB = 128
+BOUNDARY = "ott-test-boundary"
+
+
+def free_port() -> int:
+  with socket.socket() as sock:
+    sock.bind(("127.0.0.1", 0))
+    return sock.getsockname()[1]
+
+
+def peak_rss_mb(pid: int) -> float:
+  with open(f"/proc/{pid}/status") as status:
+    for line in status:
+      if line.startswith("VmHWM:"):
+        return int(line.split()[1]) / 1024
+  raise RuntimeError("VmHWM not found")
+
+
+FORM_HEAD = (
+  f"--{BOUNDARY}\r\n"
+  f'Content-Disposition: form-data; name="file"; filename="big.bin"\r\n'
+  f"Content-Type: application/octet-stream\r\n\r\n"
+).encode()
+FORM_TAIL = f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+def multipart_body(size: int, chunk: int = 1024 * 1024):
+  # Sinh body theo từng khối để chính client cũng không giữ cả file trong RAM
+  yield FORM_HEAD
+  block = b"\0" * chunk
+  for start in range(0, size, chunk):
+    yield block[:min(chunk, size - start)]
+  yield FORM_TAIL
+
+
+@pytest.fixture(scope="module")
+def upload_server(database_url):
+  if not os.path.exists("/proc/self/status"):
+    pytest.skip("peak RSS is read from /proc")
+  import boto3
+  s3_port, app_port = free_port(), free_port()
+  s3 = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=s3_port)
+  s3.start()
+  endpoint = f"http://127.0.0.1:{s3_port}"
+  boto3.client(
+    "s3", endpoint_url=endpoint, region_name=os.environ["AWS_REGION"],
+    aws_access_key_id="test", aws_secret_access_key="test"
+  ).create_bucket(Bucket="ott-upload-test", CreateBucketConfiguration={"LocationConstraint": os.environ["AWS_REGION"]})
+
+  env = {
+    **os.environ,
+    "DATABASE_URL": database_url,
+    "AWS_S3_ENDPOINT_URL": endpoint,
+    "S3_BUCKET_NAME": "ott-upload-test",
+    "UPLOAD_MAX_MB": str(UPLOAD_MAX_MB)
+  }
+  server = subprocess.Popen(
+    [sys.executable, "-m", "uvicorn", "main:app", "--port", str(app_port)],
+    env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+  )
+  base_url = f"http://127.0.0.1:{app_port}"
+  try:
+    deadline = time.monotonic() + 30
+    while True:
+      try:
+        httpx.get(f"{base_url}/health")
+        break
+      except httpx.TransportError:
+        if time.monotonic() > deadline or server.poll() is not None:
+          raise RuntimeError("uvicorn did not start")
+        time.sleep(0.2)
+    yield server.pid, base_url
+  finally:
+    server.terminate()
+    server.wait(10)
+    s3.stop()
+
+
+def upload(base_url: str, size: int, declare_length: bool = False):
+  headers = {"Content-Type": f"multipart/form-data; boundary={BOUNDARY}"}
+  if declare_length:
+    headers["Content-Length"] = str(len(FORM_HEAD) + size + len(FORM_TAIL))
+  return httpx.post(f"{base_url}/bucket/upload/", content=multipart_body(size), headers=headers, timeout=120)
+
+
+def test_upload_peak_rss_does_not_grow_with_file_size(upload_server):
+  pid, base_url = upload_server
+  # Một upload nhỏ để nạp hết module / kết nối trước khi lấy mốc
+  assert upload(base_url, 1024 * 1024).json()["filename"] == "big.bin"
+  baseline = peak_rss_mb(pid)
+
+  size_mb = 100
+  response = upload(base_url, size_mb * 1024 * 1024)
+  assert response.status_code == 200 and "error" not in response.json()
+  growth = peak_rss_mb(pid) - baseline
+  print(f"peak RSS {baseline:.0f} MB -> +{growth:.1f} MB cho file {size_mb} MB")
+  # Bộ đệm upload khoảng max_concurrency * UPLOAD_PART_SIZE (2 * 8 MB) cộng spool của form
+  assert growth < 48
+
+
+def test_oversized_upload_is_rejected_while_receiving(upload_server):
+  _, base_url = upload_server
+  too_big = (UPLOAD_MAX_MB + 16) * 1024 * 1024
+  # Khai Content-Length: từ chối trước khi nhận body
+  assert upload(base_url, too_big, declare_length=True).status_code == 413
+  # Chunked, không khai kích thước: từ chối khi vượt giới hạn trong lúc nhận
+  assert upload(base_url, too_big).status_code == 413
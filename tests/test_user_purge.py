@@ -0,0 +1,53 @@
+import time
+from tests.conftest import run, make_engine
+
+
+def test_deleting_user_leaves_tombstones_in_group(client, make_conversation):
+  from sqlalchemy import select
+  from message.message_service import append_message
+  from models.models import Conversation, DeletedMessage, Message, User
+  user_ids, conversation_id = make_conversation(3)
+  creator, other, _ = user_ids
+
+  async def send(sender_id, content):
+    return await append_message({
+      "conversation_id": conversation_id, "sender_id": sender_id, "content": content, "type": "text", "file_url": None
+    })
+
+  first = client.portal.call(send, creator, "một")
+  kept = client.portal.call(send, other, "hai")
+  last = client.portal.call(send, creator, "ba")
+
+  # Người tạo group bị xoá: created_by không được chặn câu DELETE cuối cùng
+  response = client.delete(f"/user/{creator}@test.local")
+  assert response.status_code == 200
+
+  async def load():
+    engine = make_engine()
+    async with engine.connect() as conn:
+      user = (await conn.execute(select(User.id).where(User.id == creator))).first()
+      conversation = (await conn.execute(select(Conversation).where(Conversation.id == conversation_id))).one()
+      message_ids = (await conn.execute(select(Message.id).where(Message.conversation_id == conversation_id))).scalars().all()
+      tombstones = (await conn.execute(
+        select(DeletedMessage.message_id, DeletedMessage.seq).where(DeletedMessage.conversation_id == conversation_id)
+      )).all()
+    await engine.dispose()
+    return user, conversation, message_ids, tombstones
+
+  deadline = time.monotonic() + 10
+  while True:
+    user, conversation, message_ids, tombstones = run(load())
+    if user is None or time.monotonic() > deadline:
+      break
+    time.sleep(0.1)
+
+  assert user is None
+  assert conversation.created_by is None
+  assert message_ids == [kept["id"]]
+  assert conversation.last_message_id == kept["id"]
+  assert conversation.last_seq == 5
+  assert sorted(tombstones, key=lambda row: row.seq) == [(first["id"], 4), (last["id"], 5)]
+
+  # Client đồng bộ theo seq thấy được hai sự kiện xoá
+  response = client.get(f"/message/{conversation_id}/sync", params={"after_seq": 3})
+  assert [event["action"] for event in response.json()["events"]] == ["delete", "delete"]
@@ -0,0 +1,37 @@
+import asyncio
+from tests.conftest import run
+
+
+def test_stop_waits_for_in_flight_batch_and_drains_queue():
+  from message.write_pipeline import MessageWritePipeline
+  pipeline = MessageWritePipeline()
+  writing = asyncio.Event()
+  written = []
+
+  async def slow_write(rows):
+    # Giả lập transaction đang chạy dở lúc có lệnh dừng
+    writing.set()
+    await asyncio.sleep(0.05)
+    written.extend(row["content"] for row in rows)
+
+  pipeline._write = slow_write
+
+  def submit(content):
+    return asyncio.create_task(pipeline.submit({
+      "conversation_id": "c", "sender_id": "u", "content": content, "type": "text", "file_url": None
+    }))
+
+  async def scenario():
+    await pipeline.start()
+    first = submit("một")
+    await writing.wait()
+    # Lô đầu đang ghi; hai tin sau còn trong hàng đợi khi stop() được gọi
+    later = [submit("hai"), submit("ba")]
+    await asyncio.sleep(0)
+    await pipeline.stop()
+    results = await asyncio.wait_for(asyncio.gather(first, *later), timeout=1)
+    assert [row["content"] for row in results] == ["một", "hai", "ba"]
+    assert written == ["một", "hai", "ba"]
+    assert pipeline.task is None
+
+  run(scenario())
@@ -0,0 +1,54 @@
+import os
+import time
+from contextlib import ExitStack
+import pytest
+
+# Số socket mở cùng lúc, vượt xa sức chứa pool (mặc định 1.000)
+WS_SOCKETS = int(os.getenv("TEST_WS_SOCKETS", "1000"))
+REST_REQUESTS = 100
+
+
+def percentile(values, fraction):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+@pytest.mark.parametrize("sockets", [WS_SOCKETS])
+def test_idle_websockets_do_not_hold_pool_connections(client, make_conversation, sockets):
+  """Nhiều socket hơn sức chứa pool vẫn gửi được tin và REST không bị nghẽn pool."""
+  from database import engine
+  (sender_id, _), conversation_id = make_conversation()
+  pool = engine.sync_engine.pool
+  assert sockets > pool.size() + pool._max_overflow
+
+  with ExitStack() as stack:
+    websockets = [
+      stack.enter_context(client.websocket_connect(f"/message/ws?conversation_id={conversation_id}"))
+      for _ in range(sockets)
+    ]
+    websockets[0].send_json({
+      "action": "send",
+      "conversation_id": conversation_id,
+      "sender_id": sender_id,
+      "content": "hello",
+      "type": "text",
+      "file_url": None
+    })
+    for websocket in websockets:
+      frame = websocket.receive_json()
+      assert frame["action"] == "send"
+      assert frame["content"] == "hello"
+
+    # Socket rảnh không giữ kết nối nào của pool
+    assert pool.checkedout() == 0
+
+    latencies = []
+    for _ in range(REST_REQUESTS):
+      started = time.perf_counter()
+      response = client.get(f"/message/{conversation_id}")
+      latencies.append(time.perf_counter() - started)
+      assert response.status_code == 200
+      assert [message["content"] for message in response.json()["messages"]] == ["hello"]
+    # Pool cạn sẽ làm request chờ tới pool_timeout (30 giây)
+    p99 = percentile(latencies, 0.99)
+    assert p99 < 0.5, f"REST p99 {p99 * 1000:.0f} ms với {sockets} socket mở"
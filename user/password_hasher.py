@@ -0,0 +1,77 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException, status
+from models.models import pwd_context
+
+# bcrypt nhả GIL khi hash nên một thread pool nhỏ là đủ để không chặn event loop
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+# Số lời gọi được nhận cùng lúc (đang chạy + đang chờ thread của pool)
+PASSWORD_HASH_CONCURRENCY = int(os.getenv("PASSWORD_HASH_CONCURRENCY", str(PASSWORD_HASH_WORKERS * 2)))
+# Thời gian một lời gọi được chờ chỗ trống trước khi bị từ chối với 503
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT_MS", "2000")) / 1000
+
+
+class PasswordHasher:
+  """Chạy bcrypt của passlib trong thread pool riêng với số lời gọi đồng thời có giới hạn.
+
+  Khi pool bận lâu hơn PASSWORD_HASH_QUEUE_TIMEOUT, lời gọi trả 503 ngay thay vì
+  dồn ứ phía sau một đợt đăng nhập.
+  """
+
+  def __init__(self):
+    self.executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+    self.semaphore = asyncio.Semaphore(PASSWORD_HASH_CONCURRENCY)
+    self.in_flight = 0
+    self.completed = 0
+    self.shed = 0
+    self.rehashed = 0
+    self.total_seconds = 0.0
+
+  async def _run(self, func, *args):
+    try:
+      await asyncio.wait_for(self.semaphore.acquire(), timeout=PASSWORD_HASH_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+      self.shed += 1
+      raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server is busy, please retry",
+        headers={"Retry-After": "1"}
+      )
+    self.in_flight += 1
+    started = time.perf_counter()
+    try:
+      return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+    finally:
+      self.in_flight -= 1
+      self.completed += 1
+      self.total_seconds += time.perf_counter() - started
+      self.semaphore.release()
+
+  async def hash(self, raw_password: str) -> str:
+    return await self._run(pwd_context.hash, raw_password)
+
+  async def verify_and_update(self, raw_password: str, hashed: str):
+    """Trả về (valid, new_hash); new_hash khác None khi hash đã lưu dùng tham số cũ."""
+    valid, new_hash = await self._run(pwd_context.verify_and_update, raw_password, hashed)
+    if new_hash:
+      self.rehashed += 1
+    return valid, new_hash
+
+  def shutdown(self):
+    self.executor.shutdown(wait=False, cancel_futures=True)
+
+  def stats(self) -> dict:
+    return {
+      "workers": PASSWORD_HASH_WORKERS,
+      "concurrency": PASSWORD_HASH_CONCURRENCY,
+      "in_flight": self.in_flight,
+      "completed": self.completed,
+      "shed": self.shed,
+      "rehashed": self.rehashed,
+      "avg_ms": self.total_seconds * 1000 / self.completed if self.completed else 0.0
+    }
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,99 @@
+import asyncio
+from typing import Dict, Iterable, List, Optional
+from sqlalchemy import exists
+from sqlalchemy.future import select
+from database import AsyncSessionLocal
+from models.models import DeletedUser, User
+from utils.cache import TTLCache
+
+# Chỉ các cột công khai: không bao giờ chọn hash mật khẩu
+PROFILE_COLUMNS = (User.id, User.username, User.email, User.avatar_url, User.created_at)
+
+
+class ProfileLoader:
+  """Tra profile công khai của user theo kiểu DataLoader.
+
+  Mọi load() gọi trong cùng một vòng event loop được gộp thành một câu
+  `WHERE id IN (...)`; kết quả nằm trong cache TTL ngắn, bị xoá khi các
+  endpoint cập nhật user chạy.
+  """
+
+  def __init__(self, maxsize: int = 10000, ttl: float = 30):
+    self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+    self.pending: Dict[str, asyncio.Future] = {}
+    self.batches = 0
+    self._tasks = set()
+
+  async def load(self, user_id: str) -> Optional[dict]:
+    profiles = await self.load_many([user_id])
+    return profiles.get(user_id)
+
+  async def load_many(self, user_ids: Iterable[str]) -> Dict[str, dict]:
+    """Trả về user_id -> profile cho các id tồn tại."""
+    profiles = {}
+    waiting = {}
+    for user_id in set(user_ids):
+      profile = self.cache.get(user_id)
+      if profile is not None:
+        profiles[user_id] = profile
+      else:
+        waiting[user_id] = self._enqueue(user_id)
+    for user_id, future in waiting.items():
+      # shield: người gọi bị huỷ không được huỷ luôn future dùng chung với người gọi khác
+      profile = await asyncio.shield(future)
+      if profile is not None:
+        profiles[user_id] = profile
+    return profiles
+
+  def _enqueue(self, user_id: str) -> asyncio.Future:
+    future = self.pending.get(user_id)
+    if future is None:
+      loop = asyncio.get_running_loop()
+      if not self.pending:
+        # Lần miss đầu tiên của vòng này: flush sau khi các người gọi khác kịp xếp hàng
+        loop.call_soon(self._start_flush)
+      future = self.pending[user_id] = loop.create_future()
+    return future
+
+  def _start_flush(self):
+    # Giữ tham chiếu tới task: event loop chỉ giữ tham chiếu yếu nên task có thể bị thu hồi giữa chừng
+    task = asyncio.create_task(self._flush())
+    self._tasks.add(task)
+    task.add_done_callback(self._tasks.discard)
+
+  async def _flush(self):
+    batch, self.pending = self.pending, {}
+    self.batches += 1
+    try:
+      async with AsyncSessionLocal() as db:
+        result = await db.execute(select(*PROFILE_COLUMNS).where(
+          User.id.in_(list(batch)),
+          # User đã xoá nhưng purge chưa xong
+          ~exists().where(DeletedUser.user_id == User.id)
+        ))
+        rows = {row.id: dict(row._mapping) for row in result.all()}
+    except Exception as e:
+      for future in batch.values():
+        if not future.done():
+          future.set_exception(e)
+      return
+    for user_id, future in batch.items():
+      profile = rows.get(user_id)
+      if profile is not None:
+        self.cache.set(user_id, profile)
+      if not future.done():
+        future.set_result(profile)
+
+  def invalidate(self, user_id: str):
+    self.cache.invalidate(user_id)
+
+  def stats(self) -> dict:
+    return {**self.cache.stats(), "batches": self.batches}
+
+
+profile_loader = ProfileLoader()
+
+
+def ordered_profiles(user_ids: List[str], profiles: Dict[str, dict]) -> List[dict]:
+  """Profile theo thứ tự yêu cầu, bỏ các id không tồn tại."""
+  return [profiles[user_id] for user_id in dict.fromkeys(user_ids) if user_id in profiles]
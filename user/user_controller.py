@@ -1,9 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Query
 from fastapi.security import OAuth2PasswordBearer, HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.ext.asyncio import AsyncSession
-from models.models import User, ConversationParticipant, Conversation
+from models.models import User, ConversationParticipant, Conversation, Message, Friendship, DeletedUser, get_vietnam_now
 from sqlalchemy.future import select
-from database import get_db
+from sqlalchemy import and_, or_, case, delete, exists, func, literal_column, tuple_, JSON
+from sqlalchemy.orm import aliased
+from database import get_db, AsyncSessionLocal
+from conversation.purge import purge_queue
+from user.password_hasher import password_hasher
+from user.profile_loader import profile_loader, ordered_profiles
+from friend.friend_graph import friend_graph
 from interface.interface import (
   INewUserData, 
   IUpdateUserAvatarData, 
@@ -12,11 +18,17 @@ from interface.interface import (
   IUpdateUserData
 )
 from datetime import timedelta
-from utils.utils import get_vn_time
+from typing import List, Optional
+import time
+from utils.utils import get_vn_time, encode_cursor, decode_cursor, encode_text_cursor, decode_text_cursor, escape_like
+from utils.cache import TTLCache
+from schemas.schemas import PublicProfile
+from message.connection_manager import manager
 import os
 from dotenv import load_dotenv
 load_dotenv()
 from authlib.jose import jwt
+from authlib.jose.errors import JoseError
 
 SECRET_KEY = "quoc_secret_key"
 
@@ -24,17 +36,105 @@ user_router = APIRouter()
 
 security = HTTPBearer()
 
-@user_router.get("/me")
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_db)):
+# Token hết hạn sau ngần ấy thời gian kể từ lúc đăng nhập / đăng ký
+ACCESS_TOKEN_LIFETIME = timedelta(hours=24)
+# token -> user_id đã xác thực, mỗi mục sống tối đa PRINCIPAL_CACHE_TTL giây và không quá exp của token
+PRINCIPAL_CACHE_TTL = 300
+principal_cache = TTLCache(maxsize=10000, ttl=PRINCIPAL_CACHE_TTL)
+token_decode_stats = {"count": 0, "total_seconds": 0.0}
+# user_id của user đã bị xoá: token cũ của họ bị từ chối cho tới khi chắc chắn đã hết hạn.
+# exp được tính từ giờ Việt Nam (naive, lệch +7 giờ so với UTC) nên giữ thêm 7 giờ.
+# Bảng deleted_users là bản ghi bền, tập này được nạp lại từ đó khi khởi động
+REVOKED_USER_TTL = ACCESS_TOKEN_LIFETIME + timedelta(hours=7)
+REVOKED_CHANNEL = "#revoked-users"
+revoked_users = TTLCache(maxsize=100000, ttl=REVOKED_USER_TTL.total_seconds())
+
+
+def decode_access_claims(token: str):
+  """Kiểm tra chữ ký và exp của bearer token, trả về claims."""
+  started = time.perf_counter()
   try: 
-    token = credentials.credentials
     # payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-    payload = jwt.decode(token, SECRET_KEY)
-    user_id: str = payload.get("sub")
-    if user_id is None:
-      raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token: no user id", headers={"WWW-Authenticate": "Bearer"})
-  except jwt.PyJWTError:
+    claims = jwt.decode(token, SECRET_KEY)
+    claims.validate()
+  except JoseError:
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials", headers={"WWW-Authenticate": "Bearer"})
+  finally:
+    token_decode_stats["count"] += 1
+    token_decode_stats["total_seconds"] += time.perf_counter() - started
+  if claims.get("sub") is None:
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token: no user id", headers={"WWW-Authenticate": "Bearer"})
+  return claims
+
+
+def decode_access_token(token: str) -> str:
+  """Kiểm tra bearer token và trả về user id (sub), không truy vấn DB."""
+  user_id = principal_cache.get(token)
+  if user_id is None:
+    claims = decode_access_claims(token)
+    user_id = claims["sub"]
+    ttl = min(PRINCIPAL_CACHE_TTL, claims["exp"] - time.time()) if claims.get("exp") else PRINCIPAL_CACHE_TTL
+    if ttl > 0:
+      principal_cache.set(token, user_id, ttl=ttl)
+  if revoked_users.get(user_id) is not None:
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User no longer exists", headers={"WWW-Authenticate": "Bearer"})
+  return user_id
+
+
+async def get_current_user_id(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
+  """Cho các endpoint chỉ cần id của người gọi: không truy vấn DB."""
+  return decode_access_token(credentials.credentials)
+
+
+def invalidate_principal(user_id: str):
+  """Bỏ mọi token đã cache của user sau khi dòng user thay đổi."""
+  principal_cache.invalidate_where(lambda cached_user_id: cached_user_id == user_id)
+
+
+def apply_revocation(payload: dict):
+  revoked_users.set(payload["user_id"], True)
+  invalidate_principal(payload["user_id"])
+
+
+# Worker nào xoá user cũng báo cho mọi worker khác qua kênh điều khiển của pub/sub
+manager.add_control_handler(REVOKED_CHANNEL, apply_revocation)
+
+
+async def revoke_user(user_id: str):
+  await manager.publish_control(REVOKED_CHANNEL, {"user_id": user_id})
+
+
+async def restore_deleted_users():
+  """Gọi khi khởi động: nạp lại các user đã xoá mà token có thể còn hạn và xếp lại purge chưa xong
+  (dòng users còn tồn tại). Dòng deleted_users đã quá hạn và đã purge xong được dọn luôn."""
+  now = get_vietnam_now()
+  purge_pending = exists().where(User.id == DeletedUser.user_id)
+  async with AsyncSessionLocal() as db:
+    await db.execute(delete(DeletedUser).where(DeletedUser.deleted_at < now - REVOKED_USER_TTL, ~purge_pending))
+    result = await db.execute(select(DeletedUser.user_id, DeletedUser.deleted_at, purge_pending.label("purge_pending")))
+    rows = result.all()
+    await db.commit()
+  for row in rows:
+    ttl = (row.deleted_at + REVOKED_USER_TTL - now).total_seconds()
+    if ttl > 0:
+      revoked_users.set(row.user_id, True, ttl=ttl)
+    if row.purge_pending:
+      purge_queue.purge_user(row.user_id)
+
+
+def principal_stats() -> dict:
+  count = token_decode_stats["count"]
+  return {
+    **principal_cache.stats(),
+    "token_decodes": count,
+    "avg_decode_ms": token_decode_stats["total_seconds"] * 1000 / count if count else 0.0,
+    "revoked_users": revoked_users.stats()["size"]
+  }
+
+
+@user_router.get("/me")
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_db)):
+  user_id = decode_access_token(credentials.credentials)
   
   result = await db.execute(select(User).where(User.id == user_id))
   user = result.scalars().first()
@@ -66,11 +166,101 @@ async def get_user_by_email(email: str, db: AsyncSession = Depends(get_db)):
     raise HTTPException(status_code=500, detail="Internal Server Error")
 
 
-@user_router.get("/info-id/{user_id}")
-async def get_user_by_id(user_id: str, db: AsyncSession = Depends(get_db)):
-  result = await db.execute(select(User).where(User.id == user_id))
-  user = result.scalars().first()
-  return user
+# Số id tối đa /profiles nhận trong một lần gọi
+PROFILE_BATCH_LIMIT = 100
+
+
+@user_router.get("/profiles", response_model=List[PublicProfile])
+async def get_user_profiles(ids: str = Query(..., description="Comma-separated user ids")):
+  """Profile công khai của một loạt user id theo thứ tự yêu cầu, bỏ qua id không tồn tại."""
+  user_ids = [user_id for user_id in (part.strip() for part in ids.split(",")) if user_id]
+  if len(user_ids) > PROFILE_BATCH_LIMIT:
+    raise HTTPException(status_code=400, detail=f"At most {PROFILE_BATCH_LIMIT} ids per request")
+  profiles = await profile_loader.load_many(user_ids)
+  return ordered_profiles(user_ids, profiles)
+
+
+@user_router.get("/info-id/{user_id}", response_model=Optional[PublicProfile])
+async def get_user_by_id(user_id: str):
+  return await profile_loader.load(user_id)
+
+
+@user_router.get("/search")
+async def search_users(
+  q: str = Query(..., min_length=2, max_length=100),
+  match: str = Query("substring", pattern="^(prefix|substring)$"),
+  cursor: Optional[str] = None,
+  limit: int = Query(20, ge=1, le=50),
+  db: AsyncSession = Depends(get_db),
+  current_user_id: str = Depends(get_current_user_id)
+):
+  """Tìm theo username và email không phân biệt hoa thường, sắp theo username.
+  Mỗi kết quả kèm quan hệ bạn bè với người gọi (None nếu chưa có).
+  params: match là prefix hoặc substring; cursor là next_cursor của trang trước"""
+  try:
+    position = decode_text_cursor(cursor) if cursor else None
+  except ValueError:
+    raise HTTPException(status_code=400, detail="Invalid cursor")
+
+  # Dùng index GIN pg_trgm trên lower(username) / lower(email)
+  term = escape_like(q.strip().lower())
+  pattern = f"{term}%" if match == "prefix" else f"%{term}%"
+  username_key = func.lower(User.username)
+
+  stmt = (
+    select(
+      User.id,
+      User.username,
+      User.email,
+      User.avatar_url,
+      username_key.label("sort_key"),
+      Friendship.id.label("friendship_id"),
+      Friendship.status.label("friendship_status"),
+      case((Friendship.requester_id == current_user_id, "outgoing"), else_="incoming").label("friendship_direction")
+    )
+    .outerjoin(
+      Friendship,
+      or_(
+        and_(Friendship.requester_id == current_user_id, Friendship.receiver_id == User.id),
+        and_(Friendship.requester_id == User.id, Friendship.receiver_id == current_user_id)
+      )
+    )
+    .where(
+      or_(username_key.like(pattern, escape="\\"), func.lower(User.email).like(pattern, escape="\\")),
+      User.id != current_user_id,
+      ~exists().where(DeletedUser.user_id == User.id)
+    )
+    .order_by(username_key, User.id)
+    .limit(limit + 1)
+  )
+  if position:
+    stmt = stmt.where(tuple_(username_key, User.id) > tuple_(*position))
+
+  result = await db.execute(stmt)
+  rows = result.all()
+  has_more = len(rows) > limit
+  rows = rows[:limit]
+
+  users = [
+    {
+      "id": row.id,
+      "username": row.username,
+      "email": row.email,
+      "avatar_url": row.avatar_url,
+      "friendship": {
+        "id": row.friendship_id,
+        "status": row.friendship_status,
+        "direction": row.friendship_direction
+      } if row.friendship_id else None
+    }
+    for row in rows
+  ]
+
+  return {
+    "users": users,
+    "next_cursor": encode_text_cursor(rows[-1].sort_key, rows[-1].id) if has_more else None,
+    "has_more": has_more
+  }
 
 
 @user_router.get("/{email}/conversations")
@@ -97,6 +287,121 @@ async def get_user_conversations(email: str, db: AsyncSession = Depends(get_db))
   return conversations
 
 
+@user_router.get("/{email}/inbox")
+async def get_user_inbox(
+  email: str,
+  cursor: Optional[str] = None,
+  limit: int = Query(20, ge=1, le=100),
+  db: AsyncSession = Depends(get_db)
+):
+  """Các conversation của user, hoạt động mới nhất trước, kèm tin nhắn cuối,
+  tóm tắt participants và số tin chưa đọc, trong một câu truy vấn.
+  params: cursor là next_cursor của trang trước"""
+  try:
+    position = decode_cursor(cursor) if cursor else None
+  except ValueError:
+    raise HTTPException(status_code=400, detail="Invalid cursor")
+
+  me = aliased(ConversationParticipant)
+  member = aliased(ConversationParticipant)
+  last_message = aliased(Message)
+
+  participants = (
+    select(
+      func.coalesce(
+        func.json_agg(
+          func.json_build_object(
+            "id", User.id,
+            "username", User.username,
+            "email", User.email,
+            "avatar_url", User.avatar_url
+          )
+        ),
+        literal_column("'[]'::json"),
+        type_=JSON
+      )
+    )
+    .select_from(member)
+    .join(User, User.id == member.user_id)
+    .where(member.conversation_id == Conversation.id)
+    .correlate(Conversation)
+    .scalar_subquery()
+  )
+
+  # Chỉ đếm tin nhắn còn tồn tại sau con trỏ đã đọc, sự kiện xoá (tombstone) không tính
+  unread_count = (
+    select(func.count(Message.id))
+    .where(Message.conversation_id == Conversation.id, Message.seq > me.last_read_seq)
+    .correlate(Conversation, me)
+    .scalar_subquery()
+  )
+
+  stmt = (
+    select(
+      Conversation,
+      last_message.id.label("last_message_id"),
+      last_message.sender_id.label("last_message_sender_id"),
+      last_message.content.label("last_message_content"),
+      last_message.type.label("last_message_type"),
+      last_message.created_at.label("last_message_created_at"),
+      participants.label("participants"),
+      unread_count.label("unread_count")
+    )
+    .select_from(Conversation)
+    .join(
+      me,
+      and_(
+        me.conversation_id == Conversation.id,
+        me.user_id == select(User.id).where(User.email == email).scalar_subquery()
+      )
+    )
+    .outerjoin(last_message, last_message.id == Conversation.last_message_id)
+    .order_by(Conversation.updated_at.desc(), Conversation.id.desc())
+    .limit(limit + 1)
+  )
+  if position:
+    stmt = stmt.where(tuple_(Conversation.updated_at, Conversation.id) < tuple_(*position))
+
+  result = await db.execute(stmt)
+  rows = result.all()
+  has_more = len(rows) > limit
+  rows = rows[:limit]
+
+  conversations = []
+  for row in rows:
+    conversation = row.Conversation
+    conversations.append({
+      "id": conversation.id,
+      "name": conversation.name,
+      "type": conversation.type,
+      "avatar_url": conversation.avatar_url,
+      "created_by": conversation.created_by,
+      "created_at": conversation.created_at,
+      "updated_at": conversation.updated_at,
+      "last_seq": conversation.last_seq,
+      "last_message": {
+        "id": row.last_message_id,
+        "sender_id": row.last_message_sender_id,
+        "content": row.last_message_content,
+        "type": row.last_message_type,
+        "created_at": row.last_message_created_at
+      } if row.last_message_id else None,
+      "participants": row.participants,
+      "unread_count": row.unread_count
+    })
+
+  next_cursor = None
+  if has_more:
+    edge = rows[-1].Conversation
+    next_cursor = encode_cursor(edge.updated_at, edge.id)
+
+  return {
+    "conversations": conversations,
+    "next_cursor": next_cursor,
+    "has_more": has_more
+  }
+
+
 @user_router.post("/signup")
 async def create_new_user(data: INewUserData, db: AsyncSession = Depends(get_db)):
   existing_user = await db.execute(select(User).where(User.email == data.email))
@@ -106,9 +411,8 @@ async def create_new_user(data: INewUserData, db: AsyncSession = Depends(get_db)
   new_user = User(
     username=data.username,
     email=data.email,
-    password=data.password
+    password=await password_hasher.hash(data.password)
   )
-  new_user.set_password(new_user.password)
   db.add(new_user)
   await db.commit()
   await db.refresh(new_user)
@@ -116,7 +420,7 @@ async def create_new_user(data: INewUserData, db: AsyncSession = Depends(get_db)
   payload = {
     "sub": new_user.id,
     "email": new_user.email,
-    "exp": await get_vn_time() + timedelta(hours=24)
+    "exp": await get_vn_time() + ACCESS_TOKEN_LIFETIME
   }
   
   # token = jwt.encode(payload, SECRET_KEY, algorithm="HS256")
@@ -167,13 +471,18 @@ async def login(data: ILoginUserData, db: AsyncSession = Depends(get_db)):
   if not user:
     raise HTTPException(status_code=404, detail="User is not existed!")
 
-  if not user.verify_password(data.password):
+  valid, new_hash = await password_hasher.verify_and_update(data.password, user.password)
+  if not valid:
     raise HTTPException(status_code=400, detail="Wrong password")
+  if new_hash:
+    # Hash được tạo với tham số cũ, nâng cấp luôn mà người dùng không cần biết
+    user.password = new_hash
+    await db.commit()
   
   payload = {
     "sub": user.id,
     "email": user.email,
-    "exp": await get_vn_time() + timedelta(hours=24)
+    "exp": await get_vn_time() + ACCESS_TOKEN_LIFETIME
   }
   # token = jwt.encode(payload, SECRET_KEY, algorithm="HS256")
   token = jwt.encode({"alg": "HS256"}, payload, SECRET_KEY)
@@ -191,6 +500,8 @@ async def update_user_avatar(email: str, data: IUpdateUserData, db: AsyncSession
   user.updated_at = await get_vn_time()
   
   await db.commit()
+  invalidate_principal(user.id)
+  profile_loader.invalidate(user.id)
   await db.refresh(user)
 
   return user
@@ -206,6 +517,8 @@ async def update_user_avatar(email: str, data: IUpdateUserAvatarData, db: AsyncS
   user.updated_at = await get_vn_time()
   
   await db.commit()
+  invalidate_principal(user.id)
+  profile_loader.invalidate(user.id)
   await db.refresh(user)
 
   return {"message": "User avatar updated"}
@@ -222,6 +535,8 @@ async def update_user_name(email: str, data: IUpdateUserNameData, db: AsyncSessi
   user.updated_at = await get_vn_time()
   
   await db.commit()
+  invalidate_principal(user.id)
+  profile_loader.invalidate(user.id)
   await db.refresh(user)
 
   return {"message": "User name updated"}
@@ -233,7 +548,17 @@ async def delete_user(email: str, db: AsyncSession = Depends(get_db)):
   user = result.scalars().first()
   if user is None:
     raise HTTPException(status_code=404, detail="User not found")
-  await db.delete(user)
+  # Đánh dấu xoá bền trong transaction của request. Email / mật khẩu bị xoá nên đăng nhập,
+  # tra cứu theo email và đăng ký lại email này coi như user không còn tồn tại
+  db.add(DeletedUser(user_id=user.id))
+  user.email = f"deleted:{user.id}"
+  user.password = ""
   await db.commit()
+  # Tin nhắn được xoá theo từng khối ở nền, sau đó mới xoá dòng user
+  # (participants và friendships đi theo nhờ ON DELETE CASCADE)
+  purge_queue.purge_user(user.id)
+  await revoke_user(user.id)
+  friend_graph.remove_user(user.id)
+  profile_loader.invalidate(user.id)
 
   return {"message": "User deleted successfully"}
\ No newline at end of file
@@ -0,0 +1,60 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+  """Cache LRU trong tiến trình, mỗi mục còn hết hạn sau ttl giây (None = không hết hạn).
+
+  Không dùng chung giữa các worker: nơi gọi phải báo xoá cho các worker khác (vd. qua
+  manager.publish_control) hoặc giữ ttl đủ ngắn để giới hạn thời gian dữ liệu cũ khi
+  tiến trình khác sửa các dòng bên dưới.
+  """
+
+  def __init__(self, maxsize: int = 1024, ttl: float = None):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.data = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key, default=None):
+    entry = self.data.get(key)
+    if entry is not None:
+      expires_at, value = entry
+      if expires_at is None or expires_at > time.monotonic():
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+      del self.data[key]
+    self.misses += 1
+    return default
+
+  def set(self, key, value, ttl: float = None):
+    """ttl (nếu có) thay cho ttl mặc định của cache, chỉ áp dụng cho mục này."""
+    ttl = self.ttl if ttl is None else ttl
+    expires_at = time.monotonic() + ttl if ttl is not None else None
+    self.data[key] = (expires_at, value)
+    self.data.move_to_end(key)
+    while len(self.data) > self.maxsize:
+      self.data.popitem(last=False)
+
+  def invalidate(self, key):
+    self.data.pop(key, None)
+
+  def invalidate_where(self, predicate):
+    """Xoá mọi mục có giá trị thoả predicate (duyệt tuần tự, dành cho thay đổi hiếm)."""
+    for key in [key for key, (_, value) in self.data.items() if predicate(value)]:
+      del self.data[key]
+
+  def clear(self):
+    self.data.clear()
+
+  def stats(self) -> dict:
+    lookups = self.hits + self.misses
+    return {
+      "size": len(self.data),
+      "maxsize": self.maxsize,
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_rate": self.hits / lookups if lookups else 0.0
+    }
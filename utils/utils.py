@@ -1,4 +1,6 @@
+import base64
 import datetime
+import json
 import pytz
 
 async def get_vn_time():
@@ -7,4 +9,47 @@ async def get_vn_time():
   vietnam_now = utc_now.replace(tzinfo=pytz.utc).astimezone(vietnam_tz)
   vietnam_now_naive = vietnam_now.replace(tzinfo=None)
   
-  return vietnam_now_naive
\ No newline at end of file
+  return vietnam_now_naive
+
+
+def encode_cursor(created_at: datetime.datetime, row_id: str) -> str:
+  """Cursor keyset (chuỗi mờ) cho vị trí (created_at, id)."""
+  raw = json.dumps([created_at.isoformat(), row_id]).encode()
+  return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+  """Ngược của encode_cursor, ném ValueError nếu cursor sai định dạng."""
+  try:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    created_at, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    return datetime.datetime.fromisoformat(created_at), str(row_id)
+  except Exception as e:
+    raise ValueError("Invalid cursor") from e
+
+
+def encode_text_cursor(sort_key: str, row_id: str) -> str:
+  """Cursor keyset (chuỗi mờ) cho vị trí (khoá sắp xếp dạng text, id)."""
+  raw = json.dumps([sort_key, row_id]).encode()
+  return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_text_cursor(cursor: str):
+  """Ngược của encode_text_cursor, ném ValueError nếu cursor sai định dạng."""
+  try:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    sort_key, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    return str(sort_key), str(row_id)
+  except Exception as e:
+    raise ValueError("Invalid cursor") from e
+
+
+def escape_like(value: str) -> str:
+  """Escape ký tự đại diện của LIKE để chuỗi người dùng nhập được so khớp nguyên văn (ký tự escape là dấu \\)."""
+  return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def private_pair_key(user_id: str, other_user_id: str) -> str:
+  """Khoá chuẩn của conversation riêng tư: id của hai user theo thứ tự đã sắp xếp."""
+  first, second = sorted((user_id, other_user_id))
+  return f"{first}:{second}"